@@ -0,0 +1,204 @@
+"""
+Benchmark: the sync of many accounts - the threaded path (`SyncEngine.sync_folder` in a pool of
+worker threads, one blocking connection per worker) against the async one (util/async_sync.py:
+one event loop, the commands of an account pipelined).
+
+The IMAP stand-in (imap_standin.py) runs in its own process, with a network delay (`--latency`)
+on every response - the round trips are what the async engine saves. It has `accounts` accounts
+(twice - one set for each path) with `messages` synthetic messages each (in Inbox and Sent).
+Measured for each path:
+- initial sync: the first sync of all the accounts (all their messages - `n_initial` = `messages`)
+- resync: after `--new` new messages and a flag change were delivered to every account
+- no changes: a sync of all the accounts when nothing has changed (the periodic sync)
+The stored counters of both sets of accounts are compared at the end (they must be the same).
+
+Usage:
+    python benchmarks/bench_async_sync.py                    # 50 accounts x 200 messages, 20 ms latency
+    python benchmarks/bench_async_sync.py 200 100 --latency 0.05 --workers 8
+"""
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from imap_tools import MailBoxUnencrypted
+from imap_standin import IMAPStandIn, make_message
+from util.async_imap import AsyncIMAPClient
+from util.async_sync import AsyncSyncEngine
+
+
+FOLDER_MAPPING = {'inbox': 'Inbox', 'sent': 'Sent', 'drafts': 'Drafts', 'bin': 'Trash'}
+PATHS = ('threaded', 'async')
+
+
+def account_email(path, i):
+    return f'{path[0]}{i}@localhost'  # (the same length in both sets - so are the messages)
+
+
+def serve(n_accounts, n_messages, latency, connection):
+    """
+    The stand-in (in a child process): fill the accounts, and serve them until killed.
+    Commands from the benchmark (through `connection`): ('deliver', n) - n new messages and a flag change
+    for every account; ('counters',) - the counters of the stand-in
+    """
+    random.seed(0)
+    standin = IMAPStandIn(latency=latency)
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    emails = [account_email(path, i) for path in PATHS for i in range(n_accounts)]
+    for email in emails:
+        for j in range(n_messages):
+            standin.add_message(email, 'Sent' if j % 5 == 0 else 'Inbox',
+                                make_message(subject=f'Message {j}', to=email, message_id=f'<{j}@example.com>',
+                                             date=start + timedelta(hours=j)),
+                                flags=('\\Seen',) if j % 3 else ())
+    standin.start()
+    connection.send(standin.port)
+    while True:
+        command = connection.recv()
+        if command[0] == 'deliver':
+            for email in emails:
+                for j in range(command[1]):
+                    standin.add_message(email, 'Inbox', make_message(subject=f'New {j}', to=email))
+                with standin.lock:
+                    account = standin.accounts[email]
+                    message = account.folder('Inbox').messages[0]
+                    message.flags = set(message.flags) ^ {'\\Flagged'}
+                    message.modseq = account.next_modseq()
+            connection.send('ok')
+        elif command[0] == 'counters':
+            connection.send(dict(standin.counters))
+
+
+class StandInPool:
+    """ Connections to the stand-in (instead of `MailBoxPool`, which connects to the real servers over TLS) """
+
+    def __init__(self, port):
+        self.port = port
+        self._idle = {}
+
+    @contextmanager
+    def connection(self, email, password):
+        mailbox = self._idle.pop(email, None) or MailBoxUnencrypted('127.0.0.1', self.port).login(email, password)
+        yield mailbox
+        self._idle[email] = mailbox
+
+
+def prepare_app(instance_path, n_accounts, n_messages):
+    """ The app (with a new database), and the users with their folders """
+    os.environ['INSTANCE_PATH'] = instance_path
+    os.chdir(APP_DIR)
+    import app
+    from util.ingest import upsert_folders
+    from util.migrations import upgrade_schema
+    app.sync_engine.n_initial = n_messages
+    with app.app.app_context():
+        upgrade_schema(app.db)  # (`flask --app app migrate`)
+        for path in PATHS:
+            for i in range(n_accounts):
+                user = app.User(username=account_email(path, i))
+                app.db.session.add(user)
+                app.db.session.flush()
+                # (listed now - so the folder mapping is taken from the database, not from the server)
+                upsert_folders(app.db, app.Folder, user.id, FOLDER_MAPPING, datetime.utcnow())
+        app.db.session.commit()
+    app.folder_cache.ttl = 3600
+    return app
+
+
+def sync_threaded(app, pool, email):
+    """ What `sync_folders` in app.py does (on a connection to the stand-in) """
+    with app.app.app_context(), pool.connection(email, 'password') as mailbox:
+        owner = app.db.session.execute(app.db.select(app.User).where(app.User.username == email)).scalar_one()
+        app.folder_cache.get(owner, mailbox)
+        folders = app.db.session.execute(app.db.select(app.Folder).where(app.Folder.owner_id == owner.id)).scalars()
+        return {folder.name: app.sync_engine.sync_folder(mailbox, folder) for folder in folders.all()}
+
+
+def run_threaded(app, pool, n_accounts, workers):
+    """ All the accounts in a pool of worker threads (like the `SyncScheduler`). Returns (seconds, summaries) """
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        summaries = list(executor.map(lambda i: sync_threaded(app, pool, account_email('threaded', i)),
+                                      range(n_accounts)))
+    return time.perf_counter() - started, summaries
+
+
+def run_async(engine, n_accounts):
+    """ All the accounts at once on the event loop. Returns (seconds, summaries) """
+    started = time.perf_counter()
+    futures = [engine.submit(account_email('async', i), 'password') for i in range(n_accounts)]
+    summaries = [future.result() for future in futures]
+    return time.perf_counter() - started, summaries
+
+
+def n_stored(summaries):
+    return sum(len(summary['new_uids']) + len(summary['changed_uids'])
+               for folders in summaries for summary in folders.values())
+
+
+def stored_counters(app, path):
+    """ (n_messages, n_unread, total_size) of all the folders of one set of accounts """
+    with app.app.app_context():
+        Folder, User = app.Folder, app.User
+        return tuple(app.db.session.execute(
+            app.db.select(app.db.func.sum(Folder.n_messages), app.db.func.sum(Folder.n_unread),
+                          app.db.func.sum(Folder.total_size))
+            .join(User, User.id == Folder.owner_id)
+            .where(User.username.like(f'{path[0]}%'))).one())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('accounts', type=int, nargs='?', default=50)
+    parser.add_argument('messages', type=int, nargs='?', default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per round trip')
+    parser.add_argument('--workers', type=int, default=4, help='threads of the threaded path')
+    parser.add_argument('--new', type=int, default=5, help='new messages per account before the resync')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    connection, child_connection = context.Pipe()
+    server = context.Process(target=serve, args=(args.accounts, args.messages, args.latency, child_connection),
+                             daemon=True)
+    server.start()
+    port = connection.recv()
+
+    async def connect(email):
+        return await AsyncIMAPClient.connect('127.0.0.1', port, use_ssl=False)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as instance_path:
+        app = prepare_app(instance_path, args.accounts, args.messages)
+        pool = StandInPool(port)
+        engine = AsyncSyncEngine(app.app, app.sync_engine, app.folder_cache, app.User, connect=connect)
+        for phase in ('initial sync', 'resync', 'no changes'):
+            if phase == 'resync':
+                connection.send(('deliver', args.new))
+                connection.recv()
+            results[phase] = {'threaded': run_threaded(app, pool, args.accounts, args.workers),
+                              'async': run_async(engine, args.accounts)}
+        counters = {path: stored_counters(app, path) for path in PATHS}
+        engine.stop()
+    connection.send(('counters',))
+    standin_counters = connection.recv()
+    server.terminate()
+
+    print(f'{args.accounts} accounts x {args.messages} messages, {args.latency * 1000:.0f} ms per round trip, '
+          f'threaded: {args.workers} workers')
+    for phase, by_path in results.items():
+        print(f'  {phase}:')
+        for path, (seconds, summaries) in by_path.items():
+            print(f'    {path:>8}: {seconds:7.2f} s  {args.accounts / seconds:8.1f} accounts/s  '
+                  f'{n_stored(summaries) / seconds:8.0f} messages/s')
+    print(f'  stored (messages, unread, bytes): threaded {counters["threaded"]}, async {counters["async"]} - '
+          f'{"the same" if counters["threaded"] == counters["async"] else "DIFFERENT"}')
+    print(f'  stand-in: {standin_counters["commands"]} commands')
@@ -0,0 +1,146 @@
+"""
+Benchmark: import of a whole mailbox (util/importer.py) from the local IMAP stand-in (imap_standin.py).
+
+The stand-in runs in its own process (so its copy of the mailbox doesn't count in the memory of the app).
+A mailbox of `messages` synthetic messages (INBOX + Sent) is imported in one go, and measured:
+- throughput (messages / s), against TARGET_MESSAGES_PER_SECOND
+- the growth of the peak RSS of the app's process, against TARGET_RSS_GROWTH_MB
+  (the pipeline keeps one fetch in memory - it must not grow with the size of the mailbox)
+
+--naive - for comparison: `list(mailbox.fetch(...))` of the whole INBOX (what the TODO in login() would do)
+
+Usage:
+    python benchmarks/bench_import.py                  # 20000 messages, only the headers
+    python benchmarks/bench_import.py 50000 --bodies   # the whole messages (IMPORT_BODIES=1)
+    python benchmarks/bench_import.py --naive
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from imap_tools import MailBoxUnencrypted
+from imap_standin import IMAPStandIn, make_message
+
+
+USER = 'user@localhost'
+TARGET_MESSAGES_PER_SECOND = {'headers': 500, 'bodies': 150}
+TARGET_RSS_GROWTH_MB = 100
+WORDS = 'meeting invoice project deadline report budget review please thanks regards team update'.split()
+
+
+def serve(n_messages, ready):
+    """ The stand-in (in a child process): fill the mailbox, and serve it until killed """
+    random.seed(0)
+    standin = IMAPStandIn()
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    for i in range(n_messages):
+        folder = 'Sent' if i % 5 == 0 else 'Inbox'
+        text = ' '.join(random.choice(WORDS) for _ in range(random.randint(50, 600)))
+        standin.add_message(USER, folder, make_message(subject=f'Message {i}', to=USER, text=text,
+                                                       date=start + timedelta(hours=i)),
+                            flags=('\\Seen',) if i % 3 else ())
+    standin.start()
+    ready.send(standin.port)
+    while True:
+        time.sleep(3600)
+
+
+class StandInPool:
+    """ Connections to the stand-in (instead of `MailBoxPool`, which connects to the real servers over TLS) """
+
+    def __init__(self, port):
+        self.port = port
+        self._idle = []
+
+    @contextmanager
+    def connection(self, email, password):
+        mailbox = self._idle.pop() if self._idle else \
+            MailBoxUnencrypted('127.0.0.1', self.port).login(email, password)
+        yield mailbox
+        self._idle.append(mailbox)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # (KB on Linux)
+
+
+def prepare_app(instance_path):
+    """ The app (with a new database), and the user with its folders """
+    os.environ['INSTANCE_PATH'] = instance_path
+    os.chdir(APP_DIR)
+    import app
+    from util.ingest import upsert_folders
+    from util.migrations import upgrade_schema
+    with app.app.app_context():
+        upgrade_schema(app.db)  # (`flask --app app migrate`)
+        user = app.User(username=USER)
+        app.db.session.add(user)
+        app.db.session.commit()
+        # (listed now - so the folder mapping is taken from the database, not from the server)
+        upsert_folders(app.db, app.Folder, user.id, {'inbox': 'Inbox', 'sent': 'Sent'}, datetime.utcnow())
+        app.db.session.commit()
+    return app
+
+
+def sync_folders(app, port):
+    """ The first sync of the folders (done by the scheduler in the app) - the import starts after it """
+    pool = StandInPool(port)
+    with app.app.app_context(), pool.connection(USER, 'password') as mailbox:
+        for folder in app.db.session.scalars(app.db.select(app.Folder)).all():
+            app.sync_engine.sync_folder(mailbox, folder)
+
+
+def run_import(app, port, bodies):
+    from util.importer import MailboxImporter
+    importer = MailboxImporter(app.app, app.sync_engine, StandInPool(port), app.folder_cache, app.User,
+                               bodies=bodies)
+    importer.start(USER, 'password')
+    importer._imports[USER]['thread'].join()
+    return importer.progress(USER)
+
+
+def run_naive(port):
+    with MailBoxUnencrypted('127.0.0.1', port).login(USER, 'password') as mailbox:
+        mailbox.folder.set('Inbox', readonly=True)
+        messages = list(mailbox.fetch(mark_seen=False, bulk=True))
+    return {'state': 'done', 'imported': len(messages)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('messages', type=int, nargs='?', default=20000)
+    parser.add_argument('--bodies', action='store_true')
+    parser.add_argument('--naive', action='store_true')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    server = context.Process(target=serve, args=(args.messages, sender), daemon=True)
+    server.start()
+    port = receiver.recv()
+    with tempfile.TemporaryDirectory() as instance_path:
+        app = prepare_app(instance_path)
+        sync_folders(app, port)
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        progress = run_naive(port) if args.naive else run_import(app, port, args.bodies)
+        elapsed = time.perf_counter() - started
+        growth = peak_rss_mb() - rss_before
+    server.terminate()
+
+    mode = 'bodies' if args.bodies or args.naive else 'headers'
+    rate = progress['imported'] / elapsed
+    print(f'{"naive fetch" if args.naive else "import"} ({mode}): {progress["imported"]} messages '
+          f'in {elapsed:.1f} s, state: {progress["state"]}')
+    print(f'  throughput: {rate:8.0f} messages/s  (target >= {TARGET_MESSAGES_PER_SECOND[mode]})')
+    print(f'  peak RSS growth: {growth:6.1f} MB  (target <= {TARGET_RSS_GROWTH_MB})')
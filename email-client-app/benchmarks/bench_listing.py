@@ -0,0 +1,139 @@
+"""
+Benchmark: listing a page of a folder, old schema vs new schema.
+
+old - emails are linked to folders through the `email_folder` table, no indexes,
+      pages by OFFSET (the first version of the schema)
+new - `email.folder_id` + the (owner_id, folder_id, date DESC, uid DESC) index,
+      pages by the (date, uid) cursor (see get_page_of_emails in app.py)
+
+Usage:
+    python benchmarks/bench_listing.py             # 10k and 100k emails
+    python benchmarks/bench_listing.py 1000000     # any sizes
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+N_FOLDERS = 5
+PAGE_SIZE = 10
+N_QUERIES = 50
+
+OLD_SCHEMA = '''
+CREATE TABLE folder (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, name VARCHAR(32) NOT NULL);
+CREATE TABLE email (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, uid INTEGER, date DATETIME,
+                    "from" VARCHAR(254), "to" VARCHAR(254), subject VARCHAR(255), text VARCHAR);
+CREATE TABLE email_folder (email_id INTEGER, folder_id INTEGER);
+'''
+
+NEW_SCHEMA = '''
+CREATE TABLE folder (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, name VARCHAR(32) NOT NULL,
+                     UNIQUE (owner_id, name));
+CREATE TABLE email (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, folder_id INTEGER NOT NULL,
+                    uid INTEGER, date DATETIME, "from" VARCHAR(254), "to" VARCHAR(254),
+                    subject VARCHAR(255), text VARCHAR, size INTEGER,
+                    UNIQUE (owner_id, folder_id, uid));
+CREATE INDEX ix_email_owner_id_folder_id_date ON email (owner_id, folder_id, date DESC, uid DESC);
+'''
+
+
+def generate_emails(n):
+    """ (folder_id, uid, date, from, to, subject) of n emails of one user """
+    random.seed(0)
+    start = datetime(2015, 1, 1)
+    uids = [0] * (N_FOLDERS + 1)
+    for _ in range(n):
+        folder_id = random.randint(1, N_FOLDERS)
+        uids[folder_id] += 1
+        date = start + timedelta(seconds=random.randint(0, 10 * 365 * 24 * 3600))
+        yield (folder_id, uids[folder_id], date.isoformat(sep=' '),
+               'sender@example.com', 'user@example.com', f'Subject {uids[folder_id]}')
+
+
+def fill(connection, schema, n):
+    connection.executescript(schema)
+    connection.executemany('INSERT INTO folder (id, owner_id, name) VALUES (?, 1, ?)',
+                           [(i, f'folder{i}') for i in range(1, N_FOLDERS + 1)])
+    if schema is OLD_SCHEMA:
+        for email_id, (folder_id, *email) in enumerate(generate_emails(n), start=1):
+            connection.execute('INSERT INTO email (id, owner_id, uid, date, "from", "to", subject) '
+                               'VALUES (?, 1, ?, ?, ?, ?, ?)', (email_id, *email))
+            connection.execute('INSERT INTO email_folder VALUES (?, ?)', (email_id, folder_id))
+    else:
+        connection.executemany('INSERT INTO email (owner_id, folder_id, uid, date, "from", "to", subject) '
+                               'VALUES (1, ?, ?, ?, ?, ?, ?)', generate_emails(n))
+    connection.commit()
+    connection.execute('ANALYZE')
+
+
+def old_page(connection, folder_id, page):
+    return connection.execute('''
+        SELECT e.uid, e.date, e."from", e."to", e.subject FROM email e
+        JOIN email_folder l ON l.email_id = e.id
+        WHERE l.folder_id = ? AND e.owner_id = 1
+        ORDER BY e.date DESC, e.uid DESC LIMIT ? OFFSET ?
+    ''', (folder_id, PAGE_SIZE, page * PAGE_SIZE)).fetchall()
+
+
+def new_page(connection, folder_id, cursor):
+    query = ('SELECT uid, date, "from", "to", subject, size FROM email '
+             'WHERE owner_id = 1 AND folder_id = ? ')
+    params = [folder_id]
+    if cursor is not None:
+        query += 'AND (date, uid) < (?, ?) '
+        params += cursor
+    query += 'ORDER BY date DESC, uid DESC LIMIT ?'
+    return connection.execute(query, (*params, PAGE_SIZE)).fetchall()
+
+
+def time_queries(function):
+    """ Median time of one call (ms) """
+    times = []
+    for _ in range(N_QUERIES):
+        t0 = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - t0) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def deep_cursor(connection, folder_id, page):
+    """ The cursor of the `page`-th page (as the client would have it after scrolling) """
+    row = connection.execute(
+        'SELECT date, uid FROM email WHERE owner_id = 1 AND folder_id = ? '
+        'ORDER BY date DESC, uid DESC LIMIT 1 OFFSET ?', (folder_id, page * PAGE_SIZE - 1)).fetchone()
+    return list(row)
+
+
+def run(n):
+    with tempfile.TemporaryDirectory() as tmp:
+        old = sqlite3.connect(os.path.join(tmp, 'old.db'))
+        new = sqlite3.connect(os.path.join(tmp, 'new.db'))
+        fill(old, OLD_SCHEMA, n)
+        fill(new, NEW_SCHEMA, n)
+        deep_page = n // N_FOLDERS // PAGE_SIZE // 2  # a page in the middle of the folder
+        cursor = deep_cursor(new, 1, deep_page)
+        results = {
+            'first page': (time_queries(lambda: old_page(old, 1, 0)),
+                           time_queries(lambda: new_page(new, 1, None))),
+            f'page {deep_page}': (time_queries(lambda: old_page(old, 1, deep_page)),
+                                  time_queries(lambda: new_page(new, 1, cursor))),
+        }
+        plan = new.execute('EXPLAIN QUERY PLAN SELECT uid, date FROM email WHERE owner_id = 1 AND folder_id = 1 '
+                           'ORDER BY date DESC, uid DESC LIMIT 10').fetchall()
+        old.close()
+        new.close()
+    print(f'\n{n} emails ({N_FOLDERS} folders), median of {N_QUERIES} queries:')
+    for name, (old_ms, new_ms) in results.items():
+        print(f'  {name:>12}: old {old_ms:9.3f} ms   new {new_ms:7.3f} ms   x{old_ms / new_ms:.0f}')
+    print('  new plan:', '; '.join(row[-1] for row in plan))
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    for n in sizes:
+        run(n)
@@ -0,0 +1,85 @@
+"""
+Benchmark: full-text search (util/search.py) on a synthetic mailbox.
+
+Usage:
+    python benchmarks/bench_search.py             # 100k emails
+    python benchmarks/bench_search.py 1000000     # any sizes
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util.search import SEARCH_INDEX_SQL, SEARCH_TRIGGERS_SQL, RANK_WEIGHTS, to_match_expression
+
+
+N_QUERIES = 20
+# A Zipf-like vocabulary: a few very common words and a long tail of rare ones (like in real text)
+TOPICS = ('invoice meeting report project budget holiday contract review schedule update '
+          'delivery payment travel launch hiring feedback quarter design release support').split()
+VOCABULARY = TOPICS + [f'w{i}' for i in range(20000)]
+WEIGHTS = [1 / (rank + 10) for rank in range(len(VOCABULARY))]
+QUERIES = ['invoice', 'budget review', 'proj', 'contract payment quarter', 'nonexistentword']
+
+SCHEMA = '''
+CREATE TABLE folder (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, name VARCHAR(32) NOT NULL);
+CREATE TABLE email (id INTEGER PRIMARY KEY, owner_id INTEGER NOT NULL, folder_id INTEGER NOT NULL,
+                    uid INTEGER, date DATETIME, "from" VARCHAR(254), "to" VARCHAR(254),
+                    subject VARCHAR(255), text VARCHAR, size INTEGER);
+CREATE TABLE attachment (id INTEGER PRIMARY KEY, email_id INTEGER NOT NULL, filename VARCHAR(255));
+'''
+
+# The query of util/search.py (without the folder and date filters):
+SEARCH_SQL = f'''
+SELECT e.uid, e.date, e."from", e.subject
+FROM email_fts JOIN email e ON e.id = email_fts.rowid
+WHERE email_fts MATCH ? AND e.owner_id = 1
+ORDER BY bm25(email_fts, {', '.join(map(str, RANK_WEIGHTS))}), e.id DESC
+LIMIT 20
+'''
+
+
+def generate_emails(n):
+    random.seed(0)
+    for i in range(n):
+        subject = ' '.join(random.choices(VOCABULARY, WEIGHTS, k=5))
+        text = ' '.join(random.choices(VOCABULARY, WEIGHTS, k=100))
+        yield (random.randint(1, 5), i + 1, f'2020-01-01 00:00:{i % 60:02}', f'user{i % 500}@example.com',
+               'me@example.com', subject, text, len(text))
+
+
+def run(n):
+    with tempfile.TemporaryDirectory() as tmp:
+        connection = sqlite3.connect(os.path.join(tmp, 'search.db'))
+        connection.executescript(SCHEMA)
+        connection.execute(SEARCH_INDEX_SQL)
+        for trigger in SEARCH_TRIGGERS_SQL:
+            connection.execute(trigger)
+        t0 = time.perf_counter()
+        connection.executemany(
+            'INSERT INTO email (owner_id, folder_id, uid, date, "from", "to", subject, text, size) '
+            'VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?)', generate_emails(n))
+        connection.commit()
+        indexing = time.perf_counter() - t0
+        size = os.path.getsize(os.path.join(tmp, 'search.db'))
+
+        print(f'\n{n} emails: inserted + indexed in {indexing:.1f} s, database {size / 2**20:.0f} MB')
+        for query in QUERIES:
+            match = to_match_expression(query)
+            times = []
+            for _ in range(N_QUERIES):
+                t0 = time.perf_counter()
+                rows = connection.execute(SEARCH_SQL, (match,)).fetchall()
+                times.append((time.perf_counter() - t0) * 1000)
+            print(f'  {query!r:>28}: median {sorted(times)[len(times) // 2]:8.2f} ms  ({len(rows)} results)')
+        connection.close()
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100_000]
+    for n in sizes:
+        run(n)
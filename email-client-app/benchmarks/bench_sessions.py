@@ -0,0 +1,102 @@
+"""
+Benchmark: the cost of loading + saving the session, per request, for every session backend.
+
+filesystem - Flask-Session with SESSION_TYPE = 'filesystem' (the previous setup), if it's installed
+cookie     - Flask's default signed cookie (no server-side state - for reference)
+sqlite / memory / redis - util/sessions.py (redis - with the in-process stand-in, see redis_standin.py)
+
+Every user makes requests that only read the session (like most requests of the app),
+and every 10th request changes it. `N_USERS` other sessions are stored beforehand.
+
+Usage:
+    python benchmarks/bench_sessions.py              # 10k stored sessions
+    python benchmarks/bench_sessions.py 100000       # any numbers
+"""
+
+import os
+import sys
+import tempfile
+import time
+from flask import Flask, session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util.sessions import (ServerSideSessionInterface, SQLiteSessionStore, MemorySessionStore,
+                           RedisSessionStore)
+from redis_standin import RedisStandIn
+
+
+N_REQUESTS = 5000
+N_CLIENTS = 20
+
+
+def create_app(backend, tmp):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'benchmark'
+    if backend == 'filesystem':
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = os.path.join(tmp, 'flask_session')
+        app.config['SESSION_FILE_THRESHOLD'] = 10 ** 9  # (no sweeps in the middle of the measurement)
+        Session(app)
+    elif backend == 'sqlite':
+        app.session_interface = ServerSideSessionInterface(SQLiteSessionStore(os.path.join(tmp, 'sessions.db')))
+    elif backend == 'memory':
+        app.session_interface = ServerSideSessionInterface(MemorySessionStore(max_sessions=10 ** 7))
+    elif backend == 'redis':
+        app.session_interface = ServerSideSessionInterface(RedisSessionStore(RedisStandIn()))
+
+    @app.route('/read')
+    def read():
+        return str(session.get('email'))
+
+    @app.route('/write')
+    def write():
+        session['email'] = 'user@example.com'
+        session['password'] = 'x' * 16
+        session['logged in'] = True
+        session['n'] = session.get('n', 0) + 1
+        return 'ok'
+
+    @app.route('/none')
+    def none():
+        return 'ok'
+    return app
+
+
+def measure(app, paths):
+    client = app.test_client()
+    t0 = time.perf_counter()
+    for path in paths:
+        client.get(path)
+    return (time.perf_counter() - t0) / len(paths) * 10 ** 6
+
+
+def run(n_users):
+    print(f'\n{n_users} stored sessions, {N_REQUESTS} requests (every 10th writes), microseconds per request:')
+    backends = ['cookie', 'sqlite', 'memory', 'redis']
+    try:
+        import flask_session  # noqa: F401
+        backends.insert(0, 'filesystem')
+    except ImportError:
+        print('  (Flask-Session is not installed - no filesystem backend)')
+    for backend in backends:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = create_app(backend, tmp)
+            # The other users' sessions:
+            for _ in range(n_users):
+                app.test_client().get('/write')
+            baseline = measure(app, ['/none'] * N_REQUESTS)  # (a request that doesn't touch the session)
+            clients = [app.test_client() for _ in range(N_CLIENTS)]
+            for client in clients:
+                client.get('/write')
+            t0 = time.perf_counter()
+            for i in range(N_REQUESTS):
+                clients[i % N_CLIENTS].get('/write' if i % 10 == 0 else '/read')
+            per_request = (time.perf_counter() - t0) / N_REQUESTS * 10 ** 6
+            print(f'  {backend:>10}: {per_request:8.0f} total, {per_request - baseline:8.0f} session')
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000]
+    for n in sizes:
+        run(n)
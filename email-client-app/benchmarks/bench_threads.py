@@ -0,0 +1,158 @@
+"""
+Benchmark: the listing of a folder grouped into conversations, against the flat listing.
+
+A new database (in a temporary instance folder) is filled with `emails` synthetic messages
+(in threads of 1-8 messages, in INBOX and Sent) through the write job of the sync (`_store_new_messages`),
+so the threads are found at ingest - as they are in the app. Measured:
+- ingest: messages / s with the threading (and without it - `SyncEngine.thread_index = None`)
+- a page of the flat listing (`get_page_of_emails`) and of the grouped one (`get_page_of_threads`),
+  the first one and one in the middle of the folder
+- for comparison: grouping per request (GROUP BY thread over the whole folder)
+
+Usage:
+    python benchmarks/bench_threads.py            # 20000 emails
+    python benchmarks/bench_threads.py 200000
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+
+USER = 'user@localhost'
+PAGE_SIZE = 10
+N_QUERIES = 50
+BATCH = 100  # (messages per write job - like the sync)
+
+
+def generate_messages(n):
+    """ Header rows (see `SyncEngine._header_row`) of n messages: (folder name, row), oldest first """
+    random.seed(0)
+    start = datetime(2015, 1, 1)
+    uids = {'inbox': 0, 'sent': 0}
+    i = 0
+    while i < n:
+        thread_size = random.randint(1, 8)
+        first = start + timedelta(minutes=i * 30)
+        references = []
+        for j in range(min(thread_size, n - i)):
+            folder = 'sent' if j % 3 == 2 else 'inbox'
+            uids[folder] += 1
+            message_id = f'<{i}.{j}@example.com>'
+            yield folder, {'uid': uids[folder],
+                           'date': first + timedelta(hours=j * random.randint(1, 48)),
+                           'from_': 'sender@example.com',
+                           'to': USER,
+                           'subject': ('Re: ' if j else '') + f'Subject {i}',
+                           'flags': '\\Seen' if random.random() < 0.7 else '',
+                           'size': random.randint(2000, 50000),
+                           'body_fetched': False,
+                           'message_id': message_id,
+                           'references': ' '.join(references[-20:]) or None}
+            references.append(message_id)
+        i += thread_size
+
+
+def prepare_app(instance_path):
+    os.environ['INSTANCE_PATH'] = instance_path
+    os.chdir(APP_DIR)
+    import app
+    from util.ingest import upsert_folders
+    from util.migrations import upgrade_schema
+    with app.app.app_context():
+        upgrade_schema(app.db)  # (`flask --app app migrate`)
+        user = app.User(username=USER)
+        app.db.session.add(user)
+        app.db.session.commit()
+        upsert_folders(app.db, app.Folder, user.id, {'inbox': 'INBOX', 'sent': 'Sent'}, datetime.utcnow())
+        app.db.session.commit()
+    return app
+
+
+def ingest(app, messages):
+    """ Store the messages in batches of `BATCH` per folder. Returns messages / s """
+    folders = {folder.name: folder.folder_id
+               for folder in app.db.session.scalars(app.db.select(app.Folder)).all()}
+    pending = {'inbox': [], 'sent': []}
+    started = time.perf_counter()
+    n = 0
+    for folder, row in messages:
+        pending[folder].append(row)
+        if len(pending[folder]) == BATCH:
+            app.sync_engine.write(app.sync_engine._store_new_messages, folders[folder], pending[folder])
+            n += len(pending[folder])
+            pending[folder] = []
+    for folder, rows in pending.items():
+        if rows:
+            app.sync_engine.write(app.sync_engine._store_new_messages, folders[folder], rows)
+            n += len(rows)
+    return n / (time.perf_counter() - started)
+
+
+def time_queries(function):
+    """ Median time of one call (ms) """
+    times = []
+    for _ in range(N_QUERIES):
+        t0 = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - t0) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def grouped_per_request(app, folder):
+    """ What the grouped listing would cost without the thread index: group the whole folder per request """
+    db, Email = app.db, app.Email
+    return db.session.execute(
+        db.select(Email.thread_id, db.func.count(), db.func.max(Email.date).label('last_date'))
+        .where(Email.owner_id == folder.owner_id)
+        .where(Email.folder_id == folder.folder_id)
+        .group_by(Email.thread_id)
+        .order_by(db.desc('last_date'))
+        .limit(PAGE_SIZE)).all()
+
+
+def deep_cursor(get_page, folder, pages):
+    cursor = None
+    for _ in range(pages):
+        _, cursor = get_page(folder, cursor, PAGE_SIZE)
+    return cursor
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as instance_path:
+        app = prepare_app(instance_path)
+        with app.app.app_context():
+            # (without the threading - for the ingest rate only, then deleted)
+            thread_index, app.sync_engine.thread_index = app.sync_engine.thread_index, None
+            plain_rate = ingest(app, generate_messages(min(n, 5000)))
+            app.db.session.execute(app.db.delete(app.Email))
+            app.db.session.execute(app.db.update(app.Folder).values(n_messages=0, n_unread=0, total_size=0))
+            app.db.session.commit()
+            app.sync_engine.thread_index = thread_index
+            threaded_rate = ingest(app, generate_messages(n))
+
+            inbox = app.db.session.execute(app.db.select(app.Folder).where(app.Folder.name == 'inbox')).scalar_one()
+            n_threads = app.db.session.scalar(app.db.select(app.db.func.count()).select_from(app.ThreadFolder)
+                                              .where(app.ThreadFolder.folder_id == inbox.folder_id))
+            flat_cursor = deep_cursor(app.get_page_of_emails, inbox, inbox.n_messages // PAGE_SIZE // 2)
+            grouped_cursor = deep_cursor(app.get_page_of_threads, inbox, n_threads // PAGE_SIZE // 2)
+            results = {
+                'first page': (time_queries(lambda: app.get_page_of_emails(inbox, None, PAGE_SIZE)),
+                               time_queries(lambda: app.get_page_of_threads(inbox, None, PAGE_SIZE))),
+                'middle page': (time_queries(lambda: app.get_page_of_emails(inbox, flat_cursor, PAGE_SIZE)),
+                                time_queries(lambda: app.get_page_of_threads(inbox, grouped_cursor, PAGE_SIZE))),
+            }
+            per_request = time_queries(lambda: grouped_per_request(app, inbox))
+
+    print(f'{n} emails, INBOX: {inbox.n_messages} messages in {n_threads} threads')
+    print(f'  ingest: {threaded_rate:8.0f} messages/s with threading ({plain_rate:.0f} without)')
+    print(f'  median of {N_QUERIES} queries:')
+    for name, (flat_ms, grouped_ms) in results.items():
+        print(f'  {name:>12}: flat {flat_ms:7.3f} ms   grouped {grouped_ms:7.3f} ms')
+    print(f'  grouping per request (GROUP BY over the folder): {per_request:.3f} ms')
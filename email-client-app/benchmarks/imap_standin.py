@@ -0,0 +1,665 @@
+"""
+A small in-process IMAP4rev1 server (a stand-in for Gmail / ukr.net)
+
+It keeps the mailboxes in memory and supports the commands the email client uses:
+CAPABILITY, LOGIN, LIST, STATUS, SELECT/EXAMINE, (UID) SEARCH/FETCH/STORE/COPY/MOVE,
+EXPUNGE, APPEND, CREATE/RENAME/DELETE, NOOP, IDLE, ENABLE, UNSELECT, CLOSE, LOGOUT.
+(+ CONDSTORE: HIGHESTMODSEQ, MODSEQ and FETCH ... (CHANGEDSINCE n))
+
+Usage:
+    server = IMAPStandIn(latency=0.005)  # seconds (network delay: a response is sent that much after its command)
+    server.add_message('user@localhost', 'Inbox', raw_bytes)  # (or a function that returns them - when requested)
+    server.start()  # runs in a background thread, on server.port
+    ...
+    server.stop()
+"""
+
+import queue
+import re
+import select
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+
+DEFAULT_FOLDERS = {  # name -> SPECIAL-USE flags (RFC 6154)
+    'Inbox': '',
+    'Sent': '\\Sent',
+    'Drafts': '\\Drafts',
+    'Trash': '\\Trash',
+    'Spam': '\\Junk',
+}
+CAPABILITIES = 'IMAP4rev1 IDLE MOVE UIDPLUS CONDSTORE ENABLE UNSELECT SPECIAL-USE LITERAL+'
+
+TOKEN_RE = re.compile(rb'\s*(?:"((?:[^"\\]|\\.)*)"|\{(\d+)\+?\}\r\n|(\()|(\))|([^\s()"]+(?:\[[^\]]*\](?:<[\d.]+>)?)?))')
+FETCH_ITEM_RE = re.compile(r'[^\s()\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+
+
+class StoredMessage:
+    __slots__ = ('uid', '_raw', 'flags', 'modseq', 'internaldate')
+
+    def __init__(self, uid, raw, flags, modseq, internaldate):
+        self.uid = uid
+        self._raw = raw  # bytes, or a function that makes them (a big synthetic mailbox isn't kept in memory)
+        self.flags = set(flags)
+        self.modseq = modseq
+        self.internaldate = internaldate
+
+    @property
+    def raw(self):
+        return self._raw() if callable(self._raw) else self._raw
+
+    @property
+    def header(self):
+        raw = self.raw
+        end = raw.find(b'\r\n\r\n')
+        return raw if end < 0 else raw[:end + 4]
+
+    @property
+    def text(self):
+        raw = self.raw
+        end = raw.find(b'\r\n\r\n')
+        return b'' if end < 0 else raw[end + 4:]
+
+
+class StoredFolder:
+    def __init__(self, name, uidvalidity, special_use=''):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.special_use = special_use
+        self.messages = []  # in uid order (the index + 1 is the message sequence number)
+
+    def append(self, raw, flags, modseq, internaldate=None):
+        message = StoredMessage(self.uidnext, raw, flags, modseq,
+                                internaldate or datetime.now(timezone.utc))
+        self.uidnext += 1
+        self.messages.append(message)
+        return message
+
+
+class Account:
+    def __init__(self, password):
+        self.password = password
+        self.folders = {}
+        self.modseq = 1
+        self.changed = threading.Condition()  # notified on every change (for IDLE)
+        for name, special_use in DEFAULT_FOLDERS.items():
+            self.create_folder(name, special_use)
+
+    def create_folder(self, name, special_use=''):
+        folder = StoredFolder(name, int(time.time()) + len(self.folders), special_use)
+        self.folders[name] = folder
+        return folder
+
+    def folder(self, name):
+        """ Find a folder by name (INBOX is case-insensitive) """
+        if name.upper() == 'INBOX':
+            name = next((n for n in self.folders if n.upper() == 'INBOX'), name)
+        return self.folders.get(name)
+
+    def next_modseq(self):
+        self.modseq += 1
+        return self.modseq
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    request_queue_size = 128  # (many accounts connect at once - the default backlog is 5)
+
+
+class IMAPStandIn:
+    """ The server (the state of all the accounts + a threading TCP server) """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, password=None):
+        self.host = host
+        self.port = port
+        # seconds: every response is sent that much after its command has arrived (like the round trip of a network
+        # - the commands sent together (pipelined) wait for it once, the commands sent one by one - each of them)
+        self.latency = latency
+        self.password = password  # if None - any password is accepted
+        self.accounts = {}
+        self.lock = threading.RLock()
+        self.counters = {'connections': 0, 'commands': 0, 'bytes_sent': 0}
+        self._server = None
+        self._thread = None
+
+    def account(self, username, password=None):
+        with self.lock:
+            if username not in self.accounts:
+                self.accounts[username] = Account(password if password is not None else self.password)
+            return self.accounts[username]
+
+    def add_message(self, username, folder, raw, flags=(), internaldate=None):
+        """ Deliver a message (as if it came from the outside). raw - bytes, or a function that returns them """
+        account = self.account(username)
+        with self.lock:
+            if account.folder(folder) is None:
+                account.create_folder(folder)
+            message = account.folder(folder).append(raw, flags, account.next_modseq(), internaldate)
+        account.notify()
+        return message.uid
+
+    def start(self):
+        standin = self
+
+        class Handler(IMAPHandler):
+            server_state = standin
+
+        self._server = StandInServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+def parse_sequence_set(sequence_set, largest):
+    """ '1:3,7,9:*' -> set of numbers (`*` is `largest`) """
+    numbers = set()
+    for part in sequence_set.split(','):
+        if ':' in part:
+            start, end = part.split(':')
+            start = largest if start == '*' else int(start)
+            end = largest if end == '*' else int(end)
+            if start > end:
+                start, end = end, start
+            numbers.update(range(start, end + 1))
+        else:
+            numbers.add(largest if part == '*' else int(part))
+    return numbers
+
+
+def quote(name):
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    server_state = None  # IMAPStandIn (set by a subclass)
+    disable_nagle_algorithm = True  # (a response of many lines is not held back until the client's delayed ACK)
+
+    def setup(self):
+        super().setup()
+        self._due = 0.0  # (monotonic time) when the responses of the current command can be sent
+        self._outgoing = None
+        if self.server_state.latency:
+            self._outgoing = queue.Queue()
+            self._sender = threading.Thread(target=self._send_delayed, daemon=True)
+            self._sender.start()
+
+    def finish(self):
+        if self._outgoing is not None:
+            self._outgoing.put(None)
+            self._sender.join()
+        super().finish()
+
+    def handle(self):
+        self.state = self.server_state
+        self.account = None
+        self.selected = None
+        self.readonly = False
+        with self.state.lock:
+            self.state.counters['connections'] += 1
+        self.send_line(f'* OK [CAPABILITY {CAPABILITIES}] IMAP stand-in ready')
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            with self.state.lock:
+                self.state.counters['commands'] += 1
+            self._due = time.monotonic() + self.state.latency
+            tokens = tokenize(line)
+            if len(tokens) < 2:
+                self.send_line('* BAD empty command')
+                continue
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            uid = False
+            if command == 'UID' and args:
+                uid = True
+                command, args = args[0].upper(), args[1:]
+            try:
+                result = self.dispatch(tag, command, args, uid)
+            except (ValueError, IndexError, KeyError) as e:
+                self.send_line(f'{tag} BAD {type(e).__name__}: {e}')
+                continue
+            if result == 'LOGOUT':
+                return
+
+    # --- reading / writing ---
+
+    def read_command(self):
+        """ Read one command (with its literals) """
+        data = b''
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            data += line
+            literal = re.search(rb'\{(\d+)(\+?)\}\r\n$', line)
+            if not literal:
+                return data
+            if not literal.group(2):
+                self.send_line('+ Ready for literal data')
+            data += self.rfile.read(int(literal.group(1)))
+
+    def send(self, data):
+        if self._outgoing is not None:
+            self._outgoing.put((self._due, data))
+        else:
+            self.wfile.write(data)
+        with self.state.lock:
+            self.state.counters['bytes_sent'] += len(data)
+
+    def _send_delayed(self):
+        """ (a thread per connection, with latency) Send the responses when they are due """
+        while True:
+            item = self._outgoing.get()
+            if item is None:
+                return
+            due, data = item
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass  # (the client has gone - the rest is dropped too)
+
+    def send_line(self, line):
+        self.send(line.encode() + b'\r\n')
+
+    # --- commands ---
+
+    def dispatch(self, tag, command, args, uid):
+        if command == 'CAPABILITY':
+            self.send_line(f'* CAPABILITY {CAPABILITIES}')
+        elif command == 'NOOP':
+            self.send_updates()
+        elif command == 'LOGOUT':
+            self.send_line('* BYE logging out')
+            self.send_line(f'{tag} OK LOGOUT completed')
+            return 'LOGOUT'
+        elif command == 'LOGIN':
+            username, password = (arg.decode() if isinstance(arg, bytes) else arg for arg in args[:2])
+            account = self.state.account(username)
+            if account.password is not None and account.password != password:
+                self.send_line(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials')
+                return
+            self.account = account
+        elif self.account is None:
+            self.send_line(f'{tag} BAD not authenticated')
+            return
+        elif command == 'ENABLE':
+            self.send_line('* ENABLED ' + ' '.join(args))
+        elif command in ('LIST', 'LSUB'):
+            self.list_folders()
+        elif command == 'STATUS':
+            self.status(args[0], args[1])
+        elif command in ('SELECT', 'EXAMINE'):
+            if not self.select(tag, args[0], readonly=command == 'EXAMINE'):
+                return
+            self.send_line(f'{tag} OK [{"READ-ONLY" if self.readonly else "READ-WRITE"}] {command} completed')
+            return
+        elif command in ('UNSELECT', 'CLOSE'):
+            if command == 'CLOSE' and self.selected and not self.readonly:
+                self.expunge(None, send=False)
+            self.selected = None
+        elif command == 'CREATE':
+            with self.state.lock:
+                if args[0] in self.account.folders:
+                    self.send_line(f'{tag} NO [ALREADYEXISTS] folder exists')
+                    return
+                self.account.create_folder(args[0])
+        elif command == 'DELETE':
+            with self.state.lock:
+                if self.account.folders.pop(args[0], None) is None:
+                    self.send_line(f'{tag} NO [NONEXISTENT] no such folder')
+                    return
+        elif command == 'RENAME':
+            with self.state.lock:
+                folder = self.account.folders.pop(args[0])
+                folder.name = args[1]
+                self.account.folders[args[1]] = folder
+        elif command == 'APPEND':
+            code = self.append(args)
+            self.send_line(f'{tag} OK [{code}] APPEND completed')
+            return
+        elif command == 'IDLE':
+            self.idle(tag)
+            return
+        elif self.selected is None:
+            self.send_line(f'{tag} BAD no folder selected')
+            return
+        elif command == 'SEARCH':
+            self.search(args, uid)
+        elif command == 'FETCH':
+            self.fetch(args, uid)
+        elif command == 'STORE':
+            self.store(args, uid)
+        elif command in ('COPY', 'MOVE'):
+            code = self.copy(args, uid, move=command == 'MOVE')
+            if code is None:
+                self.send_line(f'{tag} NO [TRYCREATE] no such folder')
+                return
+            self.send_line(f'{tag} OK [{code}] {command} completed')
+            return
+        elif command == 'EXPUNGE':
+            self.expunge(args[0] if uid and args else None)
+        else:
+            self.send_line(f'{tag} BAD unknown command {command}')
+            return
+        self.send_line(f'{tag} OK {command} completed')
+
+    def list_folders(self):
+        with self.state.lock:
+            folders = list(self.account.folders.values())
+        for folder in folders:
+            flags = ' '.join(flag for flag in ('\\HasNoChildren', folder.special_use) if flag)
+            self.send_line(f'* LIST ({flags}) "/" {quote(folder.name)}')
+
+    def status(self, name, items):
+        with self.state.lock:
+            folder = self.account.folder(name)
+            values = {
+                'MESSAGES': len(folder.messages),
+                'RECENT': 0,
+                'UIDNEXT': folder.uidnext,
+                'UIDVALIDITY': folder.uidvalidity,
+                'UNSEEN': sum('\\Seen' not in m.flags for m in folder.messages),
+                'HIGHESTMODSEQ': max([m.modseq for m in folder.messages], default=1),
+            }
+        requested = items.strip('()').upper().split()
+        answer = ' '.join(f'{item} {values[item]}' for item in requested if item in values)
+        self.send_line(f'* STATUS {quote(name)} ({answer})')
+
+    def select(self, tag, name, readonly):
+        with self.state.lock:
+            folder = self.account.folder(name)
+            if folder is None:
+                self.send_line(f'{tag} NO [NONEXISTENT] no such folder')
+                return False
+            self.selected = folder
+            self.readonly = readonly
+            self.known_exists = len(folder.messages)
+            highestmodseq = max([m.modseq for m in folder.messages], default=1)
+            self.send_line(f'* {len(folder.messages)} EXISTS')
+            self.send_line('* 0 RECENT')
+            self.send_line('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+            self.send_line(f'* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid')
+            self.send_line(f'* OK [UIDNEXT {folder.uidnext}] Predicted next UID')
+            self.send_line(f'* OK [HIGHESTMODSEQ {highestmodseq}] Highest')
+        return True
+
+    def resolve(self, sequence_set, uid):
+        """ sequence set -> [(sequence number, message)] """
+        messages = self.selected.messages
+        if not messages:
+            return []
+        if uid:
+            wanted = parse_sequence_set(sequence_set, messages[-1].uid)
+            return [(i + 1, m) for i, m in enumerate(messages) if m.uid in wanted]
+        wanted = parse_sequence_set(sequence_set, len(messages))
+        return [(i + 1, m) for i, m in enumerate(messages) if i + 1 in wanted]
+
+    def search(self, args, uid):
+        if args and args[0].upper() == 'CHARSET':
+            args = args[2:]
+        with self.state.lock:
+            selected = [(i + 1, m) for i, m in enumerate(self.selected.messages)]
+            i = 0
+            while i < len(args):
+                key = args[i].upper()
+                if key == 'ALL':
+                    pass
+                elif key == 'UID':
+                    i += 1
+                    wanted = {m.uid for _, m in self.resolve(args[i], uid=True)}
+                    selected = [(n, m) for n, m in selected if m.uid in wanted]
+                elif key in ('SEEN', 'UNSEEN'):
+                    selected = [(n, m) for n, m in selected if ('\\Seen' in m.flags) == (key == 'SEEN')]
+                elif re.match(r'^[\d:*,]+$', key):
+                    wanted = {m.uid for _, m in self.resolve(args[i], uid=False)}
+                    selected = [(n, m) for n, m in selected if m.uid in wanted]
+                i += 1
+        found = ' '.join(str(m.uid if uid else n) for n, m in selected)
+        self.send_line('* SEARCH' + (' ' + found if found else ''))
+
+    def fetch(self, args, uid):
+        # (a section can have spaces in it: "BODY.PEEK[HEADER.FIELDS (MESSAGE-ID REFERENCES)]")
+        sequence_set, items = args[0], FETCH_ITEM_RE.findall(args[1][1:-1] if args[1].startswith('(') else args[1])
+        changedsince = None
+        if len(args) > 2 and 'CHANGEDSINCE' in args[2].upper():
+            changedsince = int(args[2].strip('()').split()[1])
+        if uid and 'UID' not in [item.upper() for item in items]:
+            items = ['UID'] + items
+        with self.state.lock:
+            resolved = self.resolve(sequence_set, uid)
+            for number, message in resolved:
+                if changedsince is not None and message.modseq <= changedsince:
+                    continue
+                self.send(self.fetch_response(number, message, items, changedsince is not None))
+
+    def fetch_response(self, number, message, items, with_modseq):
+        parts = []
+        literals = []
+        for item in items:
+            name = item.upper()
+            if name == 'UID':
+                parts.append(f'UID {message.uid}'.encode())
+            elif name == 'FLAGS':
+                continue  # (added at the end - after the body could have set \Seen)
+            elif name == 'MODSEQ':
+                with_modseq = True
+            elif name == 'RFC822.SIZE':
+                parts.append(f'RFC822.SIZE {len(message.raw)}'.encode())
+            elif name == 'INTERNALDATE':
+                parts.append(f'INTERNALDATE "{message.internaldate.strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode())
+            elif name.startswith('BODY') or name.startswith('RFC822'):
+                section = re.search(r'\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', name)
+                section_name = section.group(1) if section else ''
+                if section_name == 'HEADER' or name == 'RFC822.HEADER':
+                    data = message.header
+                elif section_name.startswith('HEADER.FIELDS'):
+                    data = header_fields(message.header, section_name)
+                elif section_name == 'TEXT' or name == 'RFC822.TEXT':
+                    data = message.text
+                else:
+                    data = message.raw
+                label = 'BODY[' + section_name + ']' if section else name
+                if section and section.group(2):
+                    start = int(section.group(2))
+                    data = data[start:start + int(section.group(3))]
+                    label += f'<{start}>'
+                if '.PEEK' not in name and not self.readonly and name != 'RFC822.HEADER':
+                    if '\\Seen' not in message.flags:
+                        message.flags.add('\\Seen')
+                        message.modseq = self.account.next_modseq()
+                literals.append((label, data))
+        parts.append(f'FLAGS ({" ".join(sorted(message.flags))})'.encode())
+        if with_modseq:
+            parts.append(f'MODSEQ ({message.modseq})'.encode())
+        response = f'* {number} FETCH ('.encode() + b' '.join(parts)
+        for label, data in literals:
+            response += f' {label} {{{len(data)}}}\r\n'.encode() + data
+        return response + b')\r\n'
+
+    def store(self, args, uid):
+        sequence_set, action, flags = args[0], args[1].upper(), args[2].strip('()').split()
+        silent = action.endswith('.SILENT')
+        with self.state.lock:
+            for number, message in self.resolve(sequence_set, uid):
+                if action.startswith('+'):
+                    message.flags.update(flags)
+                elif action.startswith('-'):
+                    message.flags.difference_update(flags)
+                else:
+                    message.flags = set(flags)
+                message.modseq = self.account.next_modseq()
+                if not silent:
+                    self.send(self.fetch_response(number, message, ['UID', 'FLAGS'], False))
+        self.account.notify()
+
+    def copy(self, args, uid, move=False):
+        sequence_set, destination_name = args[0], args[1]
+        with self.state.lock:
+            destination = self.account.folder(destination_name)
+            if destination is None:
+                return None
+            resolved = self.resolve(sequence_set, uid)
+            source_uids, destination_uids = [], []
+            for _, message in resolved:
+                copied = destination.append(message.raw, message.flags, self.account.next_modseq(),
+                                            message.internaldate)
+                source_uids.append(str(message.uid))
+                destination_uids.append(str(copied.uid))
+            code = f'COPYUID {destination.uidvalidity} {",".join(source_uids)} {",".join(destination_uids)}'
+            if move:
+                self.send_line(f'* OK [{code}] Moved')
+                for number, message in reversed(resolved):
+                    self.selected.messages.remove(message)
+                    self.send_line(f'* {number} EXPUNGE')
+                self.known_exists = len(self.selected.messages)
+        self.account.notify()
+        return code
+
+    def expunge(self, uid_set=None, send=True):
+        with self.state.lock:
+            wanted = {m.uid for _, m in self.resolve(uid_set, uid=True)} if uid_set else None
+            messages = self.selected.messages
+            for i in range(len(messages) - 1, -1, -1):
+                message = messages[i]
+                if '\\Deleted' in message.flags and (wanted is None or message.uid in wanted):
+                    del messages[i]
+                    if send:
+                        self.send_line(f'* {i + 1} EXPUNGE')
+            self.known_exists = len(messages)
+        self.account.notify()
+
+    def append(self, args):
+        name = args[0]
+        flags = []
+        if len(args) > 2 and args[1].startswith('('):
+            flags = args[1].strip('()').split()
+        raw = args[-1].encode('latin-1') if isinstance(args[-1], str) else args[-1]
+        with self.state.lock:
+            folder = self.account.folder(name)
+            message = folder.append(raw, flags, self.account.next_modseq())
+        self.account.notify()
+        return f'APPENDUID {folder.uidvalidity} {message.uid}'
+
+    def send_updates(self):
+        """ Tell the client about new messages in the selected folder """
+        if self.selected is None:
+            return False
+        with self.state.lock:
+            exists = len(self.selected.messages)
+        if exists != self.known_exists:
+            self.known_exists = exists
+            self.send_line(f'* {exists} EXISTS')
+            return True
+        return False
+
+    def idle(self, tag):
+        self.send_line('+ idling')
+        while True:
+            self.send_updates()
+            readable = select.select([self.connection], [], [], 0)[0]
+            if readable:
+                if not self.rfile.readline():  # "DONE" (or the connection was closed)
+                    return
+                break
+            with self.account.changed:
+                self.account.changed.wait(0.2)
+        self.send_line(f'{tag} OK IDLE terminated')
+
+
+def header_fields(header, section_name):
+    """ The lines of the header of HEADER.FIELDS (NAME ...) (with their continuation lines) """
+    names = {name.upper().encode() for name in section_name.split('(', 1)[-1].rstrip(')').split()}
+    lines = []
+    keep = False
+    for line in header.split(b'\r\n'):
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                lines.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().upper() in names
+        if keep:
+            lines.append(line)
+    return b'\r\n'.join(lines + [b'', b''])
+
+
+def tokenize(line):
+    """ Split an IMAP command line into strings (a parenthesized list stays one string) """
+    tokens = []
+    position = 0
+    depth = 0
+    group_start = None
+    if line.endswith(b'\r\n'):
+        line = line[:-2]
+    while position < len(line):
+        match = TOKEN_RE.match(line, position)
+        if not match or match.end() == position:
+            break
+        position = match.end()
+        quoted, literal_length, opening, closing, atom = match.groups()
+        if opening:
+            if depth == 0:
+                group_start = match.start(3)
+            depth += 1
+            continue
+        if closing:
+            depth -= 1
+            if depth == 0:
+                tokens.append(line[group_start:match.end(4)].decode('latin-1'))
+            continue
+        if depth:
+            continue
+        if literal_length is not None:
+            length = int(literal_length)
+            tokens.append(line[position:position + length])
+            position += length
+        elif quoted is not None:
+            tokens.append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+        else:
+            tokens.append(atom.decode('latin-1'))
+    return tokens
+
+
+def make_message(subject='Hello', from_='sender@example.com', to='user@localhost',
+                 text='Hello!', date=None, message_id=None, in_reply_to=None, references=None):
+    """ A simple raw (RFC 5322) message """
+    date = date or datetime.now(timezone.utc)
+    headers = [
+        f'From: {from_}',
+        f'To: {to}',
+        f'Subject: {subject}',
+        f'Date: {format_datetime(date)}',
+        'MIME-Version: 1.0',
+        'Content-Type: text/plain; charset="utf-8"',
+        'Content-Transfer-Encoding: 8bit',
+    ]
+    if message_id:
+        headers.append(f'Message-ID: {message_id}')
+    if in_reply_to:
+        headers.append(f'In-Reply-To: {in_reply_to}')
+    if references:
+        headers.append(f'References: {references}')
+    return ('\r\n'.join(headers) + '\r\n\r\n' + text.replace('\n', '\r\n')).encode('utf-8')
@@ -0,0 +1,196 @@
+"""
+Load test: read throughput of the app (listing a page of the INBOX - `/query_db` get_page)
+with several worker processes sharing one SQLite database, while the sync writes to it.
+
+- the app is served by `workers` pre-forked processes (like gunicorn's sync workers),
+  each one imports app.py by itself (its own connections, sessions, write queue)
+- `N_CLIENTS` client processes send requests as fast as they can, for `duration` seconds
+- at the same time a "sync" process inserts new emails through the app's write queue
+  (a batch of `WRITE_BATCH` emails every `WRITE_INTERVAL` seconds)
+- with --no-wal the database is used with the default journal (the readers wait for the writer)
+
+The throughput can grow with the number of workers only up to the number of CPUs
+(the clients run on the same machine too).
+
+Usage:
+    python benchmarks/load_test.py                   # 1, 2, 4 workers, 5 seconds each
+    python benchmarks/load_test.py 1 8 --duration 20
+    python benchmarks/load_test.py --no-wal
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.sessions import SQLiteSessionStore, serializer
+
+
+N_EMAILS = 20000
+N_CLIENTS = 8
+WRITE_BATCH = 50
+WRITE_INTERVAL = 0.05
+USER = 'user@example.com'
+SESSION_ID = 'load-test-session'
+
+
+def prepare(instance_path, wal):
+    """ Create the database (`flask --app app migrate`), fill it, and store a logged-in session """
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'], cwd=APP_DIR, check=True)
+    connection = sqlite3.connect(os.path.join(instance_path, 'emails.db'))
+    if not wal:
+        connection.execute('PRAGMA journal_mode = DELETE')  # (the app has switched the file to WAL)
+    connection.execute('INSERT INTO user (id, username) VALUES (1, ?)', (USER,))
+    for i, (name, server_name) in enumerate([('inbox', 'INBOX'), ('sent', 'Sent'), ('drafts', 'Drafts')]):
+        connection.execute('INSERT INTO folder (id, owner_id, name, server_name, n_messages, n_unread, total_size) '
+                           'VALUES (?, 1, ?, ?, 0, 0, 0)', (i + 1, name, server_name))
+    start = datetime(2020, 1, 1)
+    connection.executemany(
+        'INSERT INTO email (owner_id, folder_id, uid, date, "from", "to", subject, text, flags, size, body_fetched) '
+        'VALUES (1, 1, ?, ?, ?, ?, ?, NULL, ?, 2000, 0)',
+        ((uid, start + timedelta(minutes=uid), f'sender{uid % 300}@example.com', USER,
+          f'Message number {uid}', '\\Seen' if uid % 3 else '') for uid in range(1, N_EMAILS + 1)))
+    connection.execute('UPDATE folder SET n_messages = ?, total_size = ?, uidnext = ? WHERE id = 1',
+                       (N_EMAILS, 2000 * N_EMAILS, N_EMAILS + 1))
+    connection.commit()
+    connection.close()
+
+    session = {'logged in': True, 'email': USER, 'password': 'not used'}
+    expires_at = time.time() + 3600
+    SQLiteSessionStore(os.path.join(instance_path, 'sessions.db')).set(
+        SESSION_ID, serializer.dumps({'data': session, 'expires_at': expires_at}).encode(), expires_at)
+
+
+def import_app(wal):
+    if not wal:
+        import util.database
+        util.database.set_sqlite_pragmas = lambda dbapi_connection, connection_record: None
+    os.chdir(APP_DIR)
+    import app
+    return app
+
+
+def serve(listener, wal):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # (no line per request)
+    app = import_app(wal)
+    server = make_server('127.0.0.1', listener.getsockname()[1], app.app, fd=listener.fileno())
+    server.serve_forever()
+
+
+def write(wal, stop, counters):
+    """ Insert new emails like the sync does (through the app's write queue) """
+    app = import_app(wal)
+    from util.ingest import insert_emails
+    uid = N_EMAILS + 1
+
+    def insert(first_uid):
+        folder = app.db.session.get(app.Folder, 1)
+        rows = [{'owner_id': 1, 'uid': uid, 'date': datetime(2021, 1, 1) + timedelta(minutes=uid),
+                 'from_': 'sync@example.com', 'to': USER, 'subject': f'New message {uid}',
+                 'flags': '', 'size': 2000, 'body_fetched': False}
+                for uid in range(first_uid, first_uid + WRITE_BATCH)]
+        inserted = insert_emails(app.db, app.Email, folder, rows)
+        rows = [row for row in rows if row['uid'] in inserted]
+        folder.n_messages += len(rows)
+        folder.total_size += sum(row['size'] for row in rows)
+        folder.uidnext = first_uid + WRITE_BATCH
+
+    while not stop.is_set():
+        try:
+            app.write_queue.run(insert, uid)
+            counters['writes'] += 1
+        except Exception as e:
+            counters['write_errors'] += 1
+            print('  write failed:', e)
+        uid += WRITE_BATCH
+        time.sleep(WRITE_INTERVAL)
+
+
+def request(port, deadline, results):
+    """ Client: list the INBOX until the deadline """
+    body = 'command=get_page&folder=inbox&n=10'
+    headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': f'session={SESSION_ID}'}
+    ok = errors = 0
+    while time.monotonic() < deadline:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            connection.request('POST', '/query_db', body, headers)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status == 200 and json.loads(data)['success']:
+                ok += 1
+            else:
+                errors += 1
+        except OSError:
+            errors += 1
+        finally:
+            connection.close()
+    results.put((ok, errors))
+
+
+def run(n_workers, duration, wal):
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as instance_path:
+        os.environ['INSTANCE_PATH'] = instance_path
+        prepare(instance_path, wal)
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        port = listener.getsockname()[1]
+        workers = [context.Process(target=serve, args=(listener, wal), daemon=True) for _ in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        time.sleep(1 + 0.5 * n_workers)  # (the workers import the app)
+
+        manager = context.Manager()
+        counters = manager.dict({'writes': 0, 'write_errors': 0})
+        stop = context.Event()
+        writer = context.Process(target=write, args=(wal, stop, counters), daemon=True)
+        writer.start()
+        time.sleep(1)
+
+        results = context.Queue()
+        deadline = time.monotonic() + duration
+        clients = [context.Process(target=request, args=(port, deadline, results)) for _ in range(N_CLIENTS)]
+        for client in clients:
+            client.start()
+        totals = [results.get() for _ in clients]
+        for client in clients:
+            client.join()
+        stop.set()
+        writer.join(timeout=30)
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        listener.close()
+
+        ok = sum(ok for ok, _ in totals)
+        errors = sum(errors for _, errors in totals)
+        print(f'  {n_workers:>2} workers: {ok / duration:8.0f} requests/s, {errors:5} failed requests, '
+              f'{counters["writes"]} write batches ({counters["write_errors"]} failed)')
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workers', type=int, nargs='*', default=[1, 2, 4])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--no-wal', action='store_true')
+    args = parser.parse_args()
+    print(f'{N_EMAILS} emails, {N_CLIENTS} clients, {os.cpu_count()} CPUs, '
+          f'journal: {"default" if args.no_wal else "WAL"}')
+    for n in args.workers:
+        run(n, args.duration, not args.no_wal)
@@ -0,0 +1,209 @@
+"""
+Synthetic mailboxes: deterministic messages with realistic sizes and MIME structure
+
+Message i of a mailbox is made from (seed, i) only - so a mailbox of 1M messages doesn't have to be
+kept in memory: `fill_standin` gives the IMAP stand-in a function that makes the message when it's
+requested (the attachments are slices of one block of random data - made once, base64-encoded once).
+
+The shape (roughly that of a personal mailbox):
+- text: a log-normal number of words (median 150), from a Zipf-like vocabulary
+- 40% multipart/alternative (+ an HTML version), the rest text/plain
+- 15% with 1-3 attachments (pdf / jpeg / docx / zip), log-normal sizes (median 120 KB, at most 10 MB)
+- 30% replies (In-Reply-To / References to an earlier message, "Re: " subject)
+- 75% in Inbox, 20% in Sent, 5% in Trash; 70% \\Seen, 5% \\Flagged
+
+Usage:
+    mailbox = SyntheticMailbox(100000, user='user@standin.example', seed=0)
+    folder, flags, date = mailbox.envelope(i)
+    raw = mailbox.message(i)
+    fill_standin(imap_standin, mailbox)
+    python benchmarks/mailbox_generator.py 10000    # the sizes of a sample
+"""
+
+import base64
+import functools
+import math
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+
+TOPICS = ('invoice meeting report project budget holiday contract review schedule update '
+          'delivery payment travel launch hiring feedback quarter design release support').split()
+VOCABULARY = TOPICS + [f'w{i}' for i in range(5000)]
+VOCABULARY_WEIGHTS = [1 / (rank + 10) for rank in range(len(VOCABULARY))]
+CORRESPONDENTS = [f'{name}@example.com' for name in
+                  'anna bob carol dmytro eve frank grace olena ivan julia kate leo maria nick oksana petro'.split()]
+FOLDERS = {'Inbox': 0.75, 'Sent': 0.20, 'Trash': 0.05}
+ATTACHMENT_TYPES = [('application/pdf', 'pdf'), ('image/jpeg', 'jpg'), ('application/zip', 'zip'),
+                    ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'docx')]
+
+HTML_RATIO = 0.4
+ATTACHMENT_RATIO = 0.15
+REPLY_RATIO = 0.3
+SEEN_RATIO = 0.7
+FLAGGED_RATIO = 0.05
+MEDIAN_WORDS = 150
+MEDIAN_ATTACHMENT_SIZE = 120 * 1024
+MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
+
+BASE64_LINE = 76  # (characters of a base64 line - 57 bytes of the attachment)
+RANDOM_BLOCK_SIZE = MAX_ATTACHMENT_SIZE + 1024 * 1024
+
+
+@functools.lru_cache(maxsize=1)
+def random_block_base64():
+    """ One block of random data, base64-encoded in lines (the attachments are slices of it) """
+    data = random.Random(0).randbytes(RANDOM_BLOCK_SIZE)
+    return base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+
+def log_normal(rng, median, sigma, maximum):
+    return max(1, min(maximum, int(math.exp(rng.gauss(math.log(median), sigma)))))
+
+
+class SyntheticMailbox:
+    """ The messages of one account (see the module's docstring) """
+
+    def __init__(self, n_messages, user='user@standin.example', seed=0, attachment_ratio=ATTACHMENT_RATIO,
+                 start=datetime(2015, 1, 1, tzinfo=timezone.utc), end=datetime(2025, 1, 1, tzinfo=timezone.utc)):
+        self.n_messages = n_messages
+        self.user = user
+        self.seed = seed
+        self.attachment_ratio = attachment_ratio
+        self.start = start
+        # (the messages are spread evenly from `start` to `end`, in the order of their numbers)
+        self.step = (end - start) / max(n_messages, 1)
+        self._vocabulary_weights = list(_accumulate(VOCABULARY_WEIGHTS))
+        self._folders = list(FOLDERS)
+        self._folder_weights = list(_accumulate(FOLDERS.values()))
+
+    def envelope(self, i):
+        """ (folder, flags, date) of message i - without making the message """
+        rng = self._random(i, 0)
+        folder = rng.choices(self._folders, cum_weights=self._folder_weights)[0]
+        flags = []
+        if folder == 'Sent' or rng.random() < SEEN_RATIO:
+            flags.append('\\Seen')
+        if rng.random() < FLAGGED_RATIO:
+            flags.append('\\Flagged')
+        date = self.start + self.step * i + timedelta(seconds=rng.randrange(60))
+        return folder, tuple(flags), date
+
+    def message(self, i):
+        """ The raw message i (bytes, CRLF line endings) """
+        folder, _, date = self.envelope(i)
+        rng = self._random(i, 1)
+        correspondent = rng.choice(CORRESPONDENTS)
+        from_, to = (self.user, correspondent) if folder == 'Sent' else (correspondent, self.user)
+        headers = [f'From: {from_}',
+                   f'To: {to}',
+                   f'Date: {format_datetime(date)}',
+                   f'Message-ID: {self.message_id(i)}']
+        if i > 0 and rng.random() < REPLY_RATIO:
+            parent = rng.randrange(max(0, i - 500), i)
+            headers += [f'Subject: Re: {self.subject(parent)}',
+                        f'In-Reply-To: {self.message_id(parent)}',
+                        f'References: {self.message_id(parent)}']
+        else:
+            headers.append(f'Subject: {self.subject(i)}')
+        headers.append('MIME-Version: 1.0')
+
+        text = self._text(rng)
+        body = text_part(text)
+        if rng.random() < HTML_RATIO:
+            body = multipart('alternative', [body, html_part(text)], f'alt{i}')
+        if rng.random() < self.attachment_ratio:
+            attachments = [self._attachment(rng, i, j) for j in range(rng.randint(1, 3))]
+            body = multipart('mixed', [body] + attachments, f'mixed{i}')
+        return '\r\n'.join(headers).encode() + b'\r\n' + body
+
+    def subject(self, i):
+        rng = self._random(i, 2)
+        return ' '.join(rng.choices(VOCABULARY[:200], k=rng.randint(2, 6))).capitalize()
+
+    def message_id(self, i):
+        return f'<{i}.{self.seed}@synthetic.example>'
+
+    def sizes(self, sample):
+        """ The sizes of `sample` messages, spread over the mailbox """
+        step = max(1, self.n_messages // sample)
+        return [len(self.message(i)) for i in range(0, self.n_messages, step)[:sample]]
+
+    def _random(self, i, stream):
+        return random.Random((self.seed * 4 + stream) * 100_000_007 + i)
+
+    def _text(self, rng):
+        words = rng.choices(VOCABULARY, cum_weights=self._vocabulary_weights,
+                            k=log_normal(rng, MEDIAN_WORDS, 0.9, 20000))
+        lines = [' '.join(words[j:j + 12]) for j in range(0, len(words), 12)]
+        return 'Hi,\r\n\r\n' + '\r\n'.join(lines) + '\r\n\r\n--\r\nBest regards\r\n'
+
+    def _attachment(self, rng, i, j):
+        content_type, extension = rng.choice(ATTACHMENT_TYPES)
+        size = log_normal(rng, MEDIAN_ATTACHMENT_SIZE, 1.2, MAX_ATTACHMENT_SIZE)
+        block = random_block_base64()
+        line = BASE64_LINE + 2
+        n_lines = -(-size // 57)
+        first = rng.randrange(len(block) // line - n_lines)
+        return (f'Content-Type: {content_type}; name="file{i}_{j}.{extension}"\r\n'
+                f'Content-Disposition: attachment; filename="file{i}_{j}.{extension}"\r\n'
+                'Content-Transfer-Encoding: base64\r\n\r\n').encode() + block[first * line:(first + n_lines) * line]
+
+
+def text_part(text):
+    return ('Content-Type: text/plain; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: 7bit\r\n\r\n' + text).encode()
+
+
+def html_part(text):
+    paragraphs = ''.join(f'<p style="margin:0 0 12px 0;font-family:Arial,sans-serif">{paragraph}</p>\r\n'
+                         for paragraph in text.split('\r\n\r\n'))
+    return ('Content-Type: text/html; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: 7bit\r\n\r\n'
+            f'<html><body>\r\n{paragraphs}</body></html>\r\n').encode()
+
+
+def multipart(subtype, parts, boundary):
+    body = f'Content-Type: multipart/{subtype}; boundary="{boundary}"\r\n\r\n'.encode()
+    for part in parts:
+        body += f'--{boundary}\r\n'.encode() + part + b'\r\n'
+    return body + f'--{boundary}--\r\n'.encode()
+
+
+def fill_standin(standin, mailbox, lazy=True):
+    """
+    Put the messages of the mailbox into the IMAP stand-in (`IMAPStandIn`).
+    lazy - the stand-in keeps only their envelopes, a message is made every time it's requested
+    """
+    for i in range(mailbox.n_messages):
+        folder, flags, date = mailbox.envelope(i)
+        raw = functools.partial(mailbox.message, i) if lazy else mailbox.message(i)
+        standin.add_message(mailbox.user, folder, raw, flags=flags, internaldate=date)
+
+
+def _accumulate(weights):
+    total = 0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    mailbox = SyntheticMailbox(n)
+    sizes = mailbox.sizes(min(n, 2000))
+    folders = {}
+    for i in range(n):
+        folder = mailbox.envelope(i)[0]
+        folders[folder] = folders.get(folder, 0) + 1
+    print(f'{n} messages: {folders}')
+    print(f'  sizes of {len(sizes)}: median {percentile(sizes, 0.5) / 1024:.1f} KB, '
+          f'p95 {percentile(sizes, 0.95) / 1024:.1f} KB, max {max(sizes) / 1024:.1f} KB, '
+          f'mean {sum(sizes) / len(sizes) / 1024:.1f} KB -> the whole mailbox ~{sum(sizes) / len(sizes) * n / 2**20:.0f} MB')
@@ -0,0 +1,192 @@
+"""
+A small in-process SMTP server (a stand-in for smtp.gmail.com / smtp.ukr.net)
+
+It accepts what `smtplib` sends: EHLO/HELO, AUTH (PLAIN, LOGIN), MAIL, RCPT, DATA, RSET, NOOP, QUIT
+(no TLS). The messages are counted, the last `keep` of them are kept, and - if an IMAP stand-in is given -
+the ones to its accounts are delivered into their Inbox.
+
+Usage:
+    server = SMTPStandIn(latency=0.005, imap=imap_standin)  # seconds before every reply
+    server.start()  # runs in a background thread, on server.port
+    ...
+    server.messages  # [(sender, recipients, raw bytes), ...]
+    server.stop()
+"""
+
+import base64
+import socketserver
+import threading
+import time
+from collections import deque
+
+
+class SMTPStandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class SMTPStandIn:
+    """ The server (the received messages + a threading TCP server) """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, password=None, imap=None, keep=1000):
+        self.host = host
+        self.port = port
+        self.latency = latency  # seconds: every reply is sent that much after its command
+        self.password = password  # if None - any password is accepted
+        self.imap = imap  # (`IMAPStandIn`) the messages to its accounts are delivered there
+        self.messages = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.counters = {'connections': 0, 'messages': 0, 'bytes_received': 0}
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        standin = self
+
+        class Handler(SMTPHandler):
+            server_state = standin
+
+        self._server = SMTPStandInServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def receive(self, sender, recipients, raw):
+        with self.lock:
+            self.counters['messages'] += 1
+            self.counters['bytes_received'] += len(raw)
+            self.messages.append((sender, recipients, raw))
+        if self.imap is not None:
+            for recipient in recipients:
+                if recipient in self.imap.accounts:
+                    self.imap.add_message(recipient, 'Inbox', raw)
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    server_state = None  # (`SMTPStandIn`, set by `SMTPStandIn.start`)
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        state = self.server_state
+        with state.lock:
+            state.counters['connections'] += 1
+        self.user = None
+        self.reset()
+        self.reply('220 SMTP stand-in ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8', errors='replace').rstrip('\r\n').partition(' ')
+            command = command.upper()
+            if command == 'EHLO':
+                self.reply('250-stand-in', '250-AUTH PLAIN LOGIN', '250-8BITMIME', '250 SIZE 52428800')
+            elif command == 'HELO':
+                self.reply('250 stand-in')
+            elif command == 'AUTH':
+                self.authenticate(argument)
+            elif command == 'MAIL':
+                if self.user is None:
+                    self.reply('530 Authentication required')
+                    continue
+                self.reset()
+                self.sender = address(argument)
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                if self.sender is None:
+                    self.reply('503 MAIL first')
+                    continue
+                self.recipients.append(address(argument))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                if not self.recipients:
+                    self.reply('503 RCPT first')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                raw = self.read_data()
+                if raw is None:
+                    return
+                state.receive(self.sender, self.recipients, raw)
+                self.reset()
+                self.reply('250 OK: queued')
+            elif command == 'RSET':
+                self.reset()
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+
+    def reply(self, *lines):
+        if self.server_state.latency:
+            time.sleep(self.server_state.latency)
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+        self.wfile.flush()
+
+    def authenticate(self, argument):
+        mechanism, _, initial = argument.partition(' ')
+        mechanism = mechanism.upper()
+        if mechanism == 'PLAIN':
+            if not initial:
+                self.reply('334 ')
+                initial = self.rfile.readline().strip().decode()
+            _, user, password = decode(initial).split('\0', 2)
+        elif mechanism == 'LOGIN':
+            if initial:
+                user = decode(initial)
+            else:
+                self.reply('334 VXNlcm5hbWU6')
+                user = decode(self.rfile.readline().strip().decode())
+            self.reply('334 UGFzc3dvcmQ6')
+            password = decode(self.rfile.readline().strip().decode())
+        else:
+            self.reply('504 Unrecognized authentication type')
+            return
+        expected = self.server_state.password
+        if expected is not None and password != expected:
+            self.reply('535 Authentication credentials invalid')
+            return
+        self.user = user
+        self.reply('235 Authentication successful')
+
+    def read_data(self):
+        """ The message after DATA (until the line with a single dot), with the dots unstuffed """
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line in (b'.\r\n', b'.\n'):
+                return b''.join(lines)
+            lines.append(line[1:] if line.startswith(b'..') else line)
+
+
+def address(argument):
+    """ 'FROM:<a@b.c> SIZE=100' -> 'a@b.c' """
+    value = argument.partition(':')[2].strip()
+    return value[1:value.find('>')] if value.startswith('<') else value.split()[0]
+
+
+def decode(value):
+    return base64.b64decode(value).decode('utf-8', errors='replace')
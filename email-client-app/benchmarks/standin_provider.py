@@ -0,0 +1,32 @@
+"""
+The accounts @standin.example - served by the local stand-ins (imap_standin.py, smtp_standin.py) on 127.0.0.1,
+without TLS. Only the benchmarks add this provider (to the tables of util/configs.py, at run time):
+the configuration of the app has only the real providers.
+
+Usage:
+    register(imap_port, smtp_port)  # (before the first login)
+"""
+
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util import configs
+
+
+PROVIDER = 'standin.example'
+
+
+def register(imap_port, smtp_port):
+    """ Serve the accounts @standin.example by the stand-ins listening on these ports """
+    configs.IMAP_CONFIGS[PROVIDER] = dict(MAIL_SERVER='127.0.0.1',
+                                          MAIL_PORT=imap_port,
+                                          MAIL_USE_TLS=False,
+                                          MAIL_USE_SSL=False)
+    configs.SMTP_CONFIGS[PROVIDER] = dict(MAIL_SERVER='127.0.0.1',
+                                          MAIL_PORT=smtp_port,
+                                          MAIL_USE_TLS=False,
+                                          MAIL_USE_SSL=False)
+    if PROVIDER not in configs.SUPPORTED_EMAIL_PROVIDERS:
+        configs.SUPPORTED_EMAIL_PROVIDERS.append(PROVIDER)
@@ -0,0 +1,143 @@
+"""
+Startup benchmark: the cold start of a worker process (what every restart and every new worker costs).
+
+Each run is a new Python process (nothing cached in memory - only the .pyc files on disk), in an instance
+folder with a migrated database (`flask --app app migrate`, done once before the runs):
+- import        `python -X importtime -c 'import app'` - the import of the app with everything it imports
+- body          the part of it that is the module itself (building the app and its objects, not the imports)
+- create_app    `app.create_app()` - the startup (the secret key, the check of the schema)
+- first         the first request after it (GET /login - renders the form, opens the session)
+- total         the whole process, without -X importtime (the start and the exit of the interpreter included)
+
+And the modules that cost the most to import (the median of the runs, with everything they import),
+so an import that has become expensive is easy to find.
+
+--history FILE - append the results (with the git commit) to a JSON-lines file, and compare them
+with the last run there with the same parameters (like suite.py).
+
+Usage:
+    python benchmarks/startup.py                  # 10 runs
+    python benchmarks/startup.py --runs 30 --top 25 --history benchmarks/startup_history.jsonl
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from suite import APP_DIR, git_commit, save_history
+
+
+# (run in the new process: prints the times of the steps, in seconds)
+STARTUP_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+response = app.app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+responded = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported, 'first': responded - created}))
+'''
+STEPS = ('import', 'body', 'create_app', 'first', 'total')
+
+
+def parse_importtime(output):
+    """ The lines of `-X importtime` -> [(module, self microseconds, cumulative microseconds, depth), ...] """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        if not own.strip().isdigit():
+            continue  # (the header line)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(own), int(cumulative), depth))
+    return modules
+
+
+def direct_imports(modules, parent):
+    """ {module: cumulative ms} of the modules imported by `parent` itself (they are listed right before it) """
+    children = {}
+    for name, _, cumulative, depth in modules:
+        if depth == 0:
+            if name == parent:
+                return children
+            children = {}
+        elif depth == 1:
+            children[name] = cumulative / 1000
+    return {}
+
+
+def run_once(environment):
+    """ One cold start: (the times of the steps in ms, {module imported by app: cumulative ms}) """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT], cwd=APP_DIR,
+                             env=environment, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f'The startup failed:\n{process.stderr[-2000:]}')
+    steps = {name: seconds * 1000 for name, seconds in json.loads(process.stdout.splitlines()[-1]).items()}
+    modules = parse_importtime(process.stderr)
+    steps['body'] = next(own for name, own, _, depth in modules if name == 'app' and depth == 0) / 1000
+    # (the modules imported by `app` itself - the ones its imports can be changed at)
+    return steps, direct_imports(modules, 'app')
+
+
+def wall_clock(environment):
+    """ ms from the start of the process to its end (the same steps, not slowed down by -X importtime) """
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=APP_DIR, env=environment, check=True,
+                   capture_output=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def compare(previous, results):
+    """ The changes since the `previous` run: {step: '+3.1%'} """
+    return {step: f'{(ms / previous["results"][step] - 1) * 100:+.1f}%'
+            for step, ms in results.items() if previous['results'].get(step)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15, help='the number of the most expensive imports shown')
+    parser.add_argument('--history', help='JSON-lines file of the results')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as instance_path:
+        environment = dict(os.environ, INSTANCE_PATH=instance_path)
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'], cwd=APP_DIR, env=environment,
+                       check=True, capture_output=True)
+        run_once(environment)  # (writes the .pyc files - the runs measure the start of an installed app)
+        runs = [run_once(environment) for _ in range(args.runs)]
+        totals = [wall_clock(environment) for _ in range(args.runs)]
+
+    results = {step: statistics.median(steps[step] for steps, _ in runs) for step in STEPS if step != 'total'}
+    results['total'] = statistics.median(totals)
+    modules = {}
+    for _, imported in runs:
+        for name, ms in imported.items():
+            modules.setdefault(name, []).append(ms)
+    top = sorted(((statistics.median(times), name) for name, times in modules.items()), reverse=True)[:args.top]
+
+    print(f'{args.runs} runs (median), Python {sys.version.split()[0]}')
+    for step in STEPS:
+        print(f'{step:>10}: {results[step]:8.1f} ms')
+    print('the most expensive imports of app (with what they import):')
+    for ms, name in top:
+        print(f'{ms:8.1f} ms  {name}')
+    if args.history:
+        record = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+                  'params': {'python': sys.version.split()[0]},
+                  'results': results, 'imports': {name: ms for ms, name in top}}
+        previous = save_history(args.history, record)
+        if previous is not None:
+            print(f'compared with {previous["commit"]} ({previous["date"]}):')
+            for step, change in compare(previous, results).items():
+                print(f'{step:>10}: {change}')
@@ -0,0 +1,296 @@
+"""
+Benchmark suite: the hot paths of the app, against local stand-ins of the mail servers.
+
+The IMAP stand-in (imap_standin.py) and the SMTP stand-in (smtp_standin.py) run in a child process
+with a synthetic mailbox (mailbox_generator.py) of `messages` messages, and a network delay (--latency).
+The app is imported with a new instance folder, and the accounts @standin.example are served by the stand-ins
+(standin_provider.py),
+and its routes are called with the Flask test client (the whole request - without the HTTP server).
+
+Scenarios (--only to choose some of them):
+- login     POST /login (a new IMAP connection + LOGIN), then /logout
+- ingest    after a login: the first sync, and the import of the whole mailbox (util/importer.py)
+- folders   the folder list from the server (LIST), and the update of the `Folder` rows
+- page      POST /query_db get_page - the pages of the INBOX, one after another
+- message   POST /query_the_server get_message - messages opened for the first time (the body from the server)
+- search    POST /query_db search
+- send      POST /send_email, until the SMTP stand-in has received all the messages
+
+For each one: the latency percentiles of its calls (p50 / p90 / p99), its throughput,
+and the peak RSS of the process after it (ru_maxrss - so it includes all the scenarios before it).
+
+--history FILE - append the results (with the git commit) to a JSON-lines file, and compare them
+with the last run there with the same parameters (to follow them from commit to commit).
+
+Usage:
+    python benchmarks/suite.py                     # 10000 messages, no latency, all the scenarios
+    python benchmarks/suite.py 100000 --latency 0.02 --only login,page,search
+    python benchmarks/suite.py --bodies --history benchmarks/history.jsonl
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from imap_standin import IMAPStandIn
+from mailbox_generator import TOPICS, CORRESPONDENTS, SyntheticMailbox, fill_standin, percentile
+from smtp_standin import SMTPStandIn
+import standin_provider
+
+
+USER = 'user@standin.example'
+PASSWORD = 'password'
+SCENARIOS = ('login', 'ingest', 'folders', 'page', 'message', 'search', 'send')
+CALLS = {'login': 20, 'folders': 20, 'page': 200, 'message': 30, 'search': 50, 'send': 30}
+SEARCH_QUERIES = ['invoice', 'budget review', 'proj', 'w17', 'contract payment quarter', 'nonexistentword']
+INGEST_TIMEOUT = 3600  # seconds
+
+
+def serve(n_messages, latency, connection):
+    """
+    The stand-ins (in a child process): fill the mailbox, and serve it until killed.
+    ('counters',) from the benchmark (through `connection`) - the counters of both stand-ins
+    """
+    imap = IMAPStandIn(latency=latency, password=PASSWORD)
+    fill_standin(imap, SyntheticMailbox(n_messages, user=USER))
+    smtp = SMTPStandIn(latency=latency, password=PASSWORD, imap=imap)
+    imap.start()
+    smtp.start()
+    connection.send((imap.port, smtp.port))
+    while True:
+        command = connection.recv()
+        if command[0] == 'counters':
+            connection.send({'imap': dict(imap.counters), 'smtp': dict(smtp.counters)})
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # (KB on Linux)
+
+
+def measure(calls, function):
+    """ Call `function(i)` for i in range(calls). Returns (latencies in ms, seconds in all) """
+    latencies = []
+    started = time.perf_counter()
+    for i in range(calls):
+        t0 = time.perf_counter()
+        function(i)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return latencies, time.perf_counter() - started
+
+
+def summary(latencies, seconds, n=None, unit='calls/s'):
+    """ The result of a scenario (n - what was done, for the throughput: calls by default) """
+    n = len(latencies) if n is None else n
+    return {'calls': len(latencies),
+            'p50_ms': round(percentile(latencies, 0.5), 3),
+            'p90_ms': round(percentile(latencies, 0.9), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'throughput': round(n / seconds, 1),
+            'unit': unit,
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def post(client, url, data):
+    response = client.post(url, data=data)
+    if response.status_code >= 400:
+        raise RuntimeError(f'{url} {data}: HTTP {response.status_code}')
+    return response.get_json(silent=True)
+
+
+class Suite:
+    def __init__(self, app, connection, calls):
+        self.app = app
+        self.connection = connection  # (to the child process with the stand-ins)
+        self.calls = calls
+        self.client = app.app.test_client()
+
+    def login(self):
+        def login_and_out(i):
+            client = self.app.app.test_client()
+            response = client.post('/login', data={'email': USER, 'password': PASSWORD})
+            if response.status_code != 302 or not response.location.endswith('/'):
+                raise RuntimeError(f'Login failed: {response.status_code} {response.location}')
+            client.get('/logout')
+        return summary(*measure(self.calls['login'], login_and_out))
+
+    def ingest(self):
+        started = time.perf_counter()
+        self.client.post('/login', data={'email': USER, 'password': PASSWORD})
+        progress = {}
+        while time.perf_counter() - started < INGEST_TIMEOUT:
+            progress = post(self.client, '/query_db', {'command': 'import_status'})['data']
+            if progress.get('state') in ('done', 'failed'):
+                break
+            time.sleep(0.1)
+        seconds = time.perf_counter() - started
+        if progress.get('state') != 'done':
+            raise RuntimeError(f'The import has not finished: {progress}')
+        with self.app.app.app_context():
+            stored = self.app.db.session.scalar(self.app.db.select(self.app.db.func.count(self.app.Email.email_id)))
+        return summary([seconds * 1000], seconds, n=stored, unit='messages/s')
+
+    def folders(self):
+        app = self.app
+        with app.app.app_context(), app.mailbox_pool.connection(USER, PASSWORD) as mailbox:
+            owner = app.db.session.execute(app.db.select(app.User).where(app.User.username == USER)).scalar_one()
+
+            def list_folders(i):
+                app.folder_cache.invalidate(owner)
+                app.folder_cache.get(owner, mailbox)
+            return summary(*measure(self.calls['folders'], list_folders))
+
+    def page(self):
+        cursor = [None]
+
+        def next_page(i):
+            data = post(self.client, '/query_db', {'command': 'get_page', 'folder': 'inbox', 'n': 50,
+                                                   'cursor': cursor[0] or ''})['data']
+            cursor[0] = data['next_cursor']
+        return summary(*measure(self.calls['page'], next_page))
+
+    def message(self):
+        app = self.app
+        with app.app.app_context():
+            uids = list(app.db.session.scalars(
+                app.db.select(app.Email.uid).join(app.Email.folder)
+                .where(app.Folder.name == 'inbox').where(app.Email.body_fetched.is_(False))
+                .order_by(app.Email.date.desc()).limit(self.calls['message'])))
+
+        def open_message(i):
+            response = post(self.client, '/query_the_server', {'command': 'get_message', 'folder': 'inbox',
+                                                               'uid': uids[i]})
+            if not response['success']:
+                raise RuntimeError(f'get_message {uids[i]}: {response}')
+        return summary(*measure(len(uids), open_message))
+
+    def search(self):
+        def search(i):
+            post(self.client, '/query_db', {'command': 'search', 'query': SEARCH_QUERIES[i % len(SEARCH_QUERIES)]})
+        return summary(*measure(self.calls['search'], search))
+
+    def send(self):
+        before = self.counters()['smtp']['messages']
+
+        def send(i):
+            response = post(self.client, '/send_email', {'to': CORRESPONDENTS[i % len(CORRESPONDENTS)],
+                                                         'subject': f'Benchmark {i}',
+                                                         'text': ' '.join(TOPICS) * 20})
+            if not response['success']:
+                raise RuntimeError(f'send_email: {response}')
+        started = time.perf_counter()
+        latencies, _ = measure(self.calls['send'], send)
+        # (the requests only put the messages into the outbox - they are sent in the background)
+        while self.counters()['smtp']['messages'] - before < len(latencies):
+            if time.perf_counter() - started > 60:
+                raise RuntimeError(f'Not sent in 60 s: {self.app.outbox_sender.stats()}')
+            time.sleep(0.05)
+        return summary(latencies, time.perf_counter() - started, unit='sent/s')
+
+    def counters(self):
+        self.connection.send(('counters',))
+        return self.connection.recv()
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=APP_DIR,
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def compare(previous, results):
+    """ The changes since the `previous` run: {scenario: 'p50 +3.1%, throughput -2.0%'} """
+    changes = {}
+    for scenario, result in results.items():
+        old = previous['results'].get(scenario)
+        if not old:
+            continue
+        p50 = (result['p50_ms'] / old['p50_ms'] - 1) * 100 if old['p50_ms'] else 0
+        throughput = (result['throughput'] / old['throughput'] - 1) * 100 if old['throughput'] else 0
+        changes[scenario] = f'p50 {p50:+.1f}%, throughput {throughput:+.1f}%'
+    return changes
+
+
+def save_history(path, record):
+    """ Append the run, and return the last earlier run with the same parameters (None if there is none) """
+    previous = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                earlier = json.loads(line)
+                if earlier['params'] == record['params']:
+                    previous = earlier
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return previous
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('messages', type=int, nargs='?', default=10000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per round trip')
+    parser.add_argument('--bodies', action='store_true', help='import the whole messages (IMPORT_BODIES=1)')
+    parser.add_argument('--only', default=','.join(SCENARIOS), help='comma-separated scenarios')
+    parser.add_argument('--history', help='JSON-lines file of the results')
+    args = parser.parse_args()
+    scenarios = [name for name in SCENARIOS if name in args.only.split(',')]
+    if 'ingest' not in scenarios and set(scenarios) - {'login'}:
+        scenarios.insert(scenarios.index('login') + 1 if 'login' in scenarios else 0, 'ingest')  # (the others need it)
+
+    context = multiprocessing.get_context('fork')
+    connection, child_connection = context.Pipe()
+    server = context.Process(target=serve, args=(args.messages, args.latency, child_connection), daemon=True)
+    server.start()
+    imap_port, smtp_port = connection.recv()
+
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as instance_path:
+            os.environ.update(INSTANCE_PATH=instance_path, IMPORT_BODIES='1' if args.bodies else '0')
+            standin_provider.register(imap_port, smtp_port)
+            os.chdir(APP_DIR)
+            import app
+            from util.migrations import upgrade_schema
+            with app.app.app_context():
+                upgrade_schema(app.db)  # (`flask --app app migrate`)
+            app.app.config['WTF_CSRF_ENABLED'] = False
+            suite = Suite(app, connection, CALLS)
+            for name in scenarios:
+                results[name] = getattr(suite, name)()
+                print(f'{name:>8}: {json.dumps(results[name])}', flush=True)
+            stand_in_counters = suite.counters()
+            # (stopped before the stand-ins - the background threads would fail on the closed connections)
+            app.outbox_sender.stop()
+            app.sync_scheduler.stop()
+            app.mailbox_importer.stop(USER)
+    finally:
+        server.terminate()
+
+    print(f'{args.messages} messages, {args.latency * 1000:.0f} ms per round trip, '
+          f'{"whole messages" if args.bodies else "headers"} imported; stand-ins: {stand_in_counters}')
+    print(f'{"":>8}  {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"throughput":>18} {"peak RSS MB":>12}')
+    for name, result in results.items():
+        print(f'{name:>8}: {result["p50_ms"]:9.2f} {result["p90_ms"]:9.2f} {result["p99_ms"]:9.2f} '
+              f'{result["throughput"]:9.1f} {result["unit"]:<8} {result["peak_rss_mb"]:12.1f}')
+    if args.history:
+        record = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+                  'params': {'messages': args.messages, 'latency': args.latency, 'bodies': args.bodies},
+                  'results': results}
+        previous = save_history(args.history, record)
+        if previous is not None:
+            print(f'compared with {previous["commit"]} ({previous["date"]}):')
+            for name, change in compare(previous, results).items():
+                print(f'{name:>8}: {change}')
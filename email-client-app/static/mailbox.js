@@ -180,7 +180,34 @@ function render_user_folders(user_folders, folder) {
 }
 
 
-function create_render_msg_func(msg) {
+function render_attachments(attachments) {
+  // List of links to download the attachments of the message:
+  let ul = document.createElement('ul')
+  ul.classList.add('pt-3')
+  for (let attachment of attachments) {
+    let li = document.createElement('li')
+    let a = document.createElement('a')
+    a.href = '/attachment/' + attachment.attachment_id
+    a.innerText = attachment.filename
+    li.appendChild(a)
+    ul.appendChild(li)
+  }
+  return ul
+}
+
+
+function render_html_body(html) {
+  // The HTML part of the message - in a sandboxed frame (its scripts don't run, and it can't reach the page):
+  let iframe = document.createElement('iframe')
+  iframe.setAttribute('sandbox', '')
+  iframe.classList.add('w-100', 'border-0', 'pt-3')
+  iframe.style.minHeight = '60vh'
+  iframe.srcdoc = html
+  return iframe
+}
+
+
+function create_render_msg_func(msg, folder) {
   // When an email message is selected - this function will be called:
   // (for each email message - a unique function)
   function render_msg() {
@@ -194,7 +221,6 @@ function create_render_msg_func(msg) {
     let from_ = msg.from_
     let to = msg.to
     let subject = msg.subject
-    let text = msg.text
 
     let container = document.createElement('div')
     container.classList.add('pt-3', 'pb-4')
@@ -219,25 +245,78 @@ function create_render_msg_func(msg) {
     info2.appendChild(p2)
     info2.appendChild(h3)
 
+    // The body is not in the list - it's requested only when the message is opened:
     let email_text = document.createElement('div')
-    email_text.classList.add('pt-4')
-    email_text.innerText = text
+    email_text.classList.add('pt-4', 'text-muted')
+    email_text.innerText = 'Loading...'
     
     container.appendChild(info1)
     container.appendChild(info2)
     container.appendChild(email_text)
 
     $("main").html(container)
+
+    let key = folder + '/' + uid
+    let cached = message_cache.get(key)
+    $.ajax({
+      url: "/query_the_server",
+      method: 'POST',
+      data: {
+        command: 'get_message',
+        folder: folder,
+        uid: uid,
+      },
+      // (the message doesn't change - if it's in the cache, the server answers with an empty 304)
+      headers: cached ? {'If-None-Match': cached.etag} : {},
+      success: function(data, status, xhr) {
+        if (xhr.status === 304) {
+          data = {success: true, data: cached.data}
+        } else if (data.success && xhr.getResponseHeader('ETag')) {
+          remember(message_cache, key, {etag: xhr.getResponseHeader('ETag'), data: data.data}, MESSAGE_CACHE_SIZE)
+        }
+        if (!data.success) {
+          email_text.innerText = 'Could not load the message: ' + data.error
+          return
+        }
+        email_text.classList.remove('text-muted')
+        if (data.data.html) {
+          email_text.replaceWith(render_html_body(data.data.html))
+        } else {
+          email_text.innerText = data.data.text
+        }
+        if (data.data.attachments.length > 0) {
+          container.appendChild(render_attachments(data.data.attachments))
+        }
+      },
+    });
   }
   return render_msg
 }
 
 
+// Show the number of unread messages next to each folder in the sidebar
+// (folders: {name: {total, unread, size}} - counters kept by the server, not counted per request):
+function render_folder_counters(folders) {
+  $('a.folder').each(function() {
+    let name = decodeURIComponent(this.hash.slice(1).split('/')[0])
+    $(this).find('.folder-counter').remove()
+    let counters = folders[name]
+    if (counters && counters.unread > 0) {
+      let badge = document.createElement('span')
+      badge.classList.add('folder-counter', 'badge', 'rounded-pill', 'bg-secondary', 'ms-1')
+      badge.innerText = counters.unread
+      badge.title = counters.total + ' messages, ' + (counters.size / 1048576).toFixed(1) + ' MB'
+      this.appendChild(badge)
+    }
+  })
+}
+
+
 function create_msg_list_item(msg, folder, page) {
   let uid = msg.uid
   let date = new Date(msg.date)
   let subject = msg.subject
-  let text = msg.text
+  let from_ = msg.from_
 
   let a = document.createElement('a')
   a.href = '#' + folder + '/' + page + '/show/' + uid  
@@ -251,29 +330,138 @@ function create_msg_list_item(msg, folder, page) {
   a_inner += '  <strong class="col-9 mb-1 line-clamp-1">' + subject + '</strong>'
   a_inner += '  <small>' + date.toLocaleDateString().replace(/\//g, '.') + '</small>'
   a_inner += '</div>'
-  a_inner += '<div class="mb-1 small line-clamp-2">' + text + '</div>'
+  a_inner += '<div class="mb-1 small line-clamp-2">' + from_ + '</div>'
   a.innerHTML = a_inner
 
-  render_msg = create_render_msg_func(msg)
+  render_msg = create_render_msg_func(msg, folder)
   a.onclick = render_msg
   return a
 }
 
 
-function render_msg_list(msg_infos, folder, page) {
+// Cursors of the pages that were already seen: page_cursors[key][i] is the
+// cursor to request the page i with (the server pages by (date, uid), not by offset).
+// (the key: the folder, and whether its messages are grouped into conversations - their pages are different)
+var page_cursors = {}
+
+// A row per conversation (thread) in the list, instead of a row per message (remembered in the browser):
+var group_threads = localStorage.getItem('group_threads') === '1'
+
+
+function cursors_key(folder) {
+  return group_threads ? folder + '/threads' : folder
+}
+
+
+function remember_next_cursor(folder, page, next_cursor) {
+  let i = parseInt(page.slice(1))
+  let key = cursors_key(folder)
+  if (!(key in page_cursors)) {
+    page_cursors[key] = [null]
+  }
+  page_cursors[key][i + 1] = next_cursor
+}
+
+
+// The number of messages of a conversation (a badge) - on click, its messages are shown below it:
+function add_thread_badge(a, msg, page) {
+  if (msg.thread_n_messages < 2) {
+    return
+  }
+  let badge = document.createElement('span')
+  badge.classList.add('thread-counter', 'badge', 'rounded-pill', 'ms-1',
+                      msg.n_unread > 0 ? 'bg-primary' : 'bg-secondary')
+  badge.innerText = msg.thread_n_messages
+  badge.title = msg.n_messages + ' in this folder, ' + msg.thread_n_unread + ' unread'
+  badge.onclick = function(event) {
+    event.preventDefault()
+    event.stopPropagation()
+    toggle_thread(a, msg.thread_id, page)
+  }
+  a.querySelector('strong').after(badge)
+}
+
+
+function toggle_thread(a, thread_id, page) {
+  let shown = a.nextElementSibling
+  if (shown !== null && shown.classList.contains('thread-messages')) {
+    shown.remove()
+    return
+  }
+  $.post("/query_db", {command: 'get_thread', thread_id: thread_id}, function(data, status) {
+    if (!data.success) {
+      console.log('error: ' + data.error)
+      return
+    }
+    let container = document.createElement('div')
+    container.classList.add('thread-messages', 'list-group', 'list-group-flush')
+    for (let msg of data.data.msg_infos) {
+      let item = create_msg_list_item(msg, msg.folder, page)
+      item.style.paddingLeft = (1.5 + msg.depth) + 'rem'  // (a reply is indented below its parent)
+      if (msg.unread) {
+        item.classList.add('fw-semibold')
+      }
+      container.appendChild(item)
+    }
+    a.after(container)
+  })
+}
+
+
+function create_page_link(text, folder, i, enabled) {
+  let a = document.createElement('a')
+  a.classList.add('small', 'px-2')
+  a.innerText = text
+  if (enabled) {
+    a.href = '#' + folder + '/p' + i + '/show'
+  } else {
+    a.classList.add('text-muted', 'pe-none')
+  }
+  return a
+}
+
+
+function render_msg_list(msg_infos, folder, page, total=null, unread=null, next_cursor=null) {
   let msg_list = $('#msg-list')[0]
   msg_list.innerHTML = ''
+  let i = parseInt(page.slice(1))
+  let page_size = 10
 
-  // Add number of messages:
+  // Add number of messages, and links to the newer / older pages:
   let n_msgs = msg_infos.length
+  let info = document.createElement('div')
+  info.classList.add('d-flex', 'justify-content-between', 'px-3', 'mb-1', 'pt-0')
   let info_n_msgs = document.createElement('p')
-  info_n_msgs.classList.add('text-muted', 'small', 'px-3', 'mb-1', 'pt-0')
-  info_n_msgs.innerText = n_msgs + ' messages'
-  msg_list.appendChild(info_n_msgs)
+  info_n_msgs.classList.add('text-muted', 'small', 'mb-0')
+  if (total === null) {
+    info_n_msgs.innerText = n_msgs + ' messages'
+  } else if (n_msgs > 0) {
+    let first = i * page_size + 1
+    info_n_msgs.innerText = first + '-' + (first + n_msgs - 1) + ' of ' + total + ' (' + unread + ' unread)'
+  } else {
+    info_n_msgs.innerText = total + ' messages (' + unread + ' unread)'
+  }
+  let page_links = document.createElement('div')
+  page_links.appendChild(create_page_link('< newer', folder, i - 1, i > 0))
+  page_links.appendChild(create_page_link('older >', folder, i + 1, next_cursor !== null))
+  info.appendChild(info_n_msgs)
+  info.appendChild(page_links)
+  msg_list.appendChild(info)
 
   // Add messages themselves:
   for (let i = 0; i < n_msgs; i++) {
-    msg_list.appendChild(create_msg_list_item(msg_infos[i], folder, page))
+    let a = create_msg_list_item(msg_infos[i], folder, page)
+    if ('thread_id' in msg_infos[i]) {
+      add_thread_badge(a, msg_infos[i], page)
+    }
+    if (msg_infos[i].snippet) {
+      // (the beginning of the body - stored by the server, empty until the message is opened once)
+      let snippet = document.createElement('div')
+      snippet.classList.add('small', 'text-muted', 'line-clamp-1')
+      snippet.innerText = msg_infos[i].snippet
+      a.appendChild(snippet)
+    }
+    msg_list.appendChild(a)
     if (i < n_msgs - 1) {
       let horizontal_divider = document.createElement('div')
       horizontal_divider.classList.add('horizontal-divider')
@@ -283,6 +471,219 @@ function render_msg_list(msg_infos, folder, page) {
 }
 
 
+// The pages and the messages that were shown (with their ETags) - the most recently used ones:
+// - a page is shown from the cache at once, and then checked with the server (If-None-Match):
+//   if it has not changed, the server answers with an empty 304
+// - a message is taken from the cache when the server says it's the same (304)
+var page_cache = new Map()  // folder/page/cursor -> {etag, data}
+var message_cache = new Map()  // folder/uid -> {etag, data}
+const PAGE_CACHE_SIZE = 50
+const MESSAGE_CACHE_SIZE = 20
+
+
+function remember(cache, key, value, max_size) {
+  cache.delete(key)  // (a Map keeps the order of insertion - the most recently used one goes to the end)
+  cache.set(key, value)
+  if (cache.size > max_size) {
+    cache.delete(cache.keys().next().value)
+  }
+}
+
+
+function render_page_data(folder, page, data) {
+  remember_next_cursor(folder, page, data.next_cursor)
+  render_user_folders(data.user_folders, folder)
+  render_folder_counters(data.folders)
+  render_msg_list(data.msg_infos, folder, page, data.total, data.unread, data.next_cursor)
+}
+
+
+// Request a page of messages from the local database (fast, no email server involved):
+function request_page_from_db(folder, page) {
+  let i = parseInt(page.slice(1))
+  let cursors = page_cursors[cursors_key(folder)] || [null]
+  if (i > 0 && !cursors[i]) {
+    // We don't know where this page starts (e.g. the page was reloaded) - go to the first page:
+    window.location.hash = '#' + folder + '/p0/show'
+    return
+  }
+  let key = cursors_key(folder) + '/' + page + '/' + (cursors[i] || '')
+  let cached = page_cache.get(key)
+  if (cached) {
+    render_page_data(folder, page, cached.data)
+  }
+  $.ajax({
+    url: "/query_db",
+    method: 'POST',
+    data: {
+      command: 'get_page',
+      folder: folder,
+      cursor: cursors[i] || '',
+      group: group_threads ? 'threads' : '',
+    },
+    headers: cached ? {'If-None-Match': cached.etag} : {},
+    success: function(data, status, xhr) {
+      if (window.location.hash.split('/').slice(0, 2).join('/') !== '#' + folder + '/' + page) {
+        return  // the user has already gone to another page
+      }
+      if (xhr.status === 304) {
+        remember(page_cache, key, cached, PAGE_CACHE_SIZE)
+        return  // (the page from the cache is already shown)
+      }
+      if (!data.success) {
+        console.log('error: ' + data.error)
+      } else {
+        if (xhr.getResponseHeader('ETag')) {
+          remember(page_cache, key, {etag: xhr.getResponseHeader('ETag'), data: data.data}, PAGE_CACHE_SIZE)
+        }
+        render_page_data(folder, page, data.data)
+      }
+    },
+  });
+}
+
+
+// Ask the server to sync the folder (in the background), and show the page again when it's synced:
+function request_sync(folder, page) {
+  $.post(
+    "/query_db",
+    {
+      command: 'sync_folder',
+      folder: folder,
+    },
+    function(data, status) {
+      if (!data.success) {
+        console.log('error: ' + data.error)
+      } else {
+        wait_for_sync(folder, page, data.data.synced_at, 30)
+      }
+    }
+  );
+}
+
+
+// Check every second (at most n_tries times) whether the folder was synced after `synced_at`:
+function wait_for_sync(folder, page, synced_at, n_tries) {
+  setTimeout(function() {
+    if (window.location.hash.split('/').slice(0, 2).join('/') !== '#' + folder + '/' + page) {
+      return  // the user has already gone to another page
+    }
+    $.post(
+      "/query_db",
+      {
+        command: 'sync_status',
+        folder: folder,
+      },
+      function(data, status) {
+        if (!data.success) {
+          console.log('error: ' + data.error)
+          return
+        }
+        data = data.data
+        if (data.synced_at !== synced_at) {
+          request_page_from_db(folder, page)
+        } else if (data.error && data.pending === 0) {
+          console.log('sync error: ' + data.error)
+        } else if (n_tries > 1) {
+          wait_for_sync(folder, page, synced_at, n_tries - 1)
+        }
+      }
+    );
+  }, 1000)
+}
+
+
+// Changes pushed by the server (new / moved / deleted messages, flag changes) - the current page is shown again:
+function listen_to_events() {
+  let events = new EventSource('/events')
+  function on_folder_changed(event) {
+    let data = JSON.parse(event.data)
+    let parts = window.location.hash.split('/')
+    let folder = parts[0].slice(1)
+    let page = parts[1]
+    if (data.folder === folder && page === 'p0' && !$("#search").val()) {
+      request_page_from_db(folder, page)
+    }
+  }
+  events.addEventListener('new_messages', on_folder_changed)
+  events.addEventListener('flags_changed', on_folder_changed)
+  events.addEventListener('messages_removed', on_folder_changed)
+  events.addEventListener('import_progress', function(event) {
+    let progress = JSON.parse(event.data)
+    render_import_progress(progress)
+    if (progress.folder !== null) {
+      on_folder_changed(event)  // (the counters of the folder have changed)
+    }
+  })
+}
+
+
+// Show how far the import of the older messages is (below the folders):
+function render_import_progress(progress) {
+  let text = ''
+  if (progress !== null && progress.state === 'running') {
+    text = 'Importing older messages: ' + progress.stored + ' of ' + progress.total
+    if (progress.folder !== null) {
+      text += ' (' + progress.folder + ')'
+    }
+  } else if (progress !== null && progress.state === 'failed') {
+    text = 'Import stopped: ' + progress.error
+  }
+  $('#import-progress').text(text)
+}
+
+
+function request_import_status() {
+  $.post("/query_db", {command: 'import_status'}, function(data, status) {
+    if (data.success) {
+      render_import_progress(data.data)
+    }
+  })
+}
+
+
+// Search in the local database (the results are shown instead of the list of the folder):
+function search_emails(query) {
+  $.post(
+    "/query_db",
+    {
+      command: 'search',
+      query: query,
+    },
+    function(data, status) {
+      if ($("#search").val() !== query) {
+        return  // the user has already changed the query
+      }
+      if (!data.success) {
+        console.log('error: ' + data.error)
+        return
+      }
+      let msg_infos = data.data.msg_infos
+      let msg_list = $('#msg-list')[0]
+      msg_list.innerHTML = ''
+      let info = document.createElement('p')
+      info.classList.add('text-muted', 'small', 'px-3', 'mb-1')
+      info.innerText = msg_infos.length + ' found'
+      msg_list.appendChild(info)
+      for (let i = 0; i < msg_infos.length; i++) {
+        let a = create_msg_list_item(msg_infos[i], msg_infos[i].folder, 'p0')
+        let snippet = document.createElement('div')
+        snippet.classList.add('small', 'text-muted', 'line-clamp-2')
+        snippet.innerHTML = msg_infos[i].snippet  // (escaped by the server, only <mark> is added)
+        a.appendChild(snippet)
+        msg_list.appendChild(a)
+      }
+    }
+  );
+}
+
+$("#search").on("keydown", function(event) {
+  if (event.key === "Enter" && $(this).val().trim()) {
+    search_emails($(this).val())
+  }
+})
+
+
 // When send email button is clicked:
 function send_email() {
   let to = $("#write_to").val()
@@ -502,32 +903,14 @@ function update_page_content(path) {
     }
 
     $('#msg-list')[0].innerHTML = ''  // clear the msg-list
-    // AJAX request:
-    $.post(
-      "/query_the_server",
-      {
-        command: 'get_folders_and_n_messages',
-        folder: folder,
-        // page: page  // TODO: add support for pagination
-      },
-
-      function(data, status) {
-        current_folder = window.location.hash.split('/')[0].slice(1)
-        if (current_folder !== folder) {  
-          // if the user has changed the folder
-          return  // don't update the page with the results of this request
-        }
-        if (!data.success) {
-          console.log('error: ' + data.error)
-        } else {
-          data = data.data
-          let user_folders = data.user_folders
-          let msg_infos = data.msg_infos
-          render_user_folders(user_folders, folder)
-          render_msg_list(msg_infos, folder, page)
-        }
-      }
-    );
+    // Show what is already in the local database:
+    request_page_from_db(folder, page)
+    if (page !== 'p0') {
+      return
+    }
+    // .. and (for the first page) also ask for the new messages from the email server
+    // (they are fetched in the background, and the page is updated when that's done):
+    request_sync(folder, page)
   } 
 
   // TODO- when opening saved draft emails - their link should be '...write/draft/uid' (not '...show/uid') )
@@ -585,8 +968,11 @@ function set_default_folder_active() {
 
 
 window.onload = function() {
+  $('#group-threads').prop('checked', group_threads)
   set_default_folder_active()
   render_page()
+  listen_to_events()
+  request_import_status()
 }
 
 window.addEventListener('hashchange', render_page)
@@ -653,6 +1039,20 @@ add_listeners_to_all_folders();
 
 // ---------------------------------------------------------------------
 
+// Group the messages into conversations (or not) - the list starts again from its first page:
+$("#group-threads").change(function() {
+  group_threads = this.checked
+  localStorage.setItem('group_threads', group_threads ? '1' : '0')
+  let folder = window.location.hash.split('/')[0].slice(1)
+  $('#msg-list')[0].innerHTML = ''
+  if (window.location.hash.split('/')[1] === 'p0') {
+    request_page_from_db(folder, 'p0')
+  } else {
+    window.location.hash = '#' + folder + '/p0/show'
+  }
+})
+
+
 // Create new email button:
 $("#create").click(function() {
   let parts = window.location.hash.split('/')
@@ -0,0 +1,113 @@
+"""
+The asyncio sync engine (`util.async_sync.AsyncSyncEngine`), against the IMAP stand-in of the benchmarks:
+the pipelined commands of a connection get their own answers in one round trip,
+and a sync stores the same as `SyncEngine.sync_folder` (the new messages, then the changes).
+
+Usage:
+    python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from flask import Flask
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, 'benchmarks'))
+from imap_standin import IMAPStandIn, make_message
+from util.async_imap import AsyncIMAPClient, first_line, folder_argument, untagged
+from util.async_sync import AsyncSyncEngine
+from util.database import get_models
+from util.folder_cache import FolderMappingCache
+from util.ingest import upsert_folders
+from util.migrations import upgrade_schema
+from util.sync import SyncEngine
+
+USER = 'user@localhost'
+LATENCY = 0.1  # seconds per round trip
+FOLDER_MAPPING = {'inbox': 'Inbox', 'sent': 'Sent', 'drafts': 'Drafts', 'bin': 'Trash'}
+
+
+@pytest.fixture
+def standin():
+    standin = IMAPStandIn(latency=LATENCY)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(12):
+        standin.add_message(USER, 'Sent' if i % 4 == 0 else 'Inbox',
+                            make_message(subject=f'Message {i}', to=USER, message_id=f'<{i}@example.com>',
+                                         date=start + timedelta(hours=i)),
+                            flags=('\\Seen',) if i % 3 else ())
+    standin.start()
+    yield standin
+    standin.stop()
+
+
+def test_pipelined_commands(standin):
+    async def status_of_folders():
+        client = await AsyncIMAPClient.connect('127.0.0.1', standin.port, use_ssl=False)
+        await client.login(USER, 'password')
+        started = time.monotonic()
+        futures = [client.send('STATUS', folder_argument(name), '(MESSAGES)') for name in FOLDER_MAPPING.values()]
+        results = await client.gather(futures)
+        elapsed = time.monotonic() - started
+        await client.logout()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(status_of_folders())
+    assert elapsed < 2 * LATENCY  # (one round trip for the 4 commands - not 4)
+    assert [result.typ for result in results] == ['OK'] * 4
+    answers = [first_line(untagged(result, 'STATUS')[0]).decode() for result in results]
+    assert answers[:2] == ['STATUS "Inbox" (MESSAGES 9)', 'STATUS "Sent" (MESSAGES 3)']  # (each one - its own answer)
+
+
+def test_sync_account(standin, tmp_path):
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    db, Email, Folder, Attachment, User, EmailBody = models[0], models[1], models[2], models[3], models[4], models[6]
+    with app.app_context():
+        upgrade_schema(db)
+        user = User(username=USER)
+        db.session.add(user)
+        db.session.flush()
+        # (listed now - so the folder mapping is taken from the database, not from the server)
+        upsert_folders(db, Folder, user.id, FOLDER_MAPPING, datetime.utcnow())
+        db.session.commit()
+
+    async def connect(email):
+        return await AsyncIMAPClient.connect('127.0.0.1', standin.port, use_ssl=False)
+
+    sync_engine = SyncEngine(db, Email, Folder, Attachment, EmailBody, None, None, n_initial=100)
+    engine = AsyncSyncEngine(app, sync_engine, FolderMappingCache(db, Folder), User, connect=connect)
+    try:
+        summaries = engine.sync_account(USER, 'password')
+        assert sorted(summaries['inbox']['new_uids']) == list(range(1, 10))
+        assert sorted(summaries['sent']['new_uids']) == [1, 2, 3]
+
+        standin.add_message(USER, 'Inbox', make_message(subject='New', to=USER))
+        with standin.lock:
+            account = standin.accounts[USER]
+            message = account.folder('Inbox').messages[0]
+            message.flags = {'\\Seen', '\\Flagged'}
+            message.modseq = account.next_modseq()
+        started = time.monotonic()
+        summaries = engine.sync_account(USER, 'password')
+        # (STATUS of the folders, then EXAMINE + the fetches of the changed one - 2 round trips)
+        assert time.monotonic() - started < 4 * LATENCY
+        assert (summaries['inbox']['new_uids'], summaries['inbox']['changed_uids']) == ([10], [1])
+        assert 'sent' not in summaries or not summaries['sent']['new_uids']
+    finally:
+        engine.stop()
+
+    with app.app_context():
+        counters = {folder.name: (folder.n_messages, folder.n_unread)
+                    for folder in db.session.scalars(db.select(Folder))}
+        assert (counters['inbox'], counters['sent']) == ((10, 4), (3, 1))
+        flags = db.session.execute(db.select(Email.flags).join(Folder).where(Folder.name == 'inbox')
+                                   .where(Email.uid == 1)).scalar_one()
+        assert set(flags.split()) == {'\\Seen', '\\Flagged'}
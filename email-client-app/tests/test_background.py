@@ -0,0 +1,73 @@
+"""
+The background work in one of the worker processes (`util.background.BackgroundWork`):
+the calls of the other processes are run in the elected one, the events reach all of them,
+and another process is elected when it exits.
+
+Usage:
+    python -m pytest tests
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+import util.file_lock
+from util.background import BackgroundWork
+
+
+def create(path, events):
+    return BackgroundWork(os.path.join(path, 'background.lock'), os.path.join(path, 'background.address'),
+                          handlers={'pid': os.getpid, 'fail': lambda: {}['missing']},
+                          on_event=lambda email, event: events.put((os.getpid(), email, event)))
+
+
+def elected_process(path, events, stop):
+    background_work = create(path, events)
+    assert background_work.call('pid') == os.getpid()
+    events.put('elected')
+    stop.wait(30)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.skipif(util.file_lock.fcntl is None, reason='fcntl is not available')
+def test_calls_events_and_next_election(tmp_path):
+    context = multiprocessing.get_context('fork')
+    events, stop = context.Queue(), context.Event()
+    other = context.Process(target=elected_process, args=(str(tmp_path), events, stop))
+    other.start()
+    assert events.get(timeout=10) == 'elected'
+
+    local_events = context.Queue()
+    background_work = create(str(tmp_path), local_events)
+    assert background_work.call('pid') == other.pid  # (run in the elected process)
+    assert not background_work.is_elected()
+    with pytest.raises(KeyError):
+        background_work.call('fail')
+    background_work.publish('user@example.com', {'type': 'new_messages'})
+    assert events.get(timeout=10) == (other.pid, 'user@example.com', {'type': 'new_messages'})
+    assert local_events.get(timeout=10) == (os.getpid(), 'user@example.com', {'type': 'new_messages'})
+
+    stop.set()
+    other.join()
+    wait_for(background_work.is_elected)  # (after the elected process has exited)
+    assert background_work.call('pid') == os.getpid()
+
+
+def test_single_process(tmp_path):
+    events = multiprocessing.get_context('fork').Queue()
+    background_work = create(str(tmp_path), events)
+    assert background_work.call('pid') == os.getpid()
+    assert background_work.is_elected()
+    background_work.publish('user@example.com', None)
+    assert events.get(timeout=10) == (os.getpid(), 'user@example.com', None)
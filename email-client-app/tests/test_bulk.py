@@ -0,0 +1,123 @@
+"""
+Operations on many messages at once (`util.bulk`): the uids and flags of a request are validated,
+and every uid gets its own result (the ones not on the server, the ones the server refused).
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.bulk import BulkOperations, parse_flags, parse_uid_set, parse_uids, to_uid_sets
+from util.database import get_models
+from util.migrations import upgrade_schema
+from util.sync import SyncEngine
+
+
+def test_parse_uids():
+    assert parse_uids('3, 1,,2 ') == [3, 1, 2]
+    assert parse_uids('') == []
+    for value in ('1,x', '1,-2', '0', '1.5', str(2 ** 32), '٣'):
+        with pytest.raises(ValueError):
+            parse_uids(value)
+
+
+def test_parse_flags():
+    assert parse_flags('\\seen $Label1 \\SEEN') == ['\\Seen', '$Label1']
+    for value in ('', '\\Recent', 'a(b', 'a"b'):
+        with pytest.raises(ValueError):
+            parse_flags(value)
+
+
+def test_uid_sets():
+    assert to_uid_sets([9, 1, 2, 3, 5, 8, 3]) == ['1:3,5,8:9']
+    uid_sets = to_uid_sets(range(1, 2000, 2), max_length=100)
+    assert all(len(uid_set) <= 100 for uid_set in uid_sets)
+    assert [uid for uid_set in uid_sets for uid in parse_uid_set(uid_set)] == list(range(1, 2000, 2))
+    assert parse_uid_set('1:3,5,9:8') == [1, 2, 3, 5, 8, 9]
+
+
+class FakeMailBox:
+    """ A folder on the server with the messages `uids` (STORE is refused if `refuse` is set) """
+
+    def __init__(self, uids, refuse=None):
+        self.uids = set(uids)
+        self.refuse = refuse
+        self.folder = self
+        self.client = self
+        self.sync_capabilities = {'IMAP4REV1', 'UIDPLUS'}
+        self.commands = []
+
+    def set(self, folder, readonly=False):
+        pass
+
+    def uid(self, command, *args):
+        self.commands.append(command)
+        uids = set(parse_uid_set(args[1] if command == 'SEARCH' else args[0]))  # (SEARCH UID <uid set>)
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in sorted(uids & self.uids)).encode()]
+        if command == 'STORE' and self.refuse:
+            return 'NO', [self.refuse.encode()]
+        if command == 'EXPUNGE':
+            self.uids -= uids
+        return 'OK', [None]
+
+
+@pytest.fixture
+def bulk(tmp_path):
+    """ (app, models, BulkOperations, the folder's id) - with the unread emails 1, 2, 3 """
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    db, Email, Folder, Attachment, User, EmailBody = models[0], models[1], models[2], models[3], models[4], models[6]
+    with app.app_context():
+        upgrade_schema(db)
+        user = User(username='user@example.com')
+        db.session.add(user)
+        db.session.flush()
+        folder = Folder(owner_id=user.id, name='inbox', server_name='INBOX', uidnext=100)
+        db.session.add(folder)
+        db.session.commit()
+        engine = SyncEngine(db, Email, Folder, Attachment, EmailBody, None, None)
+        rows = [{'uid': uid, 'date': datetime(2024, 1, uid), 'from_': 'a@example.com', 'to': 'user@example.com',
+                 'subject': 'Hello', 'flags': '', 'size': 100, 'body_fetched': False}
+                for uid in (1, 2, 3)]
+        engine.write(engine._store_new_messages, folder.folder_id, rows)
+        yield app, models, BulkOperations(engine), folder.folder_id
+
+
+def test_flags_of_each_uid(bulk):
+    app, models, operations, folder_id = bulk
+    db, Email, Folder = models[0], models[1], models[2]
+    with app.app_context():
+        folder = db.session.get(Folder, folder_id)
+        results = operations.set_flags(FakeMailBox([1, 2, 3]), folder, [1, 2, 7], ['\\Seen'])
+        assert results == {1: 'ok', 2: 'ok', 7: 'not_found'}
+        db.session.refresh(folder)
+        assert folder.n_unread == 1
+        assert dict(db.session.execute(db.select(Email.uid, Email.flags)).all()) == {1: '\\Seen', 2: '\\Seen', 3: ''}
+
+        results = operations.set_flags(FakeMailBox([1, 2, 3], refuse='Read-only folder'), folder, [3, 8], ['\\Seen'])
+        assert results == {3: 'Read-only folder', 8: 'not_found'}
+        db.session.refresh(folder)
+        assert folder.n_unread == 1
+
+
+def test_delete(bulk):
+    app, models, operations, folder_id = bulk
+    db, Email, Folder = models[0], models[1], models[2]
+    with app.app_context():
+        folder = db.session.get(Folder, folder_id)
+        mailbox = FakeMailBox([1, 2, 3])
+        assert operations.delete(mailbox, folder, [2, 3, 4]) == {2: 'ok', 3: 'ok', 4: 'not_found'}
+        assert mailbox.uids == {1} and mailbox.commands.count('EXPUNGE') == 1  # (one UID set)
+        db.session.refresh(folder)
+        assert (folder.n_messages, folder.n_unread) == (1, 1)
+        assert db.session.scalars(db.select(Email.uid)).all() == [1]
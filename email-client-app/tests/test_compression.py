@@ -0,0 +1,110 @@
+"""
+The compressed bodies (`util.compression`): a body is stored compressed and read back unchanged,
+and a dictionary trained on the bodies of an account makes them smaller (`BodyCompressor`).
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.compression import MIN_DICTIONARY_SAMPLES, BodyCompressor, compress, decompress, train_dictionary
+from util.database import get_models
+from util.migrations import upgrade_schema
+from util.sync import SyncEngine
+from util.write_queue import WriteQueue
+
+FOOTER = ('\n--\nJohn Smith | Senior Account Manager\nExample Corporation, 1 Main Street, Springfield\n'
+          'This message is confidential. If you received it by mistake, please delete it.\n')
+
+
+def body(i):
+    return f'Hi,\nthe report number {i} is ready ({i * 7919 % 1000} pages).\n' + FOOTER
+
+
+def test_compress_and_decompress():
+    for text in ('', 'Short', body(1) * 20, 'Ünïcödé ✓ ' * 50, '\udc80 lone surrogate' * 10):
+        data, codec = compress(text)
+        assert decompress(data, codec) == text
+        assert codec == ('raw' if len(text.encode('utf-8', errors='surrogatepass')) < 64 else codec)
+    assert compress(body(1) * 20)[1] != 'raw'
+    with pytest.raises(ValueError):
+        decompress(b'', 'lzma')
+
+
+def test_zlib_dictionary():
+    samples = [body(i).encode() for i in range(200)]
+    dictionary = train_dictionary(samples, 'zlib')
+    assert b'John Smith | Senior Account Manager\n' in dictionary  # (the lines that repeat)
+    assert b'report number' not in dictionary
+
+    class Dictionary:
+        codec = 'zlib'
+        data = dictionary
+    data, codec = compress(body(1000), Dictionary)
+    assert (codec, decompress(data, codec, Dictionary)) == ('zlib', body(1000))
+    assert len(data) < len(compress(body(1000))[0]) / 2
+
+
+@pytest.fixture
+def compressor(tmp_path):
+    """ (app, models, BodyCompressor, the user's id) - with emails whose bodies are not compressed yet """
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    (db, Email, Folder, Attachment, User, Outbox, EmailBody, CompressionDictionary,
+     MessageThread, ThreadFolder, ThreadReference) = models
+    write_queue = WriteQueue(app, db)
+    with app.app_context():
+        upgrade_schema(db)
+        user = User(username='user@example.com')
+        db.session.add(user)
+        db.session.flush()
+        folder = Folder(owner_id=user.id, name='inbox', server_name='INBOX', uidnext=1000)
+        db.session.add(folder)
+        db.session.commit()
+        engine = SyncEngine(db, Email, Folder, Attachment, EmailBody, None, None)
+        rows = [{'uid': uid, 'date': datetime(2024, 1, 1), 'from_': 'a@example.com', 'to': 'user@example.com',
+                 'subject': 'Report', 'flags': '', 'size': 100, 'body_fetched': True}
+                for uid in range(1, MIN_DICTIONARY_SAMPLES + 21)]
+        engine.write(engine._store_new_messages, folder.folder_id, rows)
+        for email in db.session.scalars(db.select(Email)):
+            email.text_uncompressed = body(email.uid)  # (stored before the compression)
+        db.session.commit()
+        yield app, models, BodyCompressor(db, Email, EmailBody, CompressionDictionary, write_queue, pause=0), user.id
+    write_queue.stop()
+
+
+def stored_bodies(models):
+    db, Email, EmailBody = models[0], models[1], models[6]
+    db.session.expire_all()
+    return db.session.execute(db.select(Email.uid, EmailBody).join(EmailBody, EmailBody.email_id == Email.email_id)
+                              .order_by(Email.uid)).all()
+
+
+def test_migrate_train_recompress(compressor):
+    app, models, body_compressor, owner_id = compressor
+    n = MIN_DICTIONARY_SAMPLES + 20
+    with app.app_context():
+        assert body_compressor.migrate() == n
+        assert body_compressor.migrate() == 0
+        before = sum(len(email_body.data) for _, email_body in stored_bodies(models))
+        assert body_compressor.report()['not_compressed_yet'] == {'bodies': 0, 'bytes': 0}
+
+        dictionary_id = body_compressor.train(owner_id, 'zlib')
+        assert dictionary_id is not None
+        assert body_compressor.recompress(owner_id) == n
+        assert body_compressor.recompress(owner_id) == 0  # (all of them have the newest dictionary)
+        bodies = stored_bodies(models)
+        assert [(uid, email_body.text) for uid, email_body in bodies] == [(uid, body(uid)) for uid in range(1, n + 1)]
+        assert {email_body.dictionary_id for _, email_body in bodies} == {dictionary_id}
+        assert sum(len(email_body.data) for _, email_body in bodies) < before / 2
+        report = body_compressor.report()
+        assert (report['dictionaries'], report['by_codec']['zlib']['bodies']) == (1, n)
@@ -0,0 +1,111 @@
+"""
+The conversations (`util.conversations`): the emails are grouped into threads by their Message-ID,
+In-Reply-To and References (JWZ threading) - incrementally, as they are stored - and a thread is shown as a tree.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.conversations import ThreadIndex, build_tree, normalize_subject, thread_headers
+from util.database import get_models
+from util.migrations import upgrade_schema
+from util.sync import SyncEngine
+
+
+def test_thread_headers():
+    headers = {'message-id': ('<3@x>',), 'references': ('<1@x> <2@x>',), 'in-reply-to': ('<2@x>',)}
+    assert thread_headers(headers) == {'message_id': '<3@x>', 'references': '<1@x> <2@x>'}
+    headers = {'message-id': ('<3@x>',), 'references': ('<1@x> <3@x>',), 'in-reply-to': ('"Bob" <2@x>',)}
+    assert thread_headers(headers) == {'message_id': '<3@x>', 'references': '<1@x> <2@x>'}  # (+ the parent)
+    assert thread_headers({}) == {'message_id': None, 'references': None}
+    assert normalize_subject('RE[2]: Fwd:  AW: Quarterly   Report') == ('quarterly report', True)
+    assert normalize_subject('Report') == ('report', False)
+
+
+def message(message_id, references, day):
+    return SimpleNamespace(message_id=message_id, references=references, date=datetime(2024, 1, day))
+
+
+def test_tree():
+    root = message('<1@x>', None, 1)
+    reply = message('<2@x>', '<1@x>', 2)
+    reply_of_reply = message('<3@x>', '<1@x> <2@x>', 4)
+    second_reply = message('<4@x>', '<1@x>', 3)
+    orphan = message('<6@x>', '<5@x>', 5)  # (its parent - a message we don't have)
+    tree = build_tree([reply_of_reply, orphan, second_reply, reply, root])
+    assert [(m.message_id, depth) for m, depth in tree] == [
+        ('<1@x>', 0), ('<2@x>', 1), ('<3@x>', 2), ('<4@x>', 1), ('<6@x>', 0)]
+
+    looped = [message('<1@x>', '<2@x>', 1), message('<2@x>', '<1@x>', 2)]  # (broken headers)
+    assert sorted(depth for _, depth in build_tree(looped)) == [0, 1]
+
+
+@pytest.fixture
+def threads(tmp_path):
+    """ (app, models, a function that stores messages) """
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    (db, Email, Folder, Attachment, User, Outbox, EmailBody, CompressionDictionary,
+     MessageThread, ThreadFolder, ThreadReference) = models
+    with app.app_context():
+        upgrade_schema(db)
+        user = User(username='user@example.com')
+        db.session.add(user)
+        db.session.flush()
+        folder = Folder(owner_id=user.id, name='inbox', server_name='INBOX', uidnext=100)
+        db.session.add(folder)
+        db.session.commit()
+        engine = SyncEngine(db, Email, Folder, Attachment, EmailBody, None, None,
+                            thread_index=ThreadIndex(db, Email, MessageThread, ThreadFolder, ThreadReference))
+
+        def store(*messages):
+            """ messages: (uid, subject, message id, references) """
+            rows = [{'uid': uid, 'date': datetime(2024, 1, uid), 'from_': 'a@example.com', 'to': 'user@example.com',
+                     'subject': subject, 'flags': '', 'size': 100, 'body_fetched': False,
+                     'message_id': message_id, 'references': references}
+                    for uid, subject, message_id, references in messages]
+            engine.write(engine._store_new_messages, folder.folder_id, rows)
+
+        yield app, models, store
+
+
+def thread_of_uids(models):
+    db, Email = models[0], models[1]
+    db.session.expire_all()
+    by_thread = {}
+    for uid, thread_id in db.session.execute(db.select(Email.uid, Email.thread_id).order_by(Email.uid)):
+        by_thread.setdefault(thread_id, []).append(uid)
+    return sorted(by_thread.values())
+
+
+def test_threads_are_found_and_merged(threads):
+    app, models, store = threads
+    db, MessageThread, ThreadFolder = models[0], models[8], models[9]
+    with app.app_context():
+        store((1, 'Budget', '<1@x>', None),
+              (2, 'Re: Budget', '<2@x>', '<1@x>'),
+              (3, 'Trip', '<3@x>', None))
+        assert thread_of_uids(models) == [[1, 2], [3]]
+
+        store((4, 'Re: Trip', '<4@x>', '<5@x>'))  # (its parent isn't stored yet)
+        store((5, 'Re: Trip', '<5@x>', '<3@x>'))  # (it links the two threads)
+        store((6, 'RE: trip', '<6@x>', None))  # (a reply without references - by the subject)
+        assert thread_of_uids(models) == [[1, 2], [3, 4, 5, 6]]
+
+        store((7, 'Re: Budget', '<7@x>', '<2@x> <3@x>'))  # (its references are in both threads)
+        assert thread_of_uids(models) == [[1, 2, 3, 4, 5, 6, 7]]
+        thread = db.session.execute(db.select(MessageThread)).scalar_one()  # (the merged ones are deleted)
+        assert (thread.n_messages, thread.n_unread, thread.last_date) == (7, 7, datetime(2024, 1, 7))
+        counters = db.session.execute(db.select(ThreadFolder)).scalar_one()
+        assert (counters.n_messages, counters.thread_id) == (7, thread.thread_id)
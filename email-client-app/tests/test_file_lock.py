@@ -0,0 +1,78 @@
+"""
+The lock of a file shared by the worker processes (`util.file_lock.FileLock`), with each of its implementations.
+
+Usage:
+    python -m pytest tests
+"""
+
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+import util.file_lock
+from util.file_lock import FileLock
+
+
+def try_lock(path, results):
+    results.put(FileLock(path).acquire(blocking=False))
+
+
+@pytest.mark.skipif(util.file_lock.fcntl is None, reason='fcntl is not available')
+def test_other_process_waits(tmp_path):
+    path = str(tmp_path / 'instance' / 'write.lock')  # (the folder is created)
+    lock = FileLock(path)
+    results = multiprocessing.Queue()
+    with lock:
+        process = multiprocessing.Process(target=try_lock, args=(path, results))
+        process.start()
+        process.join()
+        assert results.get() is False
+    process = multiprocessing.Process(target=try_lock, args=(path, results))
+    process.start()
+    process.join()
+    assert results.get() is True
+
+
+class FakeMsvcrt:
+    """ `msvcrt.locking` of the byte 0, with the locks of all the "processes" in one set """
+    LK_NBLCK, LK_UNLCK = 2, 0
+    locked = set()
+
+    @classmethod
+    def locking(cls, fd, mode, n_bytes):
+        key = os.path.realpath(f'/proc/self/fd/{fd}') if os.path.exists('/proc/self/fd') else fd
+        if mode == cls.LK_UNLCK:
+            cls.locked.discard(key)
+        elif key in cls.locked:
+            raise OSError('locked')
+        else:
+            cls.locked.add(key)
+
+
+def test_msvcrt(tmp_path, monkeypatch):
+    monkeypatch.setattr(util.file_lock, 'fcntl', None)
+    monkeypatch.setattr(util.file_lock, 'msvcrt', FakeMsvcrt)
+    path = str(tmp_path / 'write.lock')
+    first, second = FileLock(path), FileLock(path)
+    assert first.acquire()
+    assert not second.acquire(blocking=False)
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
+
+
+def test_without_file_locks(tmp_path, monkeypatch):
+    """ (neither fcntl nor msvcrt - only the threads of this process are excluded) """
+    monkeypatch.setattr(util.file_lock, 'fcntl', None)
+    monkeypatch.setattr(util.file_lock, 'msvcrt', None)
+    lock = FileLock(str(tmp_path / 'write.lock'))
+    assert lock.acquire()
+    assert not lock.acquire(blocking=False)
+    lock.release()
+    assert lock.acquire(blocking=False)
+    lock.release()
+    assert not os.path.exists(tmp_path / 'write.lock')
@@ -0,0 +1,96 @@
+"""
+The HTTP caching (`util.http_cache`): a response the client already has is answered with 304
+(by its ETag / Last-Modified), the big responses are compressed, and the fingerprinted static files are immutable.
+
+Usage:
+    python -m pytest tests
+"""
+
+import gzip
+import json
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from flask import Flask, jsonify, url_for
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.http_cache import (ResponseCompression, StaticFingerprints, is_not_modified, make_etag,
+                             not_modified_response, set_validators)
+
+LAST_MODIFIED = datetime(2024, 1, 2, 3, 4, 5, 600000)
+
+
+@pytest.fixture
+def app(tmp_path):
+    static_folder = tmp_path / 'static'
+    static_folder.mkdir()
+    (static_folder / 'app.js').write_text('console.log("v1");')
+    app = Flask(__name__, static_folder=str(static_folder))
+    app.config['compression'] = ResponseCompression(app)
+    StaticFingerprints(app)
+    app.config['version'] = 1
+
+    @app.route('/page')
+    def page():
+        etag = make_etag('page', app.config['version'])
+        if is_not_modified(etag, LAST_MODIFIED):
+            return not_modified_response(etag, LAST_MODIFIED)
+        return set_validators(jsonify({'emails': ['Hello'] * 500, 'version': app.config['version']}),
+                              etag, LAST_MODIFIED)
+
+    @app.route('/small')
+    def small():
+        return jsonify({'success': True})
+
+    return app
+
+
+def test_not_modified(app):
+    client = app.test_client()
+    response = client.get('/page', headers={'Accept-Encoding': 'identity'})
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert response.status_code == 200 and etag.startswith('W/')
+    assert response.headers['Cache-Control'] in ('private, no-cache', 'no-cache, private')
+
+    response = client.get('/page', headers={'If-None-Match': etag})
+    assert (response.status_code, response.data, response.headers['ETag']) == (304, b'', etag)
+    response = client.get('/page', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304  # (the microseconds aren't in the header)
+
+    app.config['version'] = 2
+    response = client.get('/page', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    # (If-Modified-Since is not checked when If-None-Match is given)
+    response = client.get('/page', headers={'If-None-Match': etag, 'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+
+
+def test_compressed(app):
+    client = app.test_client()
+    response = client.get('/page', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip' and 'Accept-Encoding' in response.vary
+    assert json.loads(gzip.decompress(response.data))['version'] == 1
+    assert response.headers['ETag'].startswith('W/')
+    assert 'Content-Encoding' not in client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'Content-Encoding' not in client.get('/page', headers={'Accept-Encoding': 'identity'}).headers
+    stats = app.config['compression'].stats()
+    assert stats['compressed'] == 1 and stats['bytes_after'] < stats['bytes_before'] / 10
+
+
+def test_fingerprinted_static_files(app, tmp_path):
+    with app.test_request_context():
+        url = url_for('static', filename='app.js')
+    assert '?v=' in url
+    client = app.test_client()
+    response = client.get(url)
+    assert 'immutable' in response.headers['Cache-Control'] and 'max-age=31536000' in response.headers['Cache-Control']
+    assert 'immutable' not in client.get('/static/app.js?v=old').headers.get('Cache-Control', '')
+
+    path = tmp_path / 'static' / 'app.js'
+    path.write_text('console.log("v2");')
+    os.utime(path, ns=(path.stat().st_mtime_ns + 10 ** 9,) * 2)
+    with app.test_request_context():
+        assert url_for('static', filename='app.js') != url  # (a new URL for the new content)
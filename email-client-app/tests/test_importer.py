@@ -0,0 +1,106 @@
+"""
+The import of a whole mailbox (`util.importer.MailboxImporter`), from the IMAP stand-in of the benchmarks:
+the messages older than the first sync are imported in chunks, and a stopped import goes on from its checkpoint.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from flask import Flask
+from imap_tools import MailBoxUnencrypted
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, 'benchmarks'))
+from imap_standin import IMAPStandIn, make_message
+from util.attachment_store import AttachmentStore
+from util.database import get_models
+from util.folder_cache import FolderMappingCache
+from util.importer import MailboxImporter
+from util.message_store import RawMessageStore
+from util.migrations import upgrade_schema
+from util.sync import SyncEngine
+
+USER = 'user@localhost'
+N_MESSAGES = 30
+
+
+class StandInPool:
+    """ A new connection to the stand-in for every use """
+
+    def __init__(self, port):
+        self.port = port
+
+    @contextmanager
+    def connection(self, email, password):
+        with MailBoxUnencrypted('127.0.0.1', self.port).login(email, password) as mailbox:
+            yield mailbox
+
+
+@pytest.fixture
+def importer(tmp_path):
+    """ (app, models, MailboxImporter, progress reports) - after the first sync of the folders (10 newest) """
+    standin = IMAPStandIn()
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(N_MESSAGES):
+        standin.add_message(USER, 'Inbox', make_message(subject=f'Message {i}', to=USER,
+                                                        date=start + timedelta(hours=i)))
+    standin.start()
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    db, Email, Folder, Attachment, User, EmailBody = models[0], models[1], models[2], models[3], models[4], models[6]
+    pool = StandInPool(standin.port)
+    sync_engine = SyncEngine(db, Email, Folder, Attachment, EmailBody, AttachmentStore(str(tmp_path / 'attachments')),
+                             RawMessageStore(str(tmp_path / 'messages')))
+    folder_cache = FolderMappingCache(db, Folder)
+    with app.app_context():
+        upgrade_schema(db)
+        owner = User(username=USER)
+        db.session.add(owner)
+        db.session.commit()
+        with pool.connection(USER, 'password') as mailbox:
+            folder_cache.get(owner, mailbox)
+            for folder in db.session.scalars(db.select(Folder)).all():
+                sync_engine.sync_folder(mailbox, folder)
+        assert db.session.scalar(db.select(db.func.count()).select_from(Email)) == sync_engine.n_initial
+    reports = []
+    yield app, models, MailboxImporter(app, sync_engine, pool, folder_cache, User, chunk=7,
+                                       on_progress=lambda email, progress: reports.append(progress)), reports
+    standin.stop()
+
+
+def run(importer):
+    importer.start(USER, 'password')
+    importer._imports[USER]['thread'].join(30)
+    return importer.progress(USER)
+
+
+def test_stopped_and_resumed(importer):
+    app, models, mailbox_importer, reports = importer
+    db, Email, Folder = models[0], models[1], models[2]
+    mailbox_importer.on_progress = lambda email, progress: mailbox_importer.stop(email)  # (after the 1st fetch)
+    progress = run(mailbox_importer)
+    assert (progress['state'], progress['imported']) == ('stopped', 7)
+    with app.app_context():
+        inbox = db.session.execute(db.select(Folder).where(Folder.name == 'inbox')).scalar_one()
+        assert (inbox.import_next_uid, inbox.imported_at) == (8, None)  # (the checkpoint)
+
+    mailbox_importer.on_progress = lambda email, progress: reports.append(progress)
+    progress = run(mailbox_importer)
+    assert progress['state'] == 'done' and progress['imported'] == N_MESSAGES - 10 - 7
+    assert (progress['stored'], progress['total']) == (N_MESSAGES, N_MESSAGES)
+    assert reports[-1] == progress
+    with app.app_context():
+        uids = db.session.scalars(db.select(Email.uid).order_by(Email.uid)).all()
+        assert uids == list(range(1, N_MESSAGES + 1))  # (each one once)
+        inbox = db.session.execute(db.select(Folder).where(Folder.name == 'inbox')).scalar_one()
+        assert inbox.n_messages == N_MESSAGES and inbox.imported_at is not None
+
+    assert run(mailbox_importer)['imported'] == 0  # (nothing left)
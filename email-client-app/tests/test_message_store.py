@@ -0,0 +1,58 @@
+"""
+The raw messages (`util.message_store.RawMessageStore`): a message is saved once as an .eml file,
+its headers are parsed without the body, and the parsed messages are kept in a cache of at most `cache_bytes`.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.message_store import RawMessageStore
+
+
+def raw_message(subject, text='Hi there'):
+    return f'From: a@example.com\r\nTo: user@example.com\r\nSubject: {subject}\r\n\r\n{text}\r\n'.encode()
+
+
+def test_saved_and_parsed(tmp_path):
+    store = RawMessageStore(str(tmp_path))
+    path = store.put(1, 10, raw_message('Hello'))
+    assert path == str(tmp_path / '1' / '10.eml') and os.listdir(tmp_path / 'tmp') == []
+    with store.read(path) as raw:
+        assert raw[:] == raw_message('Hello')
+    assert store.headers(path)['Subject'] == 'Hello'
+    assert (store.message(path).subject, store.message(path).text.strip()) == ('Hello', 'Hi there')
+    assert (store.counters['misses'], store.counters['hits']) == (1, 1)
+
+    store.put(1, 10, raw_message('Hello again'))  # (the cached message is dropped)
+    assert store.message(path).subject == 'Hello again'
+    store.discard(path)
+    assert not os.path.exists(path) and store.stats()['cached_messages'] == 0
+
+    empty = store.put(1, 11, b'')
+    with store.read(empty) as raw:
+        assert raw == b''
+
+
+def test_least_recently_used_are_dropped(tmp_path):
+    size = len(raw_message('1'))
+    store = RawMessageStore(str(tmp_path), cache_bytes=2 * size)
+    paths = [store.put(1, i, raw_message(str(i))) for i in range(3)]
+    store.message(paths[0])
+    store.message(paths[1])
+    store.message(paths[0])  # (now the most recently used)
+    store.message(paths[2])  # (the 2nd one is dropped)
+    assert store.stats()['cached_messages'] == 2 and store.stats()['cached_bytes'] == 2 * size
+    assert store.counters['evictions'] == 1
+    store.message(paths[0])
+    assert store.counters['hits'] == 2
+    store.message(paths[1])
+    assert store.counters['misses'] == 4
+
+    big = store.put(1, 3, raw_message('big', 'x' * 3 * size))
+    assert store.message(big).subject == 'big'
+    assert big not in store._cache  # (bigger than the whole cache)
@@ -0,0 +1,188 @@
+"""
+Upgrade of a database created by the first version of the app (before the schema revisions)
+to the current schema (`flask --app app migrate` - `upgrade_schema`).
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from sqlalchemy import inspect, text
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.database import get_models
+import util.migrations
+from util.migrations import REVISIONS, check_schema, schema_transaction, schema_version, upgrade_schema
+
+
+# The schema of the first version (`db.create_all()` of its models):
+BASELINE_SCHEMA_SQL = [
+    'CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(254) NOT NULL, PRIMARY KEY (id), UNIQUE (username))',
+    '''CREATE TABLE email (id INTEGER NOT NULL, owner_id INTEGER NOT NULL, uid INTEGER, date DATETIME,
+       "from" VARCHAR(254), "to" VARCHAR(254), subject VARCHAR(255), text VARCHAR,
+       PRIMARY KEY (id), FOREIGN KEY(owner_id) REFERENCES user (id))''',
+    '''CREATE TABLE folder (id INTEGER NOT NULL, owner_id INTEGER NOT NULL, name VARCHAR(32) NOT NULL,
+       PRIMARY KEY (id), FOREIGN KEY(owner_id) REFERENCES user (id))''',
+    '''CREATE TABLE email_folder (email_id INTEGER, folder_id INTEGER,
+       FOREIGN KEY(email_id) REFERENCES email (id), FOREIGN KEY(folder_id) REFERENCES folder (id))''',
+    '''CREATE TABLE attachment (id INTEGER NOT NULL, email_id INTEGER NOT NULL, filename VARCHAR(255) NOT NULL,
+       content_type VARCHAR, path VARCHAR NOT NULL, PRIMARY KEY (id), FOREIGN KEY(email_id) REFERENCES email (id))''',
+]
+
+
+def create_baseline_database(path):
+    connection = sqlite3.connect(path)
+    for statement in BASELINE_SCHEMA_SQL:
+        connection.execute(statement)
+    connection.execute("INSERT INTO user (id, username) VALUES (1, 'user@example.com')")
+    # (the first version added the same folders again on every request)
+    connection.executemany('INSERT INTO folder (id, owner_id, name) VALUES (?, 1, ?)',
+                           [(1, 'inbox'), (2, 'sent'), (3, 'inbox')])
+    connection.executemany(
+        'INSERT INTO email (id, owner_id, uid, date, "from", "to", subject, text) VALUES (?, 1, ?, ?, ?, ?, ?, ?)',
+        [(1, 10, '2020-01-01 10:00:00.000000', 'a@example.com', 'user@example.com', 'First', 'Hello'),
+         (2, 11, '2020-01-02 10:00:00.000000', 'b@example.com', 'user@example.com', 'Second', 'World'),
+         (3, 12, '2020-01-03 10:00:00.000000', 'user@example.com', 'c@example.com', 'Sent', 'Bye'),
+         (4, 13, '2020-01-04 10:00:00.000000', 'd@example.com', 'user@example.com', 'No folder', 'Lost')])
+    connection.executemany('INSERT INTO email_folder (email_id, folder_id) VALUES (?, ?)',
+                           [(1, 1), (2, 3), (3, 2)])
+    connection.execute("INSERT INTO attachment (id, email_id, filename, path) VALUES (1, 1, 'a.txt', 'a.txt')")
+    connection.execute("INSERT INTO attachment (id, email_id, filename, path) VALUES (2, 4, 'b.txt', 'b.txt')")
+    connection.commit()
+    connection.close()
+
+
+def create_app(path):
+    app = Flask(__name__, instance_path=os.path.dirname(path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    return app, get_models(app)
+
+
+def test_upgrade_from_baseline(tmp_path):
+    path = str(tmp_path / 'emails.db')
+    create_baseline_database(path)
+    app, (db, Email, Folder, Attachment, User, *_) = create_app(path)
+    with app.app_context():
+        upgrade_schema(db)
+        assert schema_version(db.engine) == len(REVISIONS)
+        check_schema(db)
+
+        # Every column of the models is in the upgraded tables:
+        inspector = inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            assert {column.name for column in table.columns} <= existing, table.name
+
+        # The duplicate folder is merged, and every email is in exactly one folder:
+        folders = {folder.name: folder for folder in db.session.scalars(db.select(Folder))}
+        assert sorted(folders) == ['inbox', 'sent']
+        emails = {email.uid: email for email in db.session.scalars(db.select(Email))}
+        assert sorted(emails) == [10, 11, 12]  # (the email without a folder is dropped)
+        assert emails[10].folder_id == emails[11].folder_id == folders['inbox'].folder_id
+        assert emails[12].folder_id == folders['sent'].folder_id
+        assert folders['inbox'].n_messages == 2
+        assert folders['inbox'].version == 0
+        assert [attachment.email_id for attachment in db.session.scalars(db.select(Attachment))] == [1]
+
+        # The upgraded database works like a new one (the triggers, the search index, the new rows):
+        db.session.add(Email(owner_id=1, folder_id=folders['inbox'].folder_id, uid=14, date=datetime(2020, 1, 5),
+                             flags='', size=100, body_fetched=False))
+        db.session.commit()
+        version = db.session.execute(text('SELECT version FROM folder WHERE id = :id'),
+                                     {'id': folders['inbox'].folder_id}).scalar_one()
+        assert version == 1
+
+
+def test_synced_folders_keep_their_emails(tmp_path, monkeypatch):
+    """ (a database of the version with the sync state - its folders are not resynced from scratch) """
+    path = str(tmp_path / 'emails.db')
+    create_baseline_database(path)
+    app, models = create_app(path)
+    db, Email, Folder = models[:3]
+    with app.app_context():
+        with schema_transaction(db.engine) as connection:
+            REVISIONS[0](connection, db.metadata)
+            connection.execute(text('CREATE TABLE schema_version (version INTEGER NOT NULL)'))
+            connection.execute(text('INSERT INTO schema_version (version) VALUES (1)'))
+            connection.execute(text("UPDATE folder SET uidvalidity = 7, uidnext = 20 WHERE name = 'inbox'"))
+        monkeypatch.setattr(util.migrations, 'BATCH_SIZE', 2)  # (the snippets are made in several batches)
+        upgrade_schema(db)
+        inbox = db.session.execute(db.select(Folder).where(Folder.name == 'inbox')).scalar_one()
+        assert (inbox.uidvalidity, inbox.uidnext, inbox.n_messages) == (7, 20, 2)
+        assert dict(db.session.execute(db.select(Email.uid, Email.snippet)).all()) == {
+            10: 'Hello', 11: 'World', 12: 'Bye'}
+
+
+def test_upgrade_is_idempotent(tmp_path):
+    path = str(tmp_path / 'emails.db')
+    app, (db, *_) = create_app(path)
+    with app.app_context():
+        upgrade_schema(db)  # (a new database: created at the current revision)
+        upgrade_schema(db)
+        assert schema_version(db.engine) == len(REVISIONS)
+
+
+def test_failed_upgrade_changes_nothing(tmp_path, monkeypatch):
+    path = str(tmp_path / 'emails.db')
+    create_baseline_database(path)
+    app, (db, *_) = create_app(path)
+
+    def failing_revision(connection, metadata):
+        raise RuntimeError('revision failed')
+
+    monkeypatch.setattr(util.migrations, 'REVISIONS', [REVISIONS[0], failing_revision])
+    with app.app_context():
+        with pytest.raises(RuntimeError, match='revision failed'):
+            upgrade_schema(db)
+        # (the DDL of the first revision is rolled back too - the database is still the first version)
+        inspector = inspect(db.engine)
+        assert 'schema_version' not in inspector.get_table_names()
+        assert 'server_name' not in {column['name'] for column in inspector.get_columns('folder')}
+
+        monkeypatch.setattr(util.migrations, 'REVISIONS', REVISIONS)
+        upgrade_schema(db)
+        assert schema_version(db.engine) == len(REVISIONS)
+
+
+def test_empty_schema_version_is_revision_0(tmp_path):
+    path = str(tmp_path / 'emails.db')
+    create_baseline_database(path)
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE schema_version (version INTEGER NOT NULL)')  # (left by an older upgrade)
+    connection.commit()
+    connection.close()
+    app, (db, *_) = create_app(path)
+    with app.app_context():
+        upgrade_schema(db)
+        assert schema_version(db.engine) == len(REVISIONS)
+
+
+def test_queued_messages_are_kept(tmp_path):
+    path = str(tmp_path / 'emails.db')
+    create_baseline_database(path)
+    connection = sqlite3.connect(path)
+    # (the outbox as it was before the spool - the whole message in `raw`)
+    connection.execute('''CREATE TABLE outbox (id INTEGER NOT NULL, owner_id INTEGER NOT NULL,
+        recipients VARCHAR NOT NULL, subject VARCHAR(255), raw BLOB NOT NULL, status VARCHAR(8) NOT NULL,
+        attempts INTEGER NOT NULL, next_attempt_at DATETIME NOT NULL, last_error VARCHAR,
+        created_at DATETIME NOT NULL, sent_at DATETIME, copied_to_sent BOOLEAN NOT NULL,
+        PRIMARY KEY (id), FOREIGN KEY(owner_id) REFERENCES user (id))''')
+    connection.execute("INSERT INTO outbox (id, owner_id, recipients, subject, raw, status, attempts, "
+                       "next_attempt_at, created_at, copied_to_sent) VALUES (1, 1, 'a@example.com', 'Hi', "
+                       "X'4869', 'queued', 0, '2020-01-01 10:00:00.000000', '2020-01-01 10:00:00.000000', 0)")
+    connection.commit()
+    connection.close()
+    app, models = create_app(path)
+    db, Outbox = models[0], models[5]  # (all the models stay referenced - the relationships find them by name)
+    with app.app_context():
+        upgrade_schema(db)
+        message = db.session.get(Outbox, 1)
+        assert (message.raw, message.path, message.status) == (b'Hi', None, 'queued')
+        assert {column['name']: column['nullable'] for column in inspect(db.engine).get_columns('outbox')}['raw']
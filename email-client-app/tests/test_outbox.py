@@ -0,0 +1,139 @@
+"""
+The outbox (`util.outbox.OutboxSender`): a queued message is written into the spool with its attachments,
+sent from there by the workers, and its file is deleted when it's sent or given up on;
+a temporary failure is retried, and a message whose lease has expired is claimed again.
+
+Usage:
+    python -m pytest tests
+"""
+
+import base64
+import io
+import os
+import smtplib
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.database import get_models
+from util.migrations import upgrade_schema
+from util.outbox import OutboxSender
+
+USER = 'user@example.com'
+
+
+class FakeSMTPPool:
+    """ Sessions that fail the first sends with `errors` (one each), and accept the rest """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []  # (sender, recipients, message)
+
+    @contextmanager
+    def connection(self, email, password):
+        yield self
+
+    def send_file(self, sender, recipients, file):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((sender, recipients, file.read()))
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    """ (app, models, the spool folder) - with the user's row """
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    db, User = models[0], models[4]
+    with app.app_context():
+        upgrade_schema(db)
+        db.session.add(User(username=USER))
+        db.session.commit()
+    yield app, models, str(tmp_path / 'outbox')
+
+
+def send(outbox, smtp_pool, attachments=(), **options):
+    """ Enqueue a message, and wait until the workers are done with it. Returns its `Outbox` row and the copies """
+    app, models, spool = outbox
+    db, User, Outbox = models[0], models[4], models[5]
+    copies = []
+    sender = OutboxSender(app, db, Outbox, User, smtp_pool, spool, poll_interval=0.05,
+                          on_sent=lambda email, password, raw: copies.append(raw) or True, **options)
+    try:
+        with app.app_context():
+            owner = db.session.execute(db.select(User)).scalar_one()
+            outbox_id = sender.enqueue(owner, ['friend@example.com'], 'Hello', 'Hi there', attachments)
+            assert os.listdir(spool) == [db.session.get(Outbox, outbox_id).path]
+        sender.set_credentials(USER, 'password')
+        deadline = time.monotonic() + 10
+        with app.app_context():
+            while db.session.get(Outbox, outbox_id).status in ('queued', 'sending'):
+                assert time.monotonic() < deadline
+                db.session.rollback()
+                time.sleep(0.02)
+    finally:
+        sender.stop()  # (the worker has finished with the message - its file is deleted)
+    with app.app_context():
+        message = db.session.get(Outbox, outbox_id)
+        db.session.expunge(message)
+    return message, copies
+
+
+def test_sent_from_spool(outbox):
+    smtp_pool = FakeSMTPPool()
+    data = os.urandom(200 * 1024)  # (several chunks)
+    message, copies = send(outbox, smtp_pool, [('data.bin', None, io.BytesIO(data))])
+    assert (message.status, message.attempts, message.path, message.copied_to_sent) == ('sent', 1, None, True)
+    assert os.listdir(outbox[2]) == []  # (the file is deleted)
+    (sender, recipients, raw), = smtp_pool.sent
+    assert (sender, recipients, copies) == (USER, ['friend@example.com'], [raw])
+    assert b'filename="data.bin"' in raw and b'Hi there' in raw
+    encoded = raw.split(b'Content-Transfer-Encoding: base64\r\n')[-1].split(b'\r\n\r\n', 1)[1].split(b'\r\n--')[0]
+    assert base64.b64decode(encoded) == data
+
+
+def test_failed_message_is_removed(outbox):
+    message, copies = send(outbox, FakeSMTPPool(smtplib.SMTPDataError(554, b'Rejected')))
+    assert (message.status, message.attempts, message.path, copies) == ('failed', 1, None, [])
+    assert message.last_error.startswith('(554')
+    assert os.listdir(outbox[2]) == []
+
+
+def test_retried_after_temporary_failure(outbox):
+    smtp_pool = FakeSMTPPool(smtplib.SMTPDataError(451, b'Try again later'))
+    started = time.monotonic()
+    message, copies = send(outbox, smtp_pool, retry_delay=0.2)
+    assert (message.status, message.attempts, message.path, message.last_error) == ('sent', 2, None, None)
+    assert time.monotonic() - started >= 0.2
+    assert len(smtp_pool.sent) == 1 and len(copies) == 1
+
+
+def test_expired_lease_is_claimed_again(outbox):
+    app, models, spool = outbox
+    db, User, Outbox = models[0], models[4], models[5]
+    sender = OutboxSender(app, db, Outbox, User, FakeSMTPPool(), spool, workers=0, lease=60)
+    with app.app_context():
+        owner = db.session.execute(db.select(User)).scalar_one()
+        outbox_id = sender.enqueue(owner, ['friend@example.com'], 'Hello', 'Hi there')
+    sender.set_credentials(USER, 'password')  # (no workers - the messages are claimed here)
+
+    email, password, messages = sender._claim()
+    assert (email, password, [message[0] for message in messages]) == (USER, 'password', [outbox_id])
+    sender._release(email)
+    assert sender._claim() is None  # (claimed, and its lease hasn't expired)
+
+    with app.app_context():  # (the process that claimed it has died)
+        db.session.get(Outbox, outbox_id).lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+    email, password, messages = sender._claim()
+    assert [message[0] for message in messages] == [outbox_id]
+    with app.app_context():
+        message = db.session.get(Outbox, outbox_id)
+        assert message.status == 'sending' and message.lease_expires_at > datetime.utcnow()
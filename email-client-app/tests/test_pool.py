@@ -0,0 +1,93 @@
+"""
+The pools of logged-in connections (`util.pool.ConnectionPool`): the connections are reused,
+an account gets at most `max_checked_out` of them at once, and they are closed by the closing thread.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.pool import ConnectionPool
+
+
+class FakePool(ConnectionPool):
+    """ Connections that are numbers (the opened and the closed ones are recorded) """
+
+    def __init__(self, max_per_user=1, max_total=None, max_checked_out=2, checkout_timeout=5):
+        super().__init__(max_per_user, max_total, idle_timeout=60, check_after=60,
+                         max_checked_out=max_checked_out, checkout_timeout=checkout_timeout)
+        self.opened = []
+        self.closed = []
+        self.closed_by = set()
+
+    def _open(self, email, password):
+        self.opened.append(email)
+        return len(self.opened)
+
+    def _is_alive(self, connection):
+        return True
+
+    def _close(self, connection):
+        self.closed.append(connection)
+        self.closed_by.add(threading.current_thread().name)
+
+    def wait_closed(self):
+        self._to_close.join()
+
+
+def test_reused_and_evicted():
+    pool = FakePool(max_per_user=1, max_total=1)
+    with pool.connection('a@example.com', 'password') as connection:
+        assert connection == 1
+    with pool.connection('a@example.com', 'password') as connection:
+        assert connection == 1  # (from the pool)
+    first, second = pool.acquire('a@example.com', 'password'), pool.acquire('a@example.com', 'password')
+    pool.release(first, 'a@example.com', 'password')
+    pool.release(second, 'a@example.com', 'password')  # (only one is kept)
+    with pool.connection('b@example.com', 'password'):
+        pass  # (and one of all the accounts)
+    pool.wait_closed()
+    assert pool.closed == [1, 2] and pool.closed_by == {'pool-closer'}
+    assert pool.stats()['evictions'] == 2 and pool.stats()['idle_connections'] == 1
+
+
+def test_changed_password_and_broken_connection():
+    pool = FakePool()
+    with pool.connection('a@example.com', 'password'):
+        pass
+    with pytest.raises(ValueError):
+        with pool.connection('a@example.com', 'new password') as connection:
+            assert connection == 2  # (not the one logged in with the old password)
+            raise ValueError
+    pool.wait_closed()
+    assert sorted(pool.closed) == [1, 2]  # (and the broken one isn't returned to the pool)
+    assert pool.stats()['idle_connections'] == 0
+
+
+def test_checked_out_connections_are_limited():
+    pool = FakePool(max_checked_out=2, checkout_timeout=0.1)
+    first, second = pool.acquire('a@example.com', 'password'), pool.acquire('a@example.com', 'password')
+    with pytest.raises(TimeoutError):
+        pool.acquire('a@example.com', 'password')
+    pool.release(pool.acquire('b@example.com', 'password'), 'b@example.com', 'password')  # (another account)
+
+    pool.checkout_timeout = 5
+    acquired = []
+    waiting = threading.Thread(target=lambda: acquired.append(pool.acquire('a@example.com', 'password')))
+    waiting.start()
+    pool.discard(first, 'a@example.com')
+    waiting.join(5)
+    assert acquired and acquired[0] not in (first, second)
+    assert pool.stats()['checkout_waits'] == 2
+
+    pool.release(second, 'a@example.com', 'password')
+    pool.release(acquired[0], 'a@example.com', 'password')
+    with pytest.raises(ValueError):
+        pool.release(first, 'a@example.com', 'password')  # (given back twice)
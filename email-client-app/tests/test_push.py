@@ -0,0 +1,98 @@
+"""
+The push of the changes (`util.push`): the IDLE listener waits in IDLE if the server supports it,
+and polls with NOOP if it doesn't; the events of a user reach all the user's event streams.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.push import EventBroker, IdleListener, event_stream
+
+
+class FakeMailBox:
+    """ A connection where a message arrives with every IDLE / NOOP """
+
+    def __init__(self, capabilities):
+        self.sync_capabilities = set(capabilities)
+        self.folder = self
+        self.client = self
+        self.idle = self
+        self.untagged_responses = {}
+        self.commands = []
+
+    def set(self, folder, readonly=False):
+        self.commands.append('SELECT')
+
+    def wait(self, timeout):
+        self.commands.append('IDLE')
+        time.sleep(0.01)
+        return [b'* 1 RECENT', b'* 36 EXISTS']
+
+    def noop(self):
+        self.commands.append('NOOP')
+        self.untagged_responses['EXISTS'] = [b'36']
+        return 'OK', [b'NOOP completed']
+
+
+class FakePool:
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.mailboxes = []
+        self.discarded = []
+
+    def acquire(self, email, password):
+        self.mailboxes.append(FakeMailBox(self.capabilities))
+        return self.mailboxes[-1]
+
+    def discard(self, mailbox, email):
+        self.discarded.append(mailbox)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('capabilities, mode, command', [({'IMAP4REV1', 'IDLE'}, 'idle', 'IDLE'),
+                                                         ({'IMAP4REV1'}, 'poll', 'NOOP')])
+def test_idle_or_polling(capabilities, mode, command):
+    pool = FakePool(capabilities)
+    changes = []
+    listener = IdleListener(pool, lambda email, folder: changes.append((email, folder)), max_connections=1,
+                            poll_interval=0.01)
+    assert listener.watch('a@example.com', 'password')
+    assert not listener.watch('b@example.com', 'password')  # (the connection limit)
+    wait_for(lambda: len(changes) >= 3)  # (the first one - after SELECT)
+    assert set(changes) == {('a@example.com', 'inbox')}
+    mailbox, = pool.mailboxes
+    assert (mailbox.commands[0], mailbox.commands[1]) == ('SELECT', command)
+    assert listener.stats() == {'watched': 1, 'idle': mode == 'idle', 'polling': mode == 'poll',
+                                'max_connections': 1}
+    listener.unwatch('a@example.com')
+    wait_for(lambda: pool.discarded == [mailbox])  # (the connection isn't returned to the pool)
+    assert listener.stats()['watched'] == 0
+
+
+def test_events_of_every_stream():
+    broker = EventBroker()
+    first, second = broker.subscribe('a@example.com'), broker.subscribe('a@example.com')
+    other = broker.subscribe('b@example.com')
+    broker.publish('a@example.com', {'type': 'new_messages', 'folder': 'inbox'})
+    broker.close('a@example.com')
+    assert broker.n_subscribers('a@example.com') == 2
+    for subscription in (first, second):
+        assert list(event_stream(subscription)) == [
+            'retry: 5000\n\n', 'event: new_messages\ndata: {"type": "new_messages", "folder": "inbox"}\n\n']
+    assert other.empty()
+    assert broker.unsubscribe('a@example.com', first) == 1
+    assert broker.unsubscribe('a@example.com', second) == 0
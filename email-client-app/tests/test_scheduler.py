@@ -0,0 +1,74 @@
+"""
+The sync jobs of the logged-in accounts (`util.scheduler.SyncScheduler`): a folder the user is looking at
+is synced before the periodic jobs, and an account waits after its jobs fail (longer after each failure).
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.scheduler import SyncScheduler
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_requested_folder_first():
+    started = []
+    blocked = threading.Event()
+
+    def sync_job(email, password, folder):
+        started.append((email, folder))
+        if email == 'a@example.com':
+            blocked.wait(10)
+
+    scheduler = SyncScheduler(sync_job, workers=1, interval=60)
+    try:
+        scheduler.add_account('a@example.com', 'password')
+        wait_for(lambda: started)  # (the only worker is busy with it)
+        scheduler.add_account('b@example.com', 'password')
+        scheduler.request_sync('b@example.com', 'inbox')
+        scheduler.request_sync('b@example.com', 'inbox')  # (already waiting)
+        assert scheduler.status('b@example.com')['pending'] == 2
+        blocked.set()
+        wait_for(lambda: len(started) == 3)
+        assert started == [('a@example.com', None), ('b@example.com', 'inbox'), ('b@example.com', None)]
+        with pytest.raises(KeyError):
+            scheduler.request_sync('c@example.com', 'inbox')
+    finally:
+        scheduler.stop()
+
+
+def test_backoff_after_failure():
+    started = []
+
+    def sync_job(email, password, folder):
+        started.append(time.monotonic())
+        if len(started) == 1:
+            raise ConnectionError('Server unavailable')
+
+    scheduler = SyncScheduler(sync_job, workers=2, interval=60, max_backoff=0.3)
+    try:
+        scheduler.add_account('a@example.com', 'password')
+        wait_for(lambda: scheduler.status('a@example.com')['failures'] == 1)
+        assert scheduler.status('a@example.com')['last_error'] == 'Server unavailable'
+        scheduler.request_sync('a@example.com', 'inbox')
+        wait_for(lambda: len(started) == 2)
+        assert started[1] - started[0] >= 0.25  # (min(60 * 2, 0.3) seconds after the failure)
+        wait_for(lambda: scheduler.status('a@example.com')['running'] == 0)
+        status = scheduler.status('a@example.com')
+        assert (status['failures'], status['last_error'], list(status['synced_at'])) == (0, None, ['inbox'])
+    finally:
+        scheduler.stop()
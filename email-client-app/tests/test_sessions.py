@@ -0,0 +1,83 @@
+"""
+The server-side sessions (`util.sessions`): the cookie holds only the session id, the id changes
+on the log in (the old one isn't valid anymore), and the session is deleted on the log out.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+from flask import Flask, session
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.sessions import ServerSideSessionInterface, create_session_store
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def client(request, tmp_path):
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.secret_key = 'secret'
+    app.session_interface = ServerSideSessionInterface(create_session_store(request.param, str(tmp_path)))
+
+    @app.route('/visit')
+    def visit():
+        session['visits'] = session.get('visits', 0) + 1
+        return ''
+
+    @app.route('/login')
+    def login():
+        app.session_interface.regenerate(session)
+        session['email'] = 'user@example.com'
+        return ''
+
+    @app.route('/whoami')
+    def whoami():
+        return session.get('email', '')
+
+    @app.route('/logout')
+    def logout():
+        session.clear()
+        return ''
+
+    return app.test_client()
+
+
+def session_id(client):
+    cookie = client.get_cookie('session')
+    return None if cookie is None else cookie.value
+
+
+def test_new_id_on_log_in(client):
+    client.get('/visit')
+    before = session_id(client)
+    assert before and 'visits' not in before  # (only the id is in the cookie)
+
+    client.get('/login')
+    after = session_id(client)
+    assert after != before
+    assert client.get('/whoami').text == 'user@example.com'
+
+    client.set_cookie('session', before)  # (the id known before the log in)
+    assert client.get('/whoami').text == ''
+    client.set_cookie('session', after)
+    assert client.get('/whoami').text == 'user@example.com'
+
+    client.get('/logout')
+    assert session_id(client) is None
+    client.set_cookie('session', after)
+    assert client.get('/whoami').text == ''
+
+
+def test_unchanged_session_is_not_written(client):
+    client.get('/login')
+    store = client.application.session_interface.store
+    writes = []
+    store.set = lambda *args: writes.append(args)
+    client.get('/whoami')
+    assert writes == []  # (only read - less than half of its lifetime has passed)
+    client.get('/visit')
+    assert len(writes) == 1
@@ -0,0 +1,56 @@
+"""
+The startup of the app (app.py): importing it builds the objects only - no files, no database, no optional
+modules - and `create_app` refuses to start until the schema is created by `flask --app app migrate`.
+(every step runs in a new process - the app is a module with its objects)
+
+Usage:
+    python -m pytest tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFERRED_MODULES = ['wtforms', 'flask_mail', 'util.async_sync']
+
+START = f'''
+import json, os, sys
+import app
+imported = [name for name in {DEFERRED_MODULES!r} if name in sys.modules]
+files = sorted(os.listdir(app.app.instance_path)) if os.path.exists(app.app.instance_path) else []
+try:
+    app.create_app()
+    error = None
+except RuntimeError as e:
+    error = str(e)
+status = app.app.test_client().get('/login').status_code if error is None else None
+print(json.dumps({{'imported': imported, 'files': files, 'error': error, 'status': status,
+                   'imported_by_login': [name for name in {DEFERRED_MODULES!r} if name in sys.modules]}}))
+'''
+
+
+def run(instance_path, *args):
+    environment = dict(os.environ, INSTANCE_PATH=str(instance_path), PYTHONPATH=APP_DIR)
+    environment.pop('DATABASE_URL', None)
+    environment.pop('IMAP_ENGINE', None)
+    return subprocess.run(args, cwd=APP_DIR, env=environment, capture_output=True, text=True, timeout=60, check=True)
+
+
+def start(instance_path):
+    return json.loads(run(instance_path, sys.executable, '-c', START).stdout.splitlines()[-1])
+
+
+def test_import_and_migrate(tmp_path):
+    instance_path = tmp_path / 'instance'
+    result = start(instance_path)
+    assert (result['imported'], result['files']) == ([], [])
+    assert 'has no schema' in result['error'] and 'migrate' in result['error']
+
+    run(instance_path, sys.executable, '-m', 'flask', '--app', 'app', 'migrate')
+    run(instance_path, sys.executable, '-m', 'flask', '--app', 'app', 'migrate')  # (nothing to do)
+    result = start(instance_path)
+    assert (result['imported'], result['error'], result['status']) == ([], None, 200)
+    assert 'wtforms' in result['imported_by_login']  # (by the first request of the log in page)
+    assert 'secret_key' in os.listdir(instance_path)
@@ -0,0 +1,100 @@
+"""
+The write jobs of the sync (`util.sync.SyncEngine`): the counters of the folders and of the threads
+stay right when the same change is saved more than once, and when a message is opened (`fetch_body`).
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+from util.attachment_store import AttachmentStore
+from util.conversations import ThreadIndex
+from util.database import get_models
+from util.message_store import RawMessageStore
+from util.migrations import upgrade_schema
+from util.sync import SyncEngine, flag_changes
+
+
+@pytest.fixture
+def sync(tmp_path):
+    """ (app, models, SyncEngine, the folder's id) - with 3 unread emails in one thread """
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "emails.db"}'
+    models = get_models(app)
+    (db, Email, Folder, Attachment, User, Outbox, EmailBody, CompressionDictionary,
+     MessageThread, ThreadFolder, ThreadReference) = models
+    with app.app_context():
+        upgrade_schema(db)
+        user = User(username='user@example.com')
+        db.session.add(user)
+        db.session.flush()
+        folder = Folder(owner_id=user.id, name='inbox', server_name='INBOX', uidnext=100)
+        db.session.add(folder)
+        db.session.commit()
+        engine = SyncEngine(db, Email, Folder, Attachment, EmailBody, AttachmentStore(str(tmp_path / 'attachments')),
+                            RawMessageStore(str(tmp_path / 'messages')),
+                            thread_index=ThreadIndex(db, Email, MessageThread, ThreadFolder, ThreadReference))
+        rows = [{'uid': uid, 'date': datetime(2024, 1, uid), 'from_': 'a@example.com', 'to': 'user@example.com',
+                 'subject': 'Hello', 'flags': '', 'size': 100, 'body_fetched': False,
+                 'message_id': f'<{uid}@example.com>', 'references': '<1@example.com>' if uid > 1 else None}
+                for uid in (1, 2, 3)]
+        engine.write(engine._store_new_messages, folder.folder_id, rows)
+        yield app, models, engine, folder.folder_id
+
+
+def counters(models, folder_id):
+    db, Folder, MessageThread = models[0], models[2], models[8]
+    db.session.expire_all()
+    thread = db.session.execute(db.select(MessageThread)).scalar_one()
+    return db.session.get(Folder, folder_id).n_unread, thread.n_unread
+
+
+def test_flag_change_saved_twice(sync):
+    app, models, engine, folder_id = sync
+    with app.app_context():
+        folder = engine.db.session.get(models[2], folder_id)
+        assert counters(models, folder_id) == (3, 3)
+        # (the same change fetched by two syncs, before either of them has saved it)
+        changes = flag_changes(engine._local_flags(folder), {1: '\\Seen', 2: ''})
+        again = flag_changes(engine._local_flags(folder), {1: '\\Seen', 2: ''})
+        assert engine.write(engine._store_flag_changes, folder_id, changes) == [1]
+        assert engine.write(engine._store_flag_changes, folder_id, again) == []
+        assert counters(models, folder_id) == (2, 2)
+
+        changes = flag_changes(engine._local_flags(folder), {1: '', 3: '\\Seen \\Flagged'})
+        assert sorted(engine.write(engine._store_flag_changes, folder_id, changes)) == [1, 3]
+        assert counters(models, folder_id) == (2, 2)
+
+
+class FakeMailBox:
+    """ The server's answer to the FETCH of a whole message (its flags are \\Seen there now) """
+    RAW = b'From: a@example.com\r\nTo: user@example.com\r\nSubject: Hello\r\n\r\nHi there\r\n'
+
+    def __init__(self):
+        self.folder = self
+        self.client = self
+
+    def set(self, folder, readonly=False):
+        pass
+
+    def uid(self, command, uid, items):
+        header = f'1 (UID {uid} FLAGS (\\Seen) RFC822.SIZE {len(self.RAW)} BODY[] {{{len(self.RAW)}}}'
+        return 'OK', [(header.encode(), self.RAW), b')']
+
+
+def test_opened_message_is_read(sync):
+    app, models, engine, folder_id = sync
+    db, Email = models[0], models[1]
+    with app.app_context():
+        email = db.session.execute(db.select(Email).where(Email.uid == 2)).scalar_one()
+        engine.fetch_body(FakeMailBox(), email.folder, email)
+        assert (email.flags, email.body_fetched, email.text.strip()) == ('\\Seen', True, 'Hi there')
+        assert counters(models, folder_id) == (2, 2)
@@ -1,5 +1,6 @@
-from .configs import IMAP_CONFIGS, SUPPORTED_EMAIL_PROVIDERS, DEFAULT_FOLDERS
-from imap_tools import MailBox, MailboxLoginError
+from .configs import SUPPORTED_EMAIL_PROVIDERS, DEFAULT_FOLDERS
+from .pool import connect_imap
+from imap_tools import MailboxLoginError
 
 
 def create_folder_mapping(email_provider, server_folders):
@@ -30,44 +31,65 @@ def create_folder_mapping(email_provider, server_folders):
             name = server_folder.name
             if name not in UKR_NET_NAMES:
                 folder_mapping[name] = name
+    else:
+        # (any other server - by the SPECIAL-USE flags of its folders, RFC 6154)
+        SPECIAL_USE = {'\\Sent': 'sent', '\\Drafts': 'drafts', '\\Trash': 'bin'}
+        for server_folder in server_folders:
+            name = server_folder.name
+            special_use = next((SPECIAL_USE[flag] for flag in server_folder.flags if flag in SPECIAL_USE), None)
+            if name.upper() == 'INBOX':
+                folder_mapping['inbox'] = name
+            elif special_use is not None:
+                folder_mapping.setdefault(special_use, name)
+            else:
+                folder_mapping[name] = name
     return folder_mapping
 
 
-def get_mailbox_folder_mapping(mailbox):
-    host = mailbox._get_mailbox_client().host
+def get_email_provider(host):
+    """ The email provider (as in the configs) of the IMAP server's host """
     if 'ukr.net' in host:
         host = 'ukr.net'
     elif 'gmail.com' in host:
         host = 'gmail.com'
-    email_provider = host.split('@')[-1]
+    return host.split('@')[-1]
+
+
+def get_mailbox_folder_mapping(mailbox):
+    """ Request the folder list from the server (IMAP LIST), and create the folder mapping """
+    email_provider = get_email_provider(mailbox.client.host)
     server_folders = mailbox.folder.list()
     folder_mapping = create_folder_mapping(email_provider, server_folders)
     return folder_mapping
 
 
-def get_user_folders(mailbox):
+def get_user_folders(folder_mapping):
     """ Return a list of only user folders """
-    folder_mapping = get_mailbox_folder_mapping(mailbox)
     user_folders = [folder for folder in folder_mapping if folder not in DEFAULT_FOLDERS]
     return user_folders
 
 
-def client_to_server_folder_name(client_folder, mailbox):
+def client_to_server_folder_name(client_folder, folder_mapping):
     """ Convert a single client folder name -> to server folder name """
-    folder_mapping = get_mailbox_folder_mapping(mailbox)
     return folder_mapping[client_folder]
 
 
-def are_credentials_valid(email, password):
+def are_credentials_valid(email, password, mailbox_pool=None):
+    """
+    Try to log in to the IMAP server.
+    If `mailbox_pool` is given - the logged-in connection stays in the pool,
+    so the next request of this user can reuse it.
+    """
     if not email or not password:
         return False
     email_provider = email.split('@')[-1]
     if email_provider not in SUPPORTED_EMAIL_PROVIDERS:
         return False
-    host = IMAP_CONFIGS[email_provider]['MAIL_SERVER']
-    port = IMAP_CONFIGS[email_provider]['MAIL_PORT']
     try:
-        with MailBox(host=host, port=port).login(email, password):
+        if mailbox_pool is not None:
+            with mailbox_pool.connection(email, password):
+                return True
+        with connect_imap(email, password):
             return True
     except MailboxLoginError:
         return False
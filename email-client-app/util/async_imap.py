@@ -0,0 +1,210 @@
+"""A minimal asyncio IMAP4rev1 client: the commands of a connection can be pipelined"""
+
+import asyncio
+import re
+import ssl
+from collections import deque, namedtuple
+from imap_tools import FolderInfo
+from imap_tools.imap_utf7 import utf7_decode
+from imap_tools.utils import encode_folder
+
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}\r\n$')
+LIST_ITEM_RE = re.compile(r'\((?P<flags>[\S ]*?)\) (?P<delim>\S+) (?P<name>.+)')
+MAX_LINE_LENGTH = 16 * 1024 * 1024  # (the answer of UID SEARCH ALL is one line - e.g. 700 KB for 100k messages)
+
+# The answer of a command:
+# typ - 'OK' / 'NO' / 'BAD'; text - the text of the tagged response;
+# responses - its untagged responses (without "* "), each one a list in the layout of `imaplib`:
+#             [b'line'], or [(b'line ... {size}', b'literal'), b'rest of the line'] (for FETCH)
+IMAPResult = namedtuple('IMAPResult', ['typ', 'responses', 'text'])
+
+
+class AsyncIMAPError(Exception):
+    pass
+
+
+def quote(string):
+    return '"' + string.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def folder_argument(server_folder):
+    """ The name of a folder as a command argument (modified UTF-7, quoted) """
+    return encode_folder(server_folder).decode()
+
+
+def first_line(response):
+    """ The first line of an untagged response (without its literal) """
+    return response[0][0] if type(response[0]) is tuple else response[0]
+
+
+def untagged(result, name):
+    """ The untagged responses of one kind: e.g. 'STATUS', 'LIST', or 'FETCH' ("* 12 FETCH (...)") """
+    name = name.encode()
+    selected = []
+    for response in result.responses:
+        words = first_line(response).split(b' ', 2)
+        if words[0].upper() == name or (len(words) > 1 and words[0].isdigit() and words[1].upper() == name):
+            selected.append(response)
+    return selected
+
+
+def fetch_data(result):
+    """ The FETCH responses, flattened - as `imaplib` returns them (for `MailMessage`, `parse_fetched_flags`) """
+    return [part for response in untagged(result, 'FETCH') for part in response]
+
+
+def parse_list(result):
+    """ The LIST responses -> [`FolderInfo`, ...] (like `mailbox.folder.list()`) """
+    folders = []
+    for response in untagged(result, 'LIST'):
+        match = LIST_ITEM_RE.search(utf7_decode(first_line(response)[len(b'LIST '):]))
+        if not match:
+            continue
+        name = match.group('name')
+        if type(response[0]) is tuple:
+            name = utf7_decode(response[0][1])  # (a name with " or \\ in it - sent as a literal)
+        elif name.startswith('"') and name.endswith('"'):
+            name = name[1:-1]
+        folders.append(FolderInfo(name=name.replace('\\"', '"'),
+                                  delim=match.group('delim').replace('"', ''),
+                                  flags=tuple(match.group('flags').split())))
+    return folders
+
+
+class AsyncIMAPClient:
+    """
+    One IMAP connection on asyncio streams.
+
+    The commands can be pipelined - sent one after another without waiting for the answers
+    (they are answered in order, in one round trip):
+        futures = [client.send('STATUS', folder_argument(name), '(MESSAGES UIDNEXT)') for name in folders]
+        results = await client.gather(futures)
+    `command(...)` - send one command and wait for its answer.
+
+    The untagged responses are given to the oldest command that is not answered yet
+    (a server answers the commands in order - so they are the answers of that command).
+    """
+
+    def __init__(self, reader, writer, timeout=60):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout  # seconds to wait for the answers
+        self.host = None
+        self.capabilities = set()
+        self._tag = 0
+        self._pending = deque()  # [(tag, future, responses), ...] - in the order they were sent
+        self._error = None  # (the connection has failed - every command fails with this)
+        self._reader_task = None
+
+    @classmethod
+    async def connect(cls, host, port, use_ssl=True, timeout=60):
+        """ Open a connection (TLS by default) and read the greeting of the server """
+        context = ssl.create_default_context() if use_ssl else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context, limit=MAX_LINE_LENGTH), timeout)
+        client = cls(reader, writer, timeout)
+        client.host = host
+        greeting = await asyncio.wait_for(reader.readuntil(b'\r\n'), timeout)
+        if not greeting.startswith(b'* OK') and not greeting.startswith(b'* PREAUTH'):
+            writer.close()
+            raise AsyncIMAPError(f'Unexpected greeting: {greeting!r}')
+        client._reader_task = asyncio.create_task(client._read_responses())
+        return client
+
+    @property
+    def closed(self):
+        return self._error is not None or self.writer.is_closing()
+
+    async def login(self, user, password):
+        result = await self.command('LOGIN', quote(user), quote(password))
+        if result.typ != 'OK':
+            raise AsyncIMAPError(f'LOGIN failed: {result.text}')
+        result = await self.command('CAPABILITY')
+        for response in untagged(result, 'CAPABILITY'):
+            self.capabilities = set(first_line(response).decode().upper().split()[1:])
+        return self
+
+    def send(self, *words):
+        """ Send a command (without waiting). Returns the future of its `IMAPResult` """
+        future = asyncio.get_running_loop().create_future()
+        if self._error is not None:
+            future.set_exception(self._error)
+            return future
+        self._tag += 1
+        tag = f'A{self._tag}'
+        self._pending.append((tag, future, []))
+        self.writer.write(f'{tag} {" ".join(words)}\r\n'.encode())
+        return future
+
+    async def gather(self, futures):
+        """ Wait for the answers of the sent commands """
+        await self.writer.drain()
+        return await asyncio.wait_for(asyncio.gather(*futures), self.timeout)
+
+    async def command(self, *words):
+        return (await self.gather([self.send(*words)]))[0]
+
+    async def logout(self):
+        try:
+            if not self.closed:
+                await self.command('LOGOUT')
+        except (AsyncIMAPError, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self.writer.close()
+        self._fail(AsyncIMAPError('The connection is closed'))
+
+    async def _read_responses(self):
+        """ (a task per connection) Read the responses, and give them to their commands """
+        try:
+            while True:
+                line = await self.reader.readuntil(b'\r\n')
+                response = []
+                literal = LITERAL_RE.search(line)
+                while literal:
+                    response.append((line[:-2], await self.reader.readexactly(int(literal.group(1)))))
+                    line = await self.reader.readuntil(b'\r\n')
+                    literal = LITERAL_RE.search(line)
+                response.append(line[:-2])
+                self._dispatch(response)
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError) as e:
+            self._fail(AsyncIMAPError(f'The connection was lost: {e}'))
+
+    def _dispatch(self, response):
+        line = first_line(response)
+        if line.startswith(b'* '):
+            if type(response[0]) is tuple:
+                response[0] = (response[0][0][2:], response[0][1])
+            else:
+                response[0] = line[2:]
+            if self._pending:
+                self._pending[0][2].append(response)
+            return  # (an unsolicited response - e.g. about the other folder changes - is not needed)
+        if line.startswith(b'+'):
+            return  # (no command here sends a literal)
+        tag, _, rest = line.decode(errors='replace').partition(' ')
+        typ, _, text = rest.partition(' ')
+        while self._pending:
+            pending_tag, future, responses = self._pending.popleft()
+            if pending_tag == tag:
+                if not future.done():
+                    future.set_result(IMAPResult(typ.upper(), responses, text))
+                return
+            if not future.done():  # (answered out of order - can't be, but it's not left waiting)
+                future.set_exception(AsyncIMAPError(f'{pending_tag} was not answered'))
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        while self._pending:
+            _, future, _ = self._pending.popleft()
+            if not future.done():
+                future.set_exception(self._error)
@@ -0,0 +1,333 @@
+"""Sync of many accounts in one process: their IMAP commands are pipelined, on one asyncio event loop"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from imap_tools import MailMessage
+
+from .actions import create_folder_mapping, get_email_provider
+from .async_imap import AsyncIMAPClient, AsyncIMAPError, fetch_data, first_line, folder_argument, parse_list, untagged
+from .conversations import THREAD_HEADER_FIELDS
+from .ingest import batched
+from .pool import get_imap_server
+from .sync import (STATUS_ITEM_RE, flag_changes, may_have_expunged, parse_fetched_flags, parse_fetched_thread_headers,
+                   parse_searched_uids)
+
+
+# (the same parts as `mailbox.fetch(headers_only=True, mark_seen=False)`)
+MESSAGE_PARTS = '(BODY.PEEK[HEADER] UID FLAGS RFC822.SIZE)'
+
+# The sync state of a `Folder` row (read in a database thread, used on the event loop):
+FolderState = namedtuple('FolderState', ['folder_id', 'owner_id', 'name', 'server_name',
+                                         'uidvalidity', 'uidnext', 'highestmodseq', 'n_server_messages'])
+
+
+class AsyncSyncEngine:
+    """
+    Syncs the folders of the accounts like `SyncEngine.sync_folder` does, but the IMAP side
+    runs on one asyncio event loop (in its own thread) - so one process can keep many accounts
+    up to date, without a thread (and a blocking connection) per account being synced.
+
+    - every account has one connection (kept open between its syncs, closed after `idle_timeout` seconds),
+      at most `max_connections` accounts are synced at the same time
+    - the commands of a sync are pipelined - all the folders of an account take 2 round trips:
+      1. STATUS of every folder
+      2. for every folder that has changed: EXAMINE + its fetches (new messages, flags, threading headers)
+         and the search of the expunged messages (if the number of the messages doesn't add up)
+    - the answers are stored by the write jobs of the `sync_engine` (the same as in `sync_folder`),
+      run from a pool of `db_workers` threads (the database is not async)
+
+    Usage (from any thread, e.g. the workers of the `SyncScheduler`):
+        summaries = async_sync_engine.sync_account(email, password)  # {folder name: summary}
+    """
+
+    def __init__(self, app, sync_engine, folder_cache, User, connect=None, max_connections=100, db_workers=4,
+                 timeout=60, idle_timeout=300):
+        self.app = app
+        self.sync_engine = sync_engine
+        self.db = sync_engine.db
+        self.Folder = sync_engine.Folder
+        self.folder_cache = folder_cache
+        self.User = User
+        # (coroutine function: email -> connected `AsyncIMAPClient`, not logged in yet)
+        self.connect = connect or self._connect
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._accounts = {}  # email -> {'client', 'password', 'lock', 'last_used'} (used on the event loop only)
+        self._semaphore = asyncio.Semaphore(max_connections)
+        self._executor = concurrent.futures.ThreadPoolExecutor(db_workers, thread_name_prefix='async-sync-db')
+        self._loop = None
+        self._idle_task = None
+        self._lock = threading.Lock()
+
+    def submit(self, email, password, folder=None):
+        """
+        Start the sync of the account (`folder` - one client folder name, None - all its folders).
+        Returns a `concurrent.futures.Future` of {folder name: summary (see `SyncEngine.sync_folder`)}
+        """
+        return asyncio.run_coroutine_threadsafe(self._sync_account(email, password, folder), self._start())
+
+    def sync_account(self, email, password, folder=None):
+        """ Sync the account, and wait for it (see `submit`) """
+        return self.submit(email, password, folder).result()
+
+    def stop(self):
+        """ Log out of all the connections, and stop the event loop """
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        self._idle_task.cancel()
+        asyncio.run_coroutine_threadsafe(self._close_connections(), loop).result(self.timeout)
+        loop.call_soon_threadsafe(loop.stop)
+        self._executor.shutdown()
+
+    def _start(self):
+        """ The event loop (its thread is started by the first sync) """
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='async-sync', daemon=True).start()
+                self._idle_task = asyncio.run_coroutine_threadsafe(self._close_idle_connections(), self._loop)
+            return self._loop
+
+
+    # Run on the event loop:
+
+    async def _sync_account(self, email, password, folder_name):
+        account = self._accounts.setdefault(email, {'client': None, 'password': None,
+                                                    'lock': asyncio.Lock(), 'last_used': 0})
+        async with self._semaphore, account['lock']:
+            client = account['client']
+            if client is None or client.closed or account['password'] != password:
+                if client is not None:
+                    client.close()
+                account['client'] = None
+                client = await self.connect(email)
+                try:
+                    await client.login(email, password)
+                except BaseException:
+                    client.close()
+                    raise
+                account['client'], account['password'] = client, password
+            try:
+                return await self._sync(client, email, folder_name)
+            except BaseException:
+                # (the connection could be in the middle of an answer - it's not used again)
+                client.close()
+                account['client'] = None
+                raise
+            finally:
+                account['last_used'] = time.monotonic()
+
+    async def _sync(self, client, email, folder_name):
+        owner_id, folder_mapping = await self._run(self._cached_folder_mapping, email)
+        if folder_mapping is None:
+            folder_mapping = await self._list_folders(client)
+            await self._run(self._store_folder_mapping, owner_id, folder_mapping)
+        folders = await self._run(self._folder_states, owner_id, folder_name)
+
+        # Round trip 1 - has anything changed:
+        options = 'MESSAGES UIDNEXT UIDVALIDITY UNSEEN'
+        if 'CONDSTORE' in client.capabilities:
+            options += ' HIGHESTMODSEQ'
+        results = await client.gather([client.send('STATUS', folder_argument(folder.server_name), f'({options})')
+                                       for folder in folders])
+        plans = [self._plan(folder, parse_status(result, folder)) for folder, result in zip(folders, results)]
+        plans = await self._run(self._load_local_state, plans)
+
+        # Round trip 2 - the fetches of all the changed folders:
+        sent = [self._send_fetches(client, plan) for plan in plans]
+        await client.gather([future for futures in sent for future in iter_futures(futures)])
+
+        summaries = {}
+        for plan, futures in zip(plans, sent):
+            results = {name: future.result() for name, future in futures.items() if name != 'threads'}
+            for name in ('examine', 'new'):
+                if name in results and results[name].typ != 'OK':
+                    raise AsyncIMAPError(f'{name.upper()} in "{plan["folder"].name}" failed: {results[name].text}')
+            results['threads'] = [(batch, future.result()) for batch, future in futures.get('threads', [])]
+            summaries[plan['folder'].name] = await self._run(self._store, plan, results)
+        return summaries
+
+    def _plan(self, folder, status):
+        """ What has to be done with the folder - the same decisions as in `SyncEngine.sync_folder` """
+        highestmodseq = status.get('HIGHESTMODSEQ')
+        full_resync = folder.uidvalidity != status['UIDVALIDITY']
+        unchanged = (not full_resync and folder.uidnext == status['UIDNEXT']
+                     and folder.n_server_messages == status['MESSAGES']
+                     and (highestmodseq is None or folder.highestmodseq == highestmodseq))
+        expunged = not full_resync and may_have_expunged(folder, status)
+        return {'folder': folder, 'status': status, 'full_resync': full_resync, 'unchanged': unchanged,
+                'expunged': expunged, 'local': {}, 'thread_uids': []}
+
+    def _send_fetches(self, client, plan):
+        """ Send the commands the folder needs (without waiting). Returns {name: future} """
+        folder, status = plan['folder'], plan['status']
+        futures = {}
+        if plan['unchanged'] and not plan['thread_uids']:
+            return futures
+        futures['examine'] = client.send('EXAMINE', folder_argument(folder.server_name))
+
+        # New messages:
+        if plan['full_resync']:
+            if status['MESSAGES']:
+                # (the newest `n_initial` - by their sequence numbers)
+                first = max(1, status['MESSAGES'] - self.sync_engine.n_initial + 1)
+                futures['new'] = client.send('FETCH', f'{first}:*', MESSAGE_PARTS)
+        elif status['UIDNEXT'] != folder.uidnext:
+            futures['new'] = client.send('UID', 'FETCH', f'{folder.uidnext}:*', MESSAGE_PARTS)
+
+        # Messages expunged on the server (the uids of the stored range that are still there):
+        local = plan['local']
+        if local and plan['expunged']:
+            futures['expunged'] = client.send('UID', 'SEARCH', 'UID', f'{min(local)}:{max(local)}')
+
+        # Flag changes of the messages we already have:
+        highestmodseq = status.get('HIGHESTMODSEQ')
+        if local and not plan['unchanged']:
+            if highestmodseq is not None and folder.highestmodseq is not None:
+                if highestmodseq != folder.highestmodseq:
+                    futures['flags'] = client.send('UID', 'FETCH', f'1:{folder.uidnext - 1}', '(UID FLAGS)',
+                                                   f'(CHANGEDSINCE {folder.highestmodseq})')
+            else:
+                futures['flags'] = client.send('UID', 'FETCH', f'{min(local)}:{max(local)}', '(UID FLAGS)')
+
+        # Threading headers of the emails stored before the threading:
+        futures['threads'] = [
+            (batch, client.send('UID', 'FETCH', ','.join(map(str, batch)),
+                                f'(UID BODY.PEEK[HEADER.FIELDS ({THREAD_HEADER_FIELDS})])'))
+            for batch in batched(plan['thread_uids'], self.sync_engine.bulk)]
+        return futures
+
+    async def _list_folders(self, client):
+        """ Request the folder list from the server, and create the folder mapping """
+        result = await client.command('LIST', '""', '"*"')
+        if result.typ != 'OK':
+            raise AsyncIMAPError(f'LIST failed: {result.text}')
+        return create_folder_mapping(get_email_provider(client.host), parse_list(result))
+
+    async def _connect(self, email):
+        host, port, use_ssl = get_imap_server(email)
+        return await AsyncIMAPClient.connect(host, port, use_ssl=use_ssl, timeout=self.timeout)
+
+    async def _run(self, function, *args):
+        """ Run `function(*args)` in a database thread (with app context) """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._in_app_context,
+                                                                function, args)
+
+    async def _close_idle_connections(self):
+        while True:
+            await asyncio.sleep(min(30, self.idle_timeout))
+            now = time.monotonic()
+            for email, account in list(self._accounts.items()):
+                if not account['lock'].locked() and now - account['last_used'] > self.idle_timeout:
+                    del self._accounts[email]
+                    if account['client'] is not None:
+                        await account['client'].logout()
+
+    async def _close_connections(self):
+        accounts, self._accounts = self._accounts, {}
+        await asyncio.gather(*(account['client'].logout() for account in accounts.values()
+                               if account['client'] is not None))
+
+
+    # Run in the database threads:
+
+    def _in_app_context(self, function, args):
+        with self.app.app_context():
+            return function(*args)
+
+    def _cached_folder_mapping(self, email):
+        """ (owner id, the folder mapping - None if it has to be listed on the server) """
+        owner = self.db.session.execute(self.db.select(self.User).where(self.User.username == email)).scalar_one()
+        return owner.id, self.folder_cache.cached(owner)
+
+    def _store_folder_mapping(self, owner_id, folder_mapping):
+        self.folder_cache.store(self.db.session.get(self.User, owner_id), folder_mapping)
+
+    def _folder_states(self, owner_id, folder_name):
+        Folder = self.Folder
+        query = self.db.select(Folder).where(Folder.owner_id == owner_id)
+        if folder_name is not None:
+            query = query.where(Folder.name == folder_name)
+        return [FolderState(folder.folder_id, folder.owner_id, folder.name, folder.server_name,
+                            folder.uidvalidity, folder.uidnext, folder.highestmodseq, folder.n_server_messages)
+                for folder in self.db.session.execute(query).scalars()]
+
+    def _load_local_state(self, plans):
+        """ The stored flags (of the changed folders), and the uids of the emails without a thread """
+        for plan in plans:
+            if plan['full_resync']:
+                continue
+            plan['thread_uids'] = self.sync_engine._unthreaded_uids(plan['folder'])
+            if not plan['unchanged']:
+                plan['local'] = self.sync_engine._local_flags(plan['folder'])
+        return plans
+
+    def _store(self, plan, results):
+        """ Store the answers of the folder's fetches with the write jobs of the sync. Returns its summary """
+        engine = self.sync_engine
+        folder, status = plan['folder'], plan['status']
+        summary = {'new_uids': [], 'changed_uids': [], 'expunged_uids': [], 'full_resync': plan['full_resync']}
+        if plan['full_resync']:
+            engine.write(engine._drop_local_emails, folder.folder_id)
+
+        if 'new' in results:
+            messages = [MailMessage(response) for response in untagged(results['new'], 'FETCH')
+                        if type(response[0]) is tuple]
+            if plan['full_resync']:
+                messages.reverse()  # (the newest first - as `mailbox.fetch(reverse=True)` in `sync_folder`)
+            else:
+                # (`n:*` also matches the last message, if there are no uids >= n)
+                messages = [msg for msg in messages if int(msg.uid) >= folder.uidnext]
+            for batch in batched(messages, engine.bulk):
+                rows = [engine._header_row(msg) for msg in batch]
+                summary['new_uids'].extend(engine.write(engine._store_new_messages, folder.folder_id, rows))
+
+        if 'expunged' in results and results['expunged'].typ == 'OK':
+            server_uids = parse_searched_uids(first_line(response)[len(b'SEARCH'):]
+                                              for response in untagged(results['expunged'], 'SEARCH'))
+            summary['expunged_uids'] = engine.write(engine._store_expunged, folder.folder_id,
+                                                    min(plan['local']), max(plan['local']), server_uids)
+
+        if 'flags' in results and results['flags'].typ == 'OK':
+            changes = flag_changes(plan['local'], parse_fetched_flags(fetch_data(results['flags'])))
+            summary['changed_uids'] = engine.write(engine._store_flag_changes, folder.folder_id, changes)
+
+        for batch, result in results['threads']:
+            headers = parse_fetched_thread_headers(fetch_data(result)) if result.typ == 'OK' else {}
+            # (the messages that are not on the server anymore get a thread of their own)
+            engine.write(engine._store_thread_headers, folder.folder_id, batch, headers)
+
+        if plan['unchanged']:
+            state = {'synced_at': datetime.utcnow()}
+        else:
+            state = {'uidvalidity': status['UIDVALIDITY'],
+                     'uidnext': status['UIDNEXT'],
+                     'highestmodseq': status.get('HIGHESTMODSEQ'),
+                     'n_server_messages': status['MESSAGES'],
+                     'synced_at': datetime.utcnow()}
+        engine.write(engine._save_sync_state, folder.folder_id, state)
+        return summary
+
+
+def parse_status(result, folder):
+    """ The answer of one STATUS command -> {'MESSAGES': 41, 'UIDNEXT': 11996, ...} (see `get_folder_status`) """
+    responses = untagged(result, 'STATUS')
+    if result.typ != 'OK' or not responses:
+        raise AsyncIMAPError(f'STATUS of "{folder.name}" failed: {result.text}')
+    values = first_line(responses[-1]).decode().rsplit('(', 1)[-1]
+    return {name: int(value) for name, value in STATUS_ITEM_RE.findall(values)}
+
+
+def iter_futures(futures):
+    """ All the futures of `_send_fetches` """
+    for name, future in futures.items():
+        if name == 'threads':
+            yield from (thread_future for _, thread_future in future)
+        else:
+            yield future
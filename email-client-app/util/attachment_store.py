@@ -0,0 +1,73 @@
+"""Content-addressed store of the attachment files (a file is stored once, by its SHA-256)"""
+
+import hashlib
+import os
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentStore:
+    """
+    Files are stored as <root>/<first 2 hex digits>/<next 2>/<sha256 of the content>,
+    so the same file (e.g. forwarded many times, or received by many users) is stored once.
+
+    Files are written in chunks to a temporary file (while their hash is computed),
+    and then renamed into place - so a file in the store is always complete,
+    and writing never needs the whole file in memory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def put_chunks(self, chunks):
+        """ Store the content given as an iterable of bytes. Returns (sha256, size) """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            if os.path.exists(path):
+                os.remove(tmp_path)  # (already stored)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return sha256, size
+
+    def put_bytes(self, data):
+        """ Store bytes that are already in memory (e.g. a decoded MIME part) """
+        view = memoryview(data)
+        return self.put_chunks(view[i:i + CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE))
+
+    def put_file(self, file):
+        """ Store a file object (e.g. an upload - `request.files[...]`), reading it in chunks """
+        return self.put_chunks(iter(lambda: file.read(CHUNK_SIZE), b''))
+
+    def open(self, sha256):
+        return open(self.path(sha256), 'rb')
+
+    def discard(self, sha256):
+        """ Delete the file (call only when nothing refers to it anymore) """
+        try:
+            os.remove(self.path(sha256))
+        except FileNotFoundError:
+            pass
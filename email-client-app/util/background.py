@@ -0,0 +1,212 @@
+"""The background work of the app (syncing, IDLE, importing, sending) - done by one of its worker processes"""
+
+import itertools
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+from .file_lock import FileLock
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWork:
+    """
+    Runs the background work in one process, however many worker processes serve the requests
+    (otherwise every worker would sync the same accounts, keep its own IDLE connections, import the same mailboxes).
+
+    The process is elected with the lock of the file `lock_path`: the first one that makes a `call` takes it,
+    and keeps it until it exits (then the next call of another process elects that one).
+    - the elected process runs `handlers[name](*args)` of every call itself, and of the calls of the other
+      processes (it listens on a local socket - its address and key are in the file `address_path`,
+      readable only by the app's user)
+    - the other processes send their calls there (and get the result, or the exception, back)
+    - `publish(email, event)` (in any process) calls `on_event(email, event)` in every process
+      (the event streams of the pages are open in all of them)
+    The accounts that the exited process was syncing are started again by their next request
+    (`activate_account`). Without fcntl / msvcrt every process elects itself (so only one worker process then).
+    """
+
+    def __init__(self, lock_path, address_path, handlers, on_event, timeout=10, retry_interval=0.05):
+        self.address_path = address_path
+        self.handlers = dict(handlers, publish=self._publish_here)
+        self.on_event = on_event
+        self.timeout = timeout  # seconds to wait for the elected process (for its reply)
+        self.retry_interval = retry_interval  # (it may be starting to listen)
+        self._lock = FileLock(lock_path)
+        self._state_lock = threading.Lock()
+        self._elected = False
+        self._connection = None  # to the elected process (in the other processes)
+        self._send_lock = threading.Lock()
+        self._replies = {}  # call id -> {'done': threading.Event, 'result': (ok, value) or None - disconnected}
+        self._call_ids = itertools.count()
+        self._followers = []  # (connection, send lock) of every other process (in the elected process)
+        self._followers_lock = threading.Lock()
+
+    def call(self, name, *args):
+        """ Run the handler in the elected process. Returns its result """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            connection = self._connect(deadline)
+            if connection is None:
+                return self.handlers[name](*args)
+            try:
+                return self._remote_call(connection, name, args, deadline)
+            except ConnectionError:
+                # (the elected process has exited - the call is made again, in the next one)
+                if time.monotonic() > deadline:
+                    raise
+
+    def publish(self, email, event):
+        """ Deliver the event to the user's event streams in all the processes """
+        self.call('publish', email, event)
+
+    def is_elected(self):
+        return self._elected
+
+    def stats(self):
+        with self._followers_lock:
+            n_followers = len(self._followers)
+        return {'elected': self._elected, 'pid': os.getpid(), 'other_processes': n_followers}
+
+    def _connect(self, deadline):
+        """ The connection to the elected process - or None in the elected process (this one is elected if none is) """
+        with self._state_lock:
+            while True:
+                if self._elected:
+                    return None
+                if self._connection is not None:
+                    return self._connection
+                if self._lock.acquire(blocking=False):
+                    self._listen()
+                    self._elected = True
+                    logger.info('Process %s runs the background work', os.getpid())
+                    return None
+                try:
+                    self._connection = self._open_connection()
+                except (OSError, EOFError, ValueError, KeyError, AuthenticationError):
+                    # (it hasn't written its address yet, or the address is of the process that has exited)
+                    if time.monotonic() > deadline:
+                        raise TimeoutError('No process runs the background work')
+                    time.sleep(self.retry_interval)
+                    continue
+                threading.Thread(target=self._receive, args=(self._connection,),
+                                 name='background-receiver', daemon=True).start()
+                return self._connection
+
+    def _open_connection(self):
+        with open(self.address_path) as f:
+            address = json.load(f)
+        return Client(('127.0.0.1', address['port']), authkey=bytes.fromhex(address['key']))
+
+    def _remote_call(self, connection, name, args, deadline):
+        call_id = next(self._call_ids)
+        reply = {'done': threading.Event(), 'result': None}
+        self._replies[call_id] = reply
+        try:
+            try:
+                with self._send_lock:
+                    connection.send((call_id, name, args))
+            except OSError:
+                self._disconnected(connection)
+                raise ConnectionError('The background process has exited')
+            if not reply['done'].wait(max(0, deadline - time.monotonic())):
+                raise TimeoutError(f'No reply of the background process to {name!r}')
+        finally:
+            self._replies.pop(call_id, None)
+        if reply['result'] is None:
+            raise ConnectionError('The background process has exited')
+        ok, value = reply['result']
+        if not ok:
+            raise value
+        return value
+
+    # Run by the receiver thread (in the other processes):
+
+    def _receive(self, connection):
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'event':
+                    self.on_event(*message[1:])
+                    continue
+                _, call_id, ok, value = message
+                reply = self._replies.get(call_id)
+                if reply is not None:
+                    reply['result'] = (ok, value)
+                    reply['done'].set()
+        except (OSError, EOFError):
+            self._disconnected(connection)
+        # (the next process is elected now - so the events of the pages of this process keep coming)
+        try:
+            self._connect(time.monotonic() + self.timeout)
+        except TimeoutError:
+            logger.warning('No process runs the background work')
+
+    def _disconnected(self, connection):
+        with self._state_lock:
+            if self._connection is not connection:
+                return
+            self._connection = None
+        connection.close()
+        for reply in list(self._replies.values()):
+            reply['done'].set()  # (with no result)
+
+    # Run in the elected process:
+
+    def _listen(self):
+        key = secrets.token_bytes(32)
+        listener = Listener(('127.0.0.1', 0), authkey=key)
+        # (written to a temporary file first, so the other processes never read a partial address)
+        temporary_path = f'{self.address_path}.{os.getpid()}'
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'port': listener.address[1], 'key': key.hex(), 'pid': os.getpid()}, f)
+        os.replace(temporary_path, self.address_path)
+        threading.Thread(target=self._accept, args=(listener,), name='background-listener', daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            follower = (connection, threading.Lock())
+            with self._followers_lock:
+                self._followers.append(follower)
+            threading.Thread(target=self._serve, args=(follower,), name='background-calls', daemon=True).start()
+
+    def _serve(self, follower):
+        """ Run the calls of another process, one after another """
+        connection, send_lock = follower
+        try:
+            while True:
+                call_id, name, args = connection.recv()
+                try:
+                    reply = ('reply', call_id, True, self.handlers[name](*args))
+                except Exception as e:
+                    reply = ('reply', call_id, False, e)
+                with send_lock:
+                    connection.send(reply)
+        except (OSError, EOFError):
+            pass  # (the process has exited)
+        finally:
+            with self._followers_lock:
+                self._followers.remove(follower)
+            connection.close()
+
+    def _publish_here(self, email, event):
+        self.on_event(email, event)
+        with self._followers_lock:
+            followers = list(self._followers)
+        for connection, send_lock in followers:
+            try:
+                with send_lock:
+                    connection.send(('event', email, event))
+            except OSError:
+                pass  # (its calls' thread removes it)
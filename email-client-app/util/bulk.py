@@ -0,0 +1,277 @@
+"""Operations on many messages at once (move, delete, flags) - with a few IMAP commands on UID sets"""
+
+import re
+from imap_tools.utils import encode_folder
+
+from .ingest import batched, get_existing_uids, update_emails
+from .sync import get_capabilities, parse_fetched_flags
+
+
+MAX_UID_SET_LENGTH = 1000  # characters (servers limit the length of a command line, usually to 8 KB or more)
+NOT_FOUND = 'not_found'  # (result of a uid that is not in the folder on the server)
+OK = 'ok'
+# The flags a client can set (RFC 3501: \Recent is set by the server only), by their lowercase names:
+SYSTEM_FLAGS = {flag.lower(): flag for flag in ('\\Seen', '\\Answered', '\\Flagged', '\\Deleted', '\\Draft')}
+# A keyword (e.g. $Forwarded) is an atom: printable ASCII without spaces and ( ) { % * " \ ]
+KEYWORD_RE = re.compile(r'[!#$&\'+,\-./0-9:;<=>?@A-Z\[^_`a-z|}~]+')
+
+
+def to_uid_sets(uids, max_length=MAX_UID_SET_LENGTH):
+    """
+    Compress the uids into UID sets of ranges: [1, 2, 3, 5, 8, 9] -> ['1:3,5,8:9']
+    (several sets - if one would be longer than `max_length` characters)
+    """
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    uid_sets = []
+    items = []
+    length = 0
+    for first, last in ranges:
+        item = str(first) if first == last else f'{first}:{last}'
+        if items and length + len(item) > max_length:
+            uid_sets.append(','.join(items))
+            items = []
+            length = 0
+        items.append(item)
+        length += len(item) + 1
+    if items:
+        uid_sets.append(','.join(items))
+    return uid_sets
+
+
+def parse_uid_set(uid_set):
+    """ '1:3,5' -> [1, 2, 3, 5] """
+    uids = []
+    for item in uid_set.split(','):
+        first, _, last = item.partition(':')
+        first, last = int(first), int(last or first)
+        uids.extend(range(min(first, last), max(first, last) + 1))
+    return uids
+
+
+def parse_uids(value):
+    """
+    The uids of a request: '1, 2,3' -> [1, 2, 3].
+    Raises ValueError if one of them is not a uid (an integer from 1 to 2**32 - 1 - RFC 3501)
+    """
+    uids = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if not (item.isascii() and item.isdigit()) or not 0 < int(item) < 2 ** 32:
+            raise ValueError(f'Invalid uid "{item}"')
+        uids.append(int(item))
+    return uids
+
+
+def parse_flags(value):
+    """
+    The flags of a request: '\\seen $Label1' -> ['\\Seen', '$Label1'] (the system flags - in their usual case).
+    Raises ValueError if there are none, or if one of them can't be sent in STORE
+    """
+    flags = []
+    for flag in value.split():
+        if flag.lower() in SYSTEM_FLAGS:
+            flag = SYSTEM_FLAGS[flag.lower()]
+        elif not KEYWORD_RE.fullmatch(flag):
+            raise ValueError(f'Invalid flag "{flag}"')
+        if flag not in flags:
+            flags.append(flag)
+    if not flags:
+        raise ValueError('No flags')
+    return flags
+
+
+def parse_copyuid(responses, uidvalidity):
+    """
+    The new uids of the copied / moved messages: {source uid: destination uid}
+    `responses` - the data of the COPYUID response codes (RFC 4315), e.g. [b'1792337507 3:4,8 101:103'];
+    those of another UIDVALIDITY than `uidvalidity` (the one we know) are ignored
+    """
+    copied = {}
+    for response in responses:
+        parts = response.decode().split()
+        if len(parts) == 3 and uidvalidity is not None and int(parts[0]) == uidvalidity:
+            copied.update(zip(parse_uid_set(parts[1]), parse_uid_set(parts[2])))
+    return copied
+
+
+class BulkOperations:
+    """
+    Moves, deletes and (un)flags many messages of a folder with a few commands:
+    - the uids are sent as UID sets of ranges ("1:40,45,50:90")
+    - a move is one MOVE command (RFC 6851), or COPY + STORE \\Deleted + EXPUNGE
+      (UID EXPUNGE - if the server supports UIDPLUS, so that only these messages are expunged)
+    - the local copy (the `Email` rows, the counters of the folders) is updated in one write job
+      (a moved message keeps its row and downloaded body, if the server has told its new uid - COPYUID)
+
+    Every operation returns the result of every uid: {uid: 'ok' / 'not_found' / error message}
+
+    Must be run with app context.
+    """
+
+    def __init__(self, sync_engine):
+        self.sync_engine = sync_engine  # (its write jobs are used - so the writes go to the same write queue)
+        self.db = sync_engine.db
+        self.Email = sync_engine.Email
+        self.Folder = sync_engine.Folder
+
+    def move(self, mailbox, folder, target, uids):
+        """ Move the messages from `folder` to `target` (`Folder` rows) """
+        results, found = self._select(mailbox, folder, uids)
+        moved = {}  # uid -> uid in the target folder (None - not known)
+        client = mailbox.client
+        for uid_set in to_uid_sets(found):
+            client.untagged_responses.pop('COPYUID', None)
+            if 'MOVE' in get_capabilities(mailbox):
+                typ, data = client.uid('MOVE', uid_set, encode_folder(target.server_name))
+            else:
+                typ, data = client.uid('COPY', uid_set, encode_folder(target.server_name))
+                if typ == 'OK':
+                    typ, data = self._expunge(mailbox, uid_set)
+            if typ != 'OK':
+                results.update(dict.fromkeys(parse_uid_set(uid_set), self._error(data)))
+                continue
+            copied = parse_copyuid(client.untagged_responses.pop('COPYUID', []), target.uidvalidity)
+            for uid in parse_uid_set(uid_set):
+                results[uid] = OK
+                moved[uid] = copied.get(uid)
+        if moved:
+            self.sync_engine.write(self._store_move, folder.folder_id, target.folder_id, moved)
+        return results
+
+    def delete(self, mailbox, folder, uids):
+        """ Delete the messages for good (\\Deleted + EXPUNGE) """
+        results, found = self._select(mailbox, folder, uids)
+        deleted = []
+        for uid_set in to_uid_sets(found):
+            typ, data = self._expunge(mailbox, uid_set)
+            if typ != 'OK':
+                results.update(dict.fromkeys(parse_uid_set(uid_set), self._error(data)))
+                continue
+            for uid in parse_uid_set(uid_set):
+                results[uid] = OK
+                deleted.append(uid)
+        if deleted:
+            self.sync_engine.write(self._store_delete, folder.folder_id, deleted)
+        return results
+
+    def set_flags(self, mailbox, folder, uids, flags, add=True):
+        """ Add (or remove) the flags (e.g. ['\\Seen']) of the messages """
+        results, found = self._select(mailbox, folder, uids)
+        new_flags = {}  # uid -> all its flags now (None - not told by the server)
+        for uid_set in to_uid_sets(found):
+            typ, data = mailbox.client.uid('STORE', uid_set, '+FLAGS' if add else '-FLAGS', f'({" ".join(flags)})')
+            if typ != 'OK':
+                results.update(dict.fromkeys(parse_uid_set(uid_set), self._error(data)))
+                continue
+            fetched = parse_fetched_flags(data)
+            for uid in parse_uid_set(uid_set):
+                results[uid] = OK
+                new_flags[uid] = fetched.get(uid)
+        if new_flags:
+            self.sync_engine.write(self._store_flags, folder.folder_id, new_flags, flags, add)
+        return results
+
+
+    # Run in the calling thread (talk to the server):
+
+    def _select(self, mailbox, folder, uids):
+        """ Select the folder (read-write), and find which uids are in it: ({uid: 'not_found'}, [found uids]) """
+        mailbox.folder.set(folder.server_name)
+        found = set()
+        for uid_set in to_uid_sets(uids):
+            typ, data = mailbox.client.uid('SEARCH', 'UID', uid_set)
+            if typ == 'OK' and data and data[0]:
+                found.update(int(uid) for uid in data[0].split())
+        found &= set(uids)  # (a server answers "UID n:*" with the last message, even if its uid < n)
+        return {uid: NOT_FOUND for uid in uids if uid not in found}, sorted(found)
+
+    @staticmethod
+    def _expunge(mailbox, uid_set):
+        client = mailbox.client
+        typ, data = client.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if typ != 'OK':
+            return typ, data
+        if 'UIDPLUS' in get_capabilities(mailbox):
+            return client.uid('EXPUNGE', uid_set)
+        return client.expunge()
+
+    @staticmethod
+    def _error(data):
+        return b' '.join(item for item in data if isinstance(item, bytes)).decode(errors='replace') or 'error'
+
+
+    # Write jobs (one transaction each):
+
+    def _local_rows(self, folder_id, uids):
+        Email = self.Email
+        rows = []
+        for batch in batched(uids, 500):
+            rows.extend(self.db.session.execute(
+                self.db.select(Email.email_id, Email.uid, Email.flags, Email.size, Email.thread_id)
+                .where(Email.folder_id == folder_id)
+                .where(Email.uid.in_(batch))
+            ).all())
+        return rows
+
+    def _store_move(self, folder_id, target_id, moved):
+        folder = self.db.session.get(self.Folder, folder_id)
+        target = self.db.session.get(self.Folder, target_id)
+        taken = get_existing_uids(self.db, self.Email, target, [uid for uid in moved.values() if uid is not None])
+        updates = []
+        deleted = []
+        rows = self._local_rows(folder_id, list(moved))
+        for row in rows:
+            unread = '\\Seen' not in (row.flags or '').split()
+            folder.n_messages -= 1
+            folder.n_unread -= unread
+            folder.total_size -= row.size or 0
+            new_uid = moved[row.uid]
+            if new_uid is None or new_uid in taken:
+                # (the next sync of the target folder fetches it - or has already fetched it)
+                deleted.append(row.email_id)
+            else:
+                updates.append({'email_id': row.email_id, 'folder_id': target_id, 'uid': new_uid})
+                target.n_messages += 1
+                target.n_unread += unread
+                target.total_size += row.size or 0
+        update_emails(self.db, self.Email, updates)
+        self.sync_engine.delete_local_emails(deleted)
+        self._refresh_threads(rows)
+
+    def _store_delete(self, folder_id, uids):
+        folder = self.db.session.get(self.Folder, folder_id)
+        rows = self._local_rows(folder_id, uids)
+        folder.n_messages -= len(rows)
+        folder.n_unread -= sum('\\Seen' not in (row.flags or '').split() for row in rows)
+        folder.total_size -= sum(row.size or 0 for row in rows)
+        self.sync_engine.delete_local_emails([row.email_id for row in rows])
+
+    def _store_flags(self, folder_id, new_flags, flags, add):
+        folder = self.db.session.get(self.Folder, folder_id)
+        changes = []
+        rows = self._local_rows(folder_id, list(new_flags))
+        for row in rows:
+            old = (row.flags or '').split()
+            if new_flags[row.uid] is not None:
+                new = new_flags[row.uid].split()
+            elif add:
+                new = old + [flag for flag in flags if flag not in old]
+            else:
+                new = [flag for flag in old if flag not in flags]
+            folder.n_unread += ('\\Seen' in old) - ('\\Seen' in new)
+            changes.append({'email_id': row.email_id, 'flags': ' '.join(new)})
+        update_emails(self.db, self.Email, changes)
+        self._refresh_threads(rows)
+
+    def _refresh_threads(self, rows):
+        """ The counters of the threads of the changed emails (see `ThreadIndex`) """
+        thread_index = self.sync_engine.thread_index
+        if thread_index is not None:
+            thread_index.refresh({row.thread_id for row in rows if row.thread_id is not None})
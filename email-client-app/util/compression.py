@@ -0,0 +1,244 @@
+"""Compression of the email bodies: zstd (if the `zstandard` package is installed) or zlib"""
+
+import logging
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+
+try:
+    import zstandard  # (optional: better ratio and speed, and trained dictionaries)
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'zlib'
+CODECS = ['zstd', 'zlib'] if zstandard is not None else ['zlib']  # (that can compress here)
+LEVELS = {'zstd': 9, 'zlib': 6}
+MIN_COMPRESSED_SIZE = 64  # bytes (a shorter body is stored as it is - 'raw')
+# A dictionary holds what the bodies of an account have in common (signatures, footers, quoted headers...)
+DICTIONARY_SIZE = {'zstd': 64 * 1024, 'zlib': 32 * 1024}  # (zlib uses only the last 32 KB of a dictionary)
+MIN_DICTIONARY_SAMPLES = 100  # (fewer bodies - not worth a dictionary)
+MAX_DICTIONARY_SAMPLES = 2000
+
+_zstd_dictionaries = {}  # dictionary id -> zstandard.ZstdCompressionDict (building one is not free)
+_zstd_dictionaries_lock = threading.Lock()
+
+
+def compress(text, dictionary=None):
+    """
+    Compress the body. Returns (data, codec).
+    `dictionary` - a `CompressionDictionary` (it decides the codec), or None
+    """
+    raw = text.encode('utf-8', errors='surrogatepass')
+    if len(raw) < MIN_COMPRESSED_SIZE:
+        return raw, 'raw'
+    codec = dictionary.codec if dictionary is not None else DEFAULT_CODEC
+    if codec == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=LEVELS['zstd'], dict_data=_zstd_dictionary(dictionary))
+        data = compressor.compress(raw)
+    else:
+        compressor = (zlib.compressobj(LEVELS['zlib'], zdict=dictionary.data) if dictionary is not None
+                      else zlib.compressobj(LEVELS['zlib']))
+        data = compressor.compress(raw) + compressor.flush()
+    if len(data) >= len(raw):
+        return raw, 'raw'  # (incompressible)
+    return data, codec
+
+
+def decompress(data, codec, dictionary=None):
+    """ The body (str) from the stored `data` """
+    if codec == 'raw':
+        raw = data
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('This body is compressed with zstd - install the "zstandard" package')
+        raw = zstandard.ZstdDecompressor(dict_data=_zstd_dictionary(dictionary)).decompress(data)
+    elif codec == 'zlib':
+        decompressor = zlib.decompressobj(zdict=dictionary.data) if dictionary is not None else zlib.decompressobj()
+        raw = decompressor.decompress(data) + decompressor.flush()
+    else:
+        raise ValueError(f'Unknown codec "{codec}"')
+    return bytes(raw).decode('utf-8', errors='surrogatepass')
+
+
+def train_dictionary(samples, codec=DEFAULT_CODEC):
+    """ Build a dictionary (bytes) from sample bodies (bytes) of an account """
+    size = DICTIONARY_SIZE[codec]
+    if codec == 'zstd':
+        return zstandard.train_dictionary(size, samples, level=LEVELS['zstd']).as_bytes()
+    # zlib can't train - the lines that repeat the most are used
+    # (the most common ones at the end of the dictionary: they are found with the shortest distances)
+    counts = Counter(line for sample in samples for line in set(sample.splitlines(keepends=True))
+                     if len(line.strip()) > 3)
+    lines = []
+    length = 0
+    for line, count in counts.most_common():
+        if count < 2 or length + len(line) > size:
+            break
+        lines.append(line)
+        length += len(line)
+    return b''.join(reversed(lines))
+
+
+def current_dictionary(db, CompressionDictionary, owner_id):
+    """ The newest dictionary of the user (that can be used here), or None """
+    return db.session.scalar(current_dictionary_query(db, CompressionDictionary, owner_id))
+
+
+def current_dictionary_query(db, CompressionDictionary, owner_id):
+    return (db.select(CompressionDictionary)
+            .where(CompressionDictionary.owner_id == owner_id)
+            .where(CompressionDictionary.codec.in_(CODECS))
+            .order_by(CompressionDictionary.dictionary_id.desc())
+            .limit(1))
+
+
+def _zstd_dictionary(dictionary):
+    if dictionary is None:
+        return None
+    with _zstd_dictionaries_lock:
+        compiled = _zstd_dictionaries.get(dictionary.dictionary_id)
+        if compiled is None:
+            compiled = zstandard.ZstdCompressionDict(dictionary.data)
+            _zstd_dictionaries[dictionary.dictionary_id] = compiled
+        return compiled
+
+
+class BodyCompressor:
+    """
+    Moves the bodies of the old rows (`email.text`, uncompressed) to `EmailBody` (compressed),
+    trains the dictionaries of the accounts and recompresses their bodies with them.
+
+    Works in small batches (each one a short write job in the `write_queue`),
+    so it can run while the app is serving - `flask --app app compress-bodies` (see app.py).
+    Must be run with app context.
+    """
+
+    def __init__(self, db, Email, EmailBody, CompressionDictionary, write_queue, batch=200, pause=0.01):
+        self.db = db
+        self.Email = Email
+        self.EmailBody = EmailBody
+        self.CompressionDictionary = CompressionDictionary
+        self.write_queue = write_queue
+        self.batch = batch
+        self.pause = pause  # seconds between the batches (let the other writers in)
+
+    def migrate(self):
+        """ Compress all the bodies that are still stored in `email.text`. Returns their number """
+        Email = self.Email
+        n = 0
+        while True:
+            email_ids = list(self.db.session.scalars(
+                self.db.select(Email.email_id).where(Email.text_uncompressed.is_not(None)).limit(self.batch)))
+            self.db.session.commit()  # (ends the read - the writer changes these rows)
+            if not email_ids:
+                return n
+            self.write_queue.run(self._migrate_batch, email_ids)
+            n += len(email_ids)
+            logger.info('%d bodies compressed', n)
+            time.sleep(self.pause)
+
+    def train(self, owner_id, codec=DEFAULT_CODEC):
+        """ Train a new dictionary of the account (None - if it has too few bodies) """
+        EmailBody, Email = self.EmailBody, self.Email
+        bodies = self.db.session.scalars(
+            self.db.select(EmailBody).join(Email, Email.email_id == EmailBody.email_id)
+            .where(Email.owner_id == owner_id)
+            .order_by(EmailBody.email_id.desc())
+            .limit(MAX_DICTIONARY_SAMPLES)).all()
+        samples = [body.text.encode('utf-8', errors='surrogatepass') for body in bodies]
+        self.db.session.commit()
+        if len(samples) < MIN_DICTIONARY_SAMPLES:
+            return None
+        data = train_dictionary(samples, codec)
+        return self.write_queue.run(self._store_dictionary, owner_id, codec, data, len(samples))
+
+    def recompress(self, owner_id):
+        """ Compress the bodies of the account again, with its newest dictionary. Returns their number """
+        EmailBody, Email = self.EmailBody, self.Email
+        dictionary_id = self.db.session.scalar(
+            current_dictionary_query(self.db, self.CompressionDictionary, owner_id)
+            .with_only_columns(self.CompressionDictionary.dictionary_id))
+        n = 0
+        last_id = 0
+        while True:
+            email_ids = list(self.db.session.scalars(
+                self.db.select(EmailBody.email_id).join(Email, Email.email_id == EmailBody.email_id)
+                .where(Email.owner_id == owner_id)
+                .where(EmailBody.email_id > last_id)
+                .where(EmailBody.dictionary_id.is_distinct_from(dictionary_id))
+                .order_by(EmailBody.email_id)
+                .limit(self.batch)))
+            self.db.session.commit()
+            if not email_ids:
+                return n
+            self.write_queue.run(self._recompress_batch, owner_id, email_ids)
+            n += len(email_ids)
+            last_id = email_ids[-1]
+            time.sleep(self.pause)
+
+    def report(self):
+        """ How much space the bodies take (and save) """
+        db, Email, EmailBody = self.db, self.Email, self.EmailBody
+        by_codec = {row.codec: {'bodies': row.n, 'original_bytes': row.original, 'stored_bytes': row.stored}
+                    for row in db.session.execute(
+                        db.select(EmailBody.codec,
+                                  db.func.count().label('n'),
+                                  db.func.coalesce(db.func.sum(EmailBody.size), 0).label('original'),
+                                  db.func.coalesce(db.func.sum(db.func.length(EmailBody.data)), 0).label('stored'))
+                        .group_by(EmailBody.codec))}
+        original = sum(codec['original_bytes'] for codec in by_codec.values())
+        stored = sum(codec['stored_bytes'] for codec in by_codec.values())
+        uncompressed = db.session.execute(
+            db.select(db.func.count(), db.func.coalesce(db.func.sum(db.func.length(Email.text_uncompressed)), 0))
+            .where(Email.text_uncompressed.is_not(None))).one()
+        report = {'by_codec': by_codec,
+                  'original_bytes': original,
+                  'stored_bytes': stored,
+                  'saved_bytes': original - stored,
+                  'ratio': round(original / stored, 2) if stored else None,
+                  'not_compressed_yet': {'bodies': uncompressed[0], 'bytes': uncompressed[1]},
+                  'dictionaries': db.session.scalar(db.select(db.func.count()).select_from(self.CompressionDictionary))}
+        if db.engine.dialect.name == 'sqlite':
+            page_size, page_count, free_pages = (db.session.scalar(db.text(f'PRAGMA {name}'))
+                                                 for name in ('page_size', 'page_count', 'freelist_count'))
+            report['database_bytes'] = page_size * page_count
+            report['free_bytes'] = page_size * free_pages  # (given back to the file system by VACUUM)
+        return report
+
+    def vacuum(self):
+        """ Give the space freed by the compression back to the file system (SQLite - it rewrites the file) """
+        if self.db.engine.dialect.name != 'sqlite':
+            return
+        with self.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(self.db.text('VACUUM'))
+
+
+    # Write jobs:
+
+    def _migrate_batch(self, email_ids):
+        Email = self.Email
+        emails = self.db.session.scalars(self.db.select(Email)
+                                         .where(Email.email_id.in_(email_ids))
+                                         .options(self.db.undefer(Email.text_uncompressed),
+                                                  self.db.selectinload(Email.body)))
+        for email in emails:
+            text = email.text_uncompressed
+            email.store_body(text, index=False)  # (the search index has this text already)
+
+    def _recompress_batch(self, owner_id, email_ids):
+        dictionary = current_dictionary(self.db, self.CompressionDictionary, owner_id)
+        for body in self.db.session.scalars(
+                self.db.select(self.EmailBody).where(self.EmailBody.email_id.in_(email_ids))):
+            body.set_text(body.text, dictionary)
+
+    def _store_dictionary(self, owner_id, codec, data, n_samples):
+        dictionary = self.CompressionDictionary(owner_id=owner_id, codec=codec, data=data, n_samples=n_samples,
+                                                created_at=datetime.utcnow())
+        self.db.session.add(dictionary)
+        self.db.session.flush()
+        return dictionary.dictionary_id
@@ -50,6 +50,10 @@ POP_CONFIGS = {
 
 SUPPORTED_EMAIL_PROVIDERS = ['gmail.com', 'ukr.net']
 
+# Providers that put the messages sent through their SMTP server into "Sent" themselves
+# (for the others, the client appends a copy to the "Sent" folder with IMAP):
+SENT_COPY_SAVED_BY_SERVER = ['gmail.com']
+
 DEFAULT_FOLDERS = ['inbox', 'sent', 'drafts', 'bin']  # don't change
 # (if want to change - make sure everything else continues to work)
 
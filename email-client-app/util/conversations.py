@@ -0,0 +1,290 @@
+"""Conversations: the emails grouped into threads (JWZ threading, by Message-ID / In-Reply-To / References)"""
+
+import re
+from collections import defaultdict
+from email.parser import BytesHeaderParser
+
+from .ingest import batched, dialect_insert, update_emails
+
+
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+# "Re: ", "Fwd: ", "RE[2]: ", "AW: " (German), "SV: " (Scandinavian), "WG: " ... repeated
+REPLY_PREFIX_RE = re.compile(r'^\s*((re|fwd?|aw|sv|wg|vs|antw|odp)(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+MAX_MESSAGE_ID_LEN = 255
+MAX_REFERENCES = 20  # (only the closest ancestors are kept - a long conversation has hundreds of them)
+THREAD_HEADER_FIELDS = 'MESSAGE-ID IN-REPLY-TO REFERENCES'
+
+
+def parse_message_ids(value):
+    """ '<a@x> <b@y>' -> ['<a@x>', '<b@y>'] (the ids that are too long are skipped) """
+    return [message_id for message_id in MESSAGE_ID_RE.findall(value or '') if len(message_id) <= MAX_MESSAGE_ID_LEN]
+
+
+def thread_headers(headers):
+    """
+    The threading columns of an `Email` from the headers of the message
+    (`headers` - {lowercase name: (value, ...)}, like `MailMessage.headers`):
+    {'message_id': '<id>' or None, 'references': '<ancestor> ... <parent>' or None}
+    """
+    message_ids = parse_message_ids(' '.join(headers.get('message-id', ())))
+    references = parse_message_ids(' '.join(headers.get('references', ())))
+    # (JWZ: In-Reply-To is the parent, if References doesn't end with it)
+    in_reply_to = parse_message_ids(' '.join(headers.get('in-reply-to', ())))
+    if in_reply_to and in_reply_to[0] not in references[-1:]:
+        references.append(in_reply_to[0])
+    message_id = message_ids[0] if message_ids else None
+    references = [reference for reference in references if reference != message_id][-MAX_REFERENCES:]
+    return {'message_id': message_id, 'references': ' '.join(references) or None}
+
+
+def parse_thread_headers(raw_headers):
+    """ `thread_headers` of raw header lines (bytes - the answer of BODY.PEEK[HEADER.FIELDS (...)]) """
+    message = BytesHeaderParser().parsebytes(raw_headers)
+    headers = defaultdict(tuple)
+    for name, value in message.items():
+        headers[name.lower()] += (str(value),)
+    return thread_headers(headers)
+
+
+def date_order(date):
+    """ Sort key of a date (of a header - it can be missing, or without a time zone) """
+    return date.timestamp() if date is not None else 0
+
+
+def normalize_subject(subject):
+    """ The subject without "Re:" / "Fwd:" ... -> (normalized subject, whether it had such a prefix) """
+    subject = subject or ''
+    stripped = REPLY_PREFIX_RE.sub('', subject)
+    return ' '.join(stripped.split()).lower()[:255], stripped != subject
+
+
+def build_tree(messages):
+    """
+    Arrange the messages of a thread as a tree (JWZ threading: containers linked by References,
+    without loops; the children sorted by date).
+    `messages` - objects with `message_id`, `references` and `date` (e.g. `Email` rows).
+    Returns [(message, depth), ...] in the order of reading (depth first)
+    """
+    containers = {}  # message id -> {'message', 'parent', 'children'}
+
+    def container(message_id):
+        if message_id not in containers:
+            containers[message_id] = {'id': message_id, 'message': None, 'parent': None, 'children': []}
+        return containers[message_id]
+
+    def is_ancestor(ancestor, node):
+        while node is not None:
+            if node is ancestor:
+                return True
+            node = node['parent']
+        return False
+
+    def link(parent, child):
+        if child['parent'] is parent or is_ancestor(child, parent):
+            return  # (already linked, or it would make a loop)
+        if child['parent'] is not None:
+            child['parent']['children'].remove(child)
+        child['parent'] = parent
+        parent['children'].append(child)
+
+    for i, message in enumerate(sorted(messages, key=lambda message: message.date)):
+        this = container(message.message_id or f'<no id {i}>')
+        if this['message'] is not None:
+            this = container(f'{this["id"]} (copy {i})')  # (the same message in two folders)
+        this['message'] = message
+        references = (message.references or '').split()
+        # (the References chain: each one is the parent of the next, unless they are linked already)
+        for parent_id, child_id in zip(references, references[1:]):
+            child = container(child_id)
+            if child['parent'] is None:
+                link(container(parent_id), child)
+        if references:
+            link(container(references[-1]), this)  # (the message says who its parent is - it wins)
+
+    result = []
+
+    def walk(node, depth):
+        # (an empty container - a message we don't have - is not shown, its children take its place)
+        if node['message'] is not None:
+            result.append((node['message'], depth))
+            depth += 1
+        for child in sorted(node['children'], key=first_date):
+            walk(child, depth)
+
+    def first_date(node):
+        if node['message'] is not None:
+            return node['message'].date
+        return min((first_date(child) for child in node['children']), default=None) or messages[0].date
+
+    for node in sorted((node for node in containers.values() if node['parent'] is None), key=first_date):
+        walk(node, 0)
+    return result
+
+
+class ThreadIndex:
+    """
+    Keeps the emails grouped into threads, incrementally - when they are stored (JWZ threading):
+    - every Message-ID that was seen (of a stored message, or only mentioned in References /
+      In-Reply-To - a message we don't have) is mapped to its thread (`ThreadReference`)
+    - a new message joins the thread of its own Message-ID or of any of its references;
+      if they are in several threads - the message links them, and they are merged into one
+    - a reply without references ("Re: ...") joins the newest thread with the same subject
+    - otherwise it starts a new thread
+
+    The counters of each thread (in every folder - `ThreadFolder`, and in all of them - `MessageThread`)
+    are kept up to date by `refresh`, so the grouped listing of a folder is one indexed query, like the flat one.
+
+    All the methods are run in the write jobs (of `SyncEngine` and `BulkOperations`), not committed here.
+    """
+
+    def __init__(self, db, Email, MessageThread, ThreadFolder, ThreadReference):
+        self.db = db
+        self.Email = Email
+        self.MessageThread = MessageThread
+        self.ThreadFolder = ThreadFolder
+        self.ThreadReference = ThreadReference
+
+    def assign(self, owner_id, rows):
+        """
+        Find the thread of every message: sets `row['thread_id']`
+        (`rows` - dicts with 'message_id', 'references', 'subject', 'date' - of one owner).
+        Returns the ids of the threads that have changed (to `refresh` them after the rows are saved)
+        """
+        if not rows:
+            return set()
+        db, ThreadReference = self.db, self.ThreadReference
+        chains = [(row['references'] or '').split() + ([row['message_id']] if row['message_id'] else [])
+                  for row in rows]
+        known = {}  # message id -> thread id
+        for batch in batched({message_id for chain in chains for message_id in chain}, 500):
+            known.update(db.session.execute(
+                db.select(ThreadReference.message_id, ThreadReference.thread_id)
+                .where(ThreadReference.owner_id == owner_id)
+                .where(ThreadReference.message_id.in_(batch))).all())
+        by_subject = self._threads_by_subject(owner_id, rows, chains, known)
+
+        merged = {}  # thread id -> the thread it was merged into
+        new_threads = {}  # (temporary, negative) thread id -> its subject
+
+        def find(thread_id):
+            while thread_id in merged:
+                thread_id = merged[thread_id]
+            return thread_id
+
+        new_references = {}
+        for i in sorted(range(len(rows)), key=lambda i: date_order(rows[i]['date'])):
+            row, chain = rows[i], chains[i]
+            subject, is_reply = normalize_subject(row['subject'])
+            threads = {find(known[message_id]) for message_id in chain if message_id in known}
+            if not threads and is_reply and subject in by_subject:
+                threads = {find(by_subject[subject])}
+            if not threads:
+                thread_id = -len(new_threads) - 1
+                new_threads[thread_id] = subject
+            else:
+                # (the stored threads are kept, the new ones are merged into them)
+                thread_id = min(threads, key=lambda thread_id: (thread_id < 0, abs(thread_id)))
+                for other in threads - {thread_id}:
+                    merged[other] = thread_id
+            if subject and subject not in by_subject:
+                by_subject[subject] = thread_id
+            for message_id in chain:
+                if message_id not in known:
+                    known[message_id] = new_references[message_id] = thread_id
+            row['thread_id'] = thread_id
+
+        ids = self._insert_threads(owner_id, {thread_id: subject for thread_id, subject in new_threads.items()
+                                              if thread_id not in merged})
+        merged = {thread_id: find(thread_id) for thread_id in merged}
+        self._merge_threads(owner_id, {thread_id: ids.get(target, target) for thread_id, target in merged.items()
+                                       if thread_id > 0})
+        if new_references:
+            db.session.execute(dialect_insert(db, ThreadReference).on_conflict_do_nothing(), [
+                {'owner_id': owner_id, 'message_id': message_id, 'thread_id': ids.get(find(thread_id), find(thread_id))}
+                for message_id, thread_id in new_references.items()])
+        for row in rows:
+            row['thread_id'] = ids.get(find(row['thread_id']), find(row['thread_id']))
+        return {row['thread_id'] for row in rows}
+
+    def threads_of(self, email_ids):
+        """ The ids of the threads of the emails """
+        Email = self.Email
+        thread_ids = set()
+        for batch in batched(email_ids, 500):
+            thread_ids.update(self.db.session.scalars(
+                self.db.select(Email.thread_id).where(Email.email_id.in_(batch)).where(Email.thread_id.is_not(None))))
+        return thread_ids
+
+    def refresh(self, thread_ids):
+        """ Count the messages of the threads again (in every folder, and in all of them) """
+        db, Email, MessageThread, ThreadFolder = self.db, self.Email, self.MessageThread, self.ThreadFolder
+        for batch in batched(thread_ids, 500):
+            folders = {}  # (thread id, folder id) -> counters
+            totals = {thread_id: {'thread_id': thread_id, 'n_messages': 0, 'n_unread': 0, 'last_date': None}
+                      for thread_id in batch}
+            for row in db.session.execute(
+                    db.select(Email.email_id, Email.thread_id, Email.folder_id, Email.date, Email.uid, Email.flags)
+                    .where(Email.thread_id.in_(batch))):
+                unread = '\\Seen' not in (row.flags or '').split()
+                counters = folders.setdefault((row.thread_id, row.folder_id), {
+                    'thread_id': row.thread_id, 'folder_id': row.folder_id, 'n_messages': 0, 'n_unread': 0,
+                    'last_date': row.date, 'last_uid': row.uid, 'last_email_id': row.email_id})
+                counters['n_messages'] += 1
+                counters['n_unread'] += unread
+                if (row.date, row.uid) > (counters['last_date'], counters['last_uid']):
+                    counters.update(last_date=row.date, last_uid=row.uid, last_email_id=row.email_id)
+                total = totals[row.thread_id]
+                total['n_messages'] += 1
+                total['n_unread'] += unread
+                if total['last_date'] is None or row.date > total['last_date']:
+                    total['last_date'] = row.date
+            db.session.execute(db.delete(ThreadFolder).where(ThreadFolder.thread_id.in_(batch)))
+            if folders:
+                db.session.execute(db.insert(ThreadFolder), list(folders.values()))
+            db.session.execute(db.update(MessageThread), list(totals.values()))
+
+    def _threads_by_subject(self, owner_id, rows, chains, known):
+        """ The newest thread of every subject of the replies that have no known references: {subject: thread id} """
+        subjects = set()
+        for row, chain in zip(rows, chains):
+            subject, is_reply = normalize_subject(row['subject'])
+            if is_reply and subject and not any(message_id in known for message_id in chain):
+                subjects.add(subject)
+        MessageThread = self.MessageThread
+        by_subject = {}
+        for batch in batched(subjects, 500):
+            for row in self.db.session.execute(
+                    self.db.select(MessageThread.subject, MessageThread.thread_id)
+                    .where(MessageThread.owner_id == owner_id)
+                    .where(MessageThread.subject.in_(batch))
+                    .order_by(MessageThread.last_date.desc().nulls_last())):
+                by_subject.setdefault(row.subject, row.thread_id)
+        return by_subject
+
+    def _insert_threads(self, owner_id, subjects):
+        """ Insert the new threads ({temporary id: subject}). Returns {temporary id: thread id} """
+        if not subjects:
+            return {}
+        temporary_ids = list(subjects)
+        thread_ids = self.db.session.scalars(
+            self.db.insert(self.MessageThread).returning(self.MessageThread.thread_id, sort_by_parameter_order=True),
+            [{'owner_id': owner_id, 'subject': subjects[temporary_id], 'n_messages': 0, 'n_unread': 0}
+             for temporary_id in temporary_ids])
+        return dict(zip(temporary_ids, thread_ids))
+
+    def _merge_threads(self, owner_id, merged):
+        """ Move everything of the merged threads ({thread id: thread it's merged into}) into the other ones """
+        db, Email, ThreadReference = self.db, self.Email, self.ThreadReference
+        by_target = defaultdict(list)
+        for thread_id, target in merged.items():
+            by_target[target].append(thread_id)
+        for target, thread_ids in by_target.items():
+            db.session.execute(db.update(ThreadReference)
+                               .where(ThreadReference.owner_id == owner_id)
+                               .where(ThreadReference.thread_id.in_(thread_ids))
+                               .values(thread_id=target))
+            email_ids = list(db.session.scalars(db.select(Email.email_id).where(Email.thread_id.in_(thread_ids))))
+            update_emails(db, Email, [{'email_id': email_id, 'thread_id': target} for email_id in email_ids])
+        if merged:
+            db.session.execute(db.delete(self.ThreadFolder).where(self.ThreadFolder.thread_id.in_(list(merged))))
+            db.session.execute(db.delete(self.MessageThread).where(self.MessageThread.thread_id.in_(list(merged))))
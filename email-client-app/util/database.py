@@ -1,65 +1,261 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 
-# import os
-# DB_USER = os.environ.get("DB_USER")
-# DB_PASSWORD = os.environ.get("DB_PASSWORD")
+from .compression import compress, current_dictionary, decompress
+from .search import index_email_text
 
 MAX_EMAIL_ADDR_LEN = 254  # RFC 2821
 MAX_EMAIL_SUBJ_LEN = 255  # RFC 2822 says it's 998 but most other email clients have it 255 or 256
 MAX_FOLDER_NAME_LEN = 32  # max name length of folders in the email client
+MAX_SERVER_FOLDER_NAME_LEN = 255  # folder names on the server can be longer (e.g. "[Gmail]/Sent Mail")
 MAX_FILE_NAME_LEN = 255
+MAX_SNIPPET_LEN = 200  # preview of the body in the list of messages
+MAX_MESSAGE_ID_LEN = 255  # (longer Message-IDs are not used for threading)
 
 
-def get_models(app):
-    db = SQLAlchemy(app)
+def engine_options(uri):
+    """
+    SQLAlchemy engine options (`SQLALCHEMY_ENGINE_OPTIONS`) for the database URI.
+    Connections are used by the requests, the sync workers, the outbox workers and the writer
+    - so the pool is larger than the default (5 + 10 overflow).
+    """
+    if uri.startswith('sqlite'):
+        # (wait up to 30 s for the other writer, instead of "database is locked" after 5 s)
+        return {'connect_args': {'timeout': 30}, 'pool_size': 10, 'max_overflow': 20}
+    # (per worker process - keep (workers * (pool_size + max_overflow)) below the server's max_connections)
+    return {'pool_size': 5, 'max_overflow': 10, 'pool_pre_ping': True, 'pool_recycle': 1800}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Run for every new SQLite connection. WAL: the readers don't wait for the writer
+    (and the writer doesn't wait for the readers), so several worker processes can share the file
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')  # (with WAL - a crash of the app loses nothing)
+    cursor.close()
+
+
+def make_snippet(text):
+    """ The beginning of the body, on one line (without the quoted lines of the previous messages) """
+    lines = (line for line in text.splitlines() if not line.lstrip().startswith('>'))
+    return ' '.join(' '.join(lines).split())[:MAX_SNIPPET_LEN]
 
 
-    # Many-to-Many association table:  # TODO: make it many to one (email belongs only to 1 folder)
-    email_folder = db.Table(
-        'email_folder', 
-        db.Column("email_id", db.Integer, db.ForeignKey("email.id")),
-        db.Column("folder_id", db.Integer, db.ForeignKey("folder.id")),
-    )
+def get_models(app):
+    db = SQLAlchemy(app)
 
 
     class Email(db.Model):
+        __table_args__ = (
+            # (also serves as the index to find an email by its uid)
+            db.UniqueConstraint('owner_id', 'folder_id', 'uid', name='uq_email_owner_id_folder_id_uid'),
+        )
         email_id = db.Column('id', db.Integer, primary_key=True)
         owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), nullable=False)  # an email is in exactly 1 folder
         uid = db.Column(db.Integer)
         date = db.Column(db.DateTime)
         from_ = db.Column('from', db.String(MAX_EMAIL_ADDR_LEN))
         to = db.Column('to', db.String(MAX_EMAIL_ADDR_LEN))
         subject = db.Column(db.String(MAX_EMAIL_SUBJ_LEN))
-        text = db.Column(db.String)  # email body (if not stored in the filesystem)
+        # (the body of the emails downloaded before the compression - moved to `body` by `BodyCompressor`;
+        #  deferred: it's not read with the other columns, only when it's used)
+        text_uncompressed = db.deferred(db.Column('text', db.String))
+        snippet = db.Column(db.String(MAX_SNIPPET_LEN))  # (see `make_snippet`) None - the body is not downloaded yet
+        flags = db.Column(db.String)  # IMAP flags, separated by spaces (e.g. "\\Seen \\Flagged")
+        size = db.Column(db.Integer)  # size of the whole message on the server (bytes)
+        body_fetched = db.Column(db.Boolean, nullable=False, default=False)  # False - only the headers are stored
+        path = db.Column(db.String)  # the raw message (.eml) in the message store, None - not downloaded yet
+        # Threading (see `ThreadIndex`):
+        message_id = db.Column(db.String(MAX_MESSAGE_ID_LEN))  # the Message-ID header, e.g. "<abc@example.com>"
+        references = db.Column('message_references', db.String)  # Message-IDs of the ancestors, separated by spaces (the parent is the last one)
+        thread_id = db.Column(db.Integer, db.ForeignKey('message_thread.id'), index=True)  # None - stored before the threading
+
+        folder = db.relationship("Folder", backref=db.backref("emails", lazy=True, cascade="all, delete-orphan"))  # also declare a property 'emails' on the 'Folder' class
+        attachments = db.relationship("Attachment", backref="email", lazy=True,
+                                      cascade="all, delete-orphan")  # also declare a property 'email' on the 'Attachment' class
+        body = db.relationship("EmailBody", uselist=False, lazy=True,
+                               cascade="all, delete-orphan")  # the compressed body (None - not downloaded yet)
+
+        @property
+        def text(self):
+            """ The body (plain text) - decompressed when it's read """
+            if self.body is not None:
+                return self.body.text
+            return self.text_uncompressed
+
+        @text.setter
+        def text(self, text):
+            self.store_body(text)
+
+        def store_body(self, text, index=True):
+            """
+            Store the body compressed (with the newest dictionary of the user, if there is one).
+            `index` - also put it into the search index (the triggers can't read a compressed body)
+            """
+            self.text_uncompressed = None
+            self.snippet = make_snippet(text) if text is not None else None
+            if text is None:
+                self.body = None
+            else:
+                dictionary = current_dictionary(db, CompressionDictionary, self.owner_id)
+                if self.body is None:
+                    self.body = EmailBody()
+                self.body.set_text(text, dictionary)
+            if index and self.email_id is not None:
+                index_email_text(db.session, self.email_id, text)
 
-        # ## path = db.Column(db.String)  # path in the file system: ./<username>/data/emails/<uid>/<email_id>.eml  # (this would store the path of the email file if it was stored in the filesystem)
-        folders = db.relationship("Folder", secondary=email_folder, backref="emails")  # also declare a property 'emails' on the 'Folder' class
-        attachments = db.relationship("Attachment", backref="email", lazy=True)  # also declare a property 'email' on the 'Attachment' class
         def __repr__(self):
             return (f"<Email(email_id={self.email_id}, "
                     f"owner={self.owner}, "
+                    f"folder_id={self.folder_id}, "
                     f"uid={self.uid}, "
                     f"date={self.date}, "
                     f"from_={self.from_}, "
                     f"to={self.to}, "
                     f"subject={self.subject}, "
-                    f"len(text)={len(self.text) if self.text else None}>")
-    
+                    f"body_size={self.body.size if self.body is not None else None}>")
+
+
+    # The listing of a folder (newest first) is read from this index only:
+    db.Index('ix_email_owner_id_folder_id_date', Email.owner_id, Email.folder_id,
+             Email.date.desc(), Email.uid.desc())
+
+
+    class EmailBody(db.Model):
+        """ The body of an email, compressed (in its own table - so the rows of `email` stay small) """
+        email_id = db.Column(db.Integer, db.ForeignKey('email.id'), primary_key=True)
+        codec = db.Column(db.String(8), nullable=False)  # raw / zlib / zstd
+        dictionary_id = db.Column(db.Integer, db.ForeignKey('compression_dictionary.id'))  # None - no dictionary
+        size = db.Column(db.Integer, nullable=False)  # bytes before the compression (UTF-8)
+        data = db.Column(db.LargeBinary, nullable=False)
+
+        dictionary = db.relationship("CompressionDictionary", lazy=True)
+
+        @property
+        def text(self):
+            return decompress(self.data, self.codec, self.dictionary)
+
+        def set_text(self, text, dictionary=None):
+            self.data, self.codec = compress(text, dictionary)
+            self.dictionary = dictionary if self.codec != 'raw' else None
+            self.size = len(text.encode('utf-8', errors='surrogatepass'))
+
+        def __repr__(self):
+            return (f"<EmailBody(email_id={self.email_id}, "
+                    f"codec={self.codec}, "
+                    f"dictionary_id={self.dictionary_id}, "
+                    f"size={self.size}, "
+                    f"len(data)={len(self.data) if self.data is not None else None})>")
+
+
+    class CompressionDictionary(db.Model):
+        """ What the bodies of a user have in common (trained on them) - makes the short bodies compress well """
+        dictionary_id = db.Column('id', db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+        codec = db.Column(db.String(8), nullable=False)  # the codec it's used with (zlib / zstd)
+        data = db.Column(db.LargeBinary, nullable=False)
+        n_samples = db.Column(db.Integer)  # number of the bodies it was trained on
+        created_at = db.Column(db.DateTime, nullable=False)
+        def __repr__(self):
+            return (f"<CompressionDictionary(dictionary_id={self.dictionary_id}, "
+                    f"owner_id={self.owner_id}, "
+                    f"codec={self.codec}, "
+                    f"len(data)={len(self.data)})>")
+
+
+    class MessageThread(db.Model):
+        """ A conversation: the emails that reply to each other (in any of the folders of the user) """
+        thread_id = db.Column('id', db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        subject = db.Column(db.String(MAX_EMAIL_SUBJ_LEN))  # normalized (without "Re:", lowercase) - to find the thread of a reply
+        # Counters (maintained by `ThreadIndex.refresh`):
+        n_messages = db.Column(db.Integer, nullable=False, default=0)
+        n_unread = db.Column(db.Integer, nullable=False, default=0)
+        last_date = db.Column(db.DateTime)  # of the newest message
+        def __repr__(self):
+            return (f"<MessageThread(thread_id={self.thread_id}, "
+                    f"owner_id={self.owner_id}, "
+                    f"subject={self.subject}, "
+                    f"n_messages={self.n_messages})>")
+
+
+    db.Index('ix_message_thread_owner_id_subject', MessageThread.owner_id, MessageThread.subject)
+
+
+    class ThreadFolder(db.Model):
+        """ The messages of a thread in one folder (a row of the grouped listing of the folder) """
+        thread_id = db.Column(db.Integer, db.ForeignKey('message_thread.id'), primary_key=True)
+        folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'), primary_key=True)
+        n_messages = db.Column(db.Integer, nullable=False)
+        n_unread = db.Column(db.Integer, nullable=False)
+        # The newest message of the thread in the folder (it's shown in the listing):
+        last_date = db.Column(db.DateTime)
+        last_uid = db.Column(db.Integer)
+        last_email_id = db.Column(db.Integer)
+        def __repr__(self):
+            return (f"<ThreadFolder(thread_id={self.thread_id}, "
+                    f"folder_id={self.folder_id}, "
+                    f"n_messages={self.n_messages})>")
+
+
+    # The grouped listing of a folder (newest thread first) is read from this index:
+    db.Index('ix_thread_folder_folder_id_last_date', ThreadFolder.folder_id,
+             ThreadFolder.last_date.desc(), ThreadFolder.thread_id.desc())
+
+
+    class ThreadReference(db.Model):
+        """ The thread of a Message-ID: of a stored message, or of one that is only referred to by the others """
+        owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+        message_id = db.Column(db.String(MAX_MESSAGE_ID_LEN), primary_key=True)
+        thread_id = db.Column(db.Integer, db.ForeignKey('message_thread.id'), nullable=False, index=True)
+        def __repr__(self):
+            return (f"<ThreadReference(owner_id={self.owner_id}, "
+                    f"message_id={self.message_id}, "
+                    f"thread_id={self.thread_id})>")
+
 
     class Folder(db.Model):
+        __table_args__ = (
+            db.UniqueConstraint('owner_id', 'name', name='uq_folder_owner_id_name'),  # (needed for the upsert of the folders)
+        )
         folder_id = db.Column('id', db.Integer, primary_key=True)
         owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-        name = db.Column(db.String(MAX_FOLDER_NAME_LEN), nullable=False)
+        name = db.Column(db.String(MAX_FOLDER_NAME_LEN), nullable=False)  # name in the client
+        server_name = db.Column(db.String(MAX_SERVER_FOLDER_NAME_LEN))  # name on the server
+        listed_at = db.Column(db.DateTime)  # when the folder was last seen in the server's folder list
+        # Sync state (what the server said during the last sync):
+        uidvalidity = db.Column(db.BigInteger)  # if this changes - the uids of the folder are not valid anymore
+        uidnext = db.Column(db.BigInteger)  # all messages with uid >= uidnext are new
+        highestmodseq = db.Column(db.BigInteger)  # (CONDSTORE) flags changed since this modseq
+        n_server_messages = db.Column(db.Integer)  # MESSAGES - if the number doesn't add up, some were expunged
+        synced_at = db.Column(db.DateTime)
+        # Counters of the locally stored messages (maintained by the sync engine):
+        n_messages = db.Column(db.Integer, nullable=False, default=0)
+        n_unread = db.Column(db.Integer, nullable=False, default=0)
+        total_size = db.Column(db.BigInteger, nullable=False, default=0)  # sum of the sizes of the messages (bytes)
+        # Incremented (by a trigger - SQLite only) on every change of the folder's emails - for the ETag of its listing:
+        version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+        changed_at = db.Column(db.DateTime)  # (the time of the last such change, UTC - for the Last-Modified)
+        # Import of the older messages (see `MailboxImporter`):
+        import_next_uid = db.Column(db.BigInteger)  # the messages with a smaller uid are imported, None - not started
+        imported_at = db.Column(db.DateTime)  # when the import of the folder was finished
         def __repr__(self):
-            return f"<Folder(folder_id={self.folder_id}, name={self.name})>"
+            return (f"<Folder(folder_id={self.folder_id}, "
+                    f"name={self.name}, "
+                    f"server_name={self.server_name})>")
 
 
     class Attachment(db.Model):
         attachment_id = db.Column('id', db.Integer, primary_key=True)
-        email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=False)
+        email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=False, index=True)
         filename = db.Column(db.String(MAX_FILE_NAME_LEN), nullable=False)
         content_type = db.Column(db.String)  # MIME type of the attachment
-        path = db.Column(db.String, nullable=False)  # path in the file system: ./<username>/data/emails/<uid>/attachments/<filename.ext>
+        path = db.Column(db.String, nullable=False)  # path in the file system (in the attachment store: <root>/ab/cd/<sha256>)
+        sha256 = db.Column(db.String(64), index=True)  # hash of the content (the same file is stored once)
+        size = db.Column(db.Integer)  # bytes
         def __repr__(self):
             return (f"<Attachment(attachment_id={self.attachment_id}, "
                     f"email_id={self.email_id}, "
@@ -67,6 +263,34 @@ def get_models(app):
                     f"path={self.path})>")
 
 
+    class Outbox(db.Model):
+        """ Messages waiting to be sent (and the ones already sent or given up on) """
+        outbox_id = db.Column('id', db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+        recipients = db.Column(db.String, nullable=False)  # separated by ", "
+        subject = db.Column(db.String(MAX_EMAIL_SUBJ_LEN))
+        path = db.Column(db.String)  # the message (RFC 5322) in the outbox spool, None - sent (or in `raw`)
+        raw = db.Column(db.LargeBinary)  # the whole message - of the messages queued before the spool
+        status = db.Column(db.String(8), nullable=False, default='queued')  # queued / sending / sent / failed
+        lease_expires_at = db.Column(db.DateTime)  # (UTC) 'sending' - claimed by a worker until then
+        attempts = db.Column(db.Integer, nullable=False, default=0)
+        next_attempt_at = db.Column(db.DateTime, nullable=False)  # (UTC) not sent before that
+        last_error = db.Column(db.String)
+        created_at = db.Column(db.DateTime, nullable=False)
+        sent_at = db.Column(db.DateTime)
+        copied_to_sent = db.Column(db.Boolean, nullable=False, default=False)  # appended to the IMAP "Sent" folder
+        def __repr__(self):
+            return (f"<Outbox(outbox_id={self.outbox_id}, "
+                    f"owner_id={self.owner_id}, "
+                    f"recipients={self.recipients}, "
+                    f"status={self.status}, "
+                    f"attempts={self.attempts})>")
+
+
+    # Workers look for the messages that are due:
+    db.Index('ix_outbox_status_next_attempt_at', Outbox.status, Outbox.next_attempt_at)
+
+
     class User(db.Model):
         id = db.Column(db.Integer, primary_key=True)
         username = db.Column(db.String(MAX_EMAIL_ADDR_LEN), unique=True, nullable=False)  # user's email address
@@ -78,10 +302,12 @@ def get_models(app):
 
 
     with app.app_context():
-        db.create_all()  # create table schema in the database 
-        # (does not update tables if they are already in the database)
-    
-    return db, Email, Folder, Attachment, User
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
+    # (no queries here: the schema is created / upgraded by `upgrade_schema` - `flask --app app migrate`)
+
+    return (db, Email, Folder, Attachment, User, Outbox, EmailBody, CompressionDictionary,
+            MessageThread, ThreadFolder, ThreadReference)
 
 
 
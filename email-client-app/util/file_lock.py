@@ -0,0 +1,90 @@
+"""Locks shared by the worker processes of the app: an exclusive lock of a file in the instance folder"""
+
+import os
+import threading
+import time
+
+try:
+    import fcntl  # (POSIX)
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt  # (Windows)
+except ImportError:
+    msvcrt = None
+
+
+class FileLock:
+    """
+    An exclusive lock of the file `path` - held by one process at a time (and one thread of it).
+    - `fcntl.flock` where it's available (Linux, macOS)
+    - `msvcrt.locking` of the first byte of the file on Windows
+    - otherwise only a lock of this process (a single process can't conflict with itself)
+    The lock is released by the OS if the process dies.
+
+    Usage:
+        with FileLock(path):
+            ...
+        lock.acquire(blocking=False)  # -> whether it's locked now
+    """
+
+    def __init__(self, path, poll_interval=0.05):
+        self.path = path
+        self.poll_interval = poll_interval  # seconds (msvcrt can't wait for the lock - it's tried again)
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        if not self._thread_lock.acquire(blocking):
+            return False
+        try:
+            if fcntl is None and msvcrt is None:
+                return True
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if not self._lock_file(fd, blocking):
+                os.close(fd)
+                self._thread_lock.release()
+                return False
+            self._fd = fd
+            return True
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            finally:
+                os.close(fd)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _lock_file(self, fd, blocking):
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+        while True:
+            os.lseek(fd, 0, os.SEEK_SET)
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+            time.sleep(self.poll_interval)
@@ -0,0 +1,91 @@
+"""Cache of the folder mapping (client folder name -> server folder name)"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .actions import get_mailbox_folder_mapping
+from .ingest import upsert_folders
+
+
+class FolderMappingCache:
+    """
+    Remembers the folder mapping of every user, so that the server's
+    folder list (IMAP LIST) is not requested on every call.
+
+    The mapping is looked up:
+    1. in memory (if it is younger than `ttl` seconds)
+    2. in the `Folder` table (if it was listed less than `ttl` seconds ago)
+       - so a freshly started process can answer without the server
+    3. on the server (and then saved to the memory and to the `Folder` table)
+
+    Must be run with app context (it uses the database).
+    """
+
+    def __init__(self, db, Folder, ttl=300):
+        self.db = db
+        self.Folder = Folder
+        self.ttl = ttl
+        self._mappings = {}  # owner id -> (folder_mapping, time when it was stored)
+        self._lock = threading.Lock()
+
+    def get(self, owner, mailbox):
+        """ Return the folder mapping of the `owner` (`mailbox` - is the owner's connection) """
+        folder_mapping = self.cached(owner)
+        if folder_mapping is None:
+            folder_mapping = get_mailbox_folder_mapping(mailbox)
+            self.store(owner, folder_mapping)
+        return folder_mapping
+
+    def cached(self, owner):
+        """ The mapping from the memory or from the database (1. and 2.), None - if it has to be listed again """
+        with self._lock:
+            cached = self._mappings.get(owner.id)
+        if cached and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        folder_mapping = self._load(owner)
+        if folder_mapping is not None:
+            with self._lock:
+                self._mappings[owner.id] = (folder_mapping, time.monotonic())
+        return folder_mapping
+
+    def store(self, owner, folder_mapping):
+        """ Save the mapping that was just listed on the server """
+        self._save(owner, folder_mapping)
+        with self._lock:
+            self._mappings[owner.id] = (folder_mapping, time.monotonic())
+
+    def invalidate(self, owner):
+        """ Forget the mapping (call this after the folders changed on the server) """
+        with self._lock:
+            self._mappings.pop(owner.id, None)
+        self.db.session.execute(
+            self.db.update(self.Folder)
+            .where(self.Folder.owner_id == owner.id)
+            .values(listed_at=None)
+        )
+        self.db.session.commit()
+
+    def _load(self, owner):
+        """ Read the mapping from the database (None - if it's missing or too old) """
+        folders = self.db.session.execute(
+            self.db.select(self.Folder.name, self.Folder.server_name, self.Folder.listed_at)
+            .where(self.Folder.owner_id == owner.id)
+        ).all()
+        oldest_allowed = datetime.utcnow() - timedelta(seconds=self.ttl)
+        if not folders or any(f.listed_at is None or f.listed_at < oldest_allowed for f in folders):
+            return None
+        return {f.name: f.server_name for f in folders}
+
+    def _save(self, owner, folder_mapping):
+        """ Update the owner's `Folder` rows to match the mapping """
+        upsert_folders(self.db, self.Folder, owner.id, folder_mapping, datetime.utcnow())
+        # Folders that are no longer on the server:
+        gone = self.db.session.execute(
+            self.db.select(self.Folder)
+            .where(self.Folder.owner_id == owner.id)
+            .where(self.Folder.name.not_in(list(folder_mapping)))
+        ).scalars().all()
+        for folder in gone:
+            self.db.session.delete(folder)
+        self.db.session.commit()
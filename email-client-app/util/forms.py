@@ -1,6 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, Email, ValidationError
+from .configs import SUPPORTED_EMAIL_PROVIDERS
 
 
 class LoginForm(FlaskForm):
@@ -10,7 +11,8 @@ class LoginForm(FlaskForm):
 
     def validate_email(self, email):
         email = email.data
-        if not (email.endswith('@gmail.com') or email.endswith('@ukr.net')):
-            raise ValidationError('Email must end with @gmail.com or @ukr.net')
+        if email.split('@')[-1] not in SUPPORTED_EMAIL_PROVIDERS:
+            raise ValidationError('Email must end with ' + ' or '.join(f'@{provider}'
+                                                                        for provider in SUPPORTED_EMAIL_PROVIDERS))
 
 
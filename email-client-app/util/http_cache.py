@@ -0,0 +1,164 @@
+"""HTTP caching: validators (ETag / Last-Modified) of the AJAX responses, their compression, fingerprinted static files"""
+
+import gzip
+import hashlib
+import os
+import threading
+from datetime import timezone
+
+from flask import Response, request
+from werkzeug.security import safe_join
+
+try:
+    import brotli  # (optional: smaller than gzip, for the browsers that accept it)
+except ImportError:
+    brotli = None
+
+
+COMPRESSED_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'text/javascript',
+                        'application/javascript'}
+MIN_COMPRESSED_SIZE = 1024  # bytes (a smaller response is sent as it is)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # (of 11: the higher ones are too slow for a response that is compressed every time)
+STATIC_MAX_AGE = 365 * 24 * 3600  # seconds - for the fingerprinted static files
+
+
+def make_etag(*parts):
+    """ An ETag from the values the response is made of (the same values - the same ETag) """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:32]
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Whether the client already has this version of the response (If-None-Match, or If-Modified-Since without it).
+    `last_modified` - a naive datetime in UTC (or None)
+    (the validators are checked here for POST as well - the AJAX requests only read with it)
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None):
+    """
+    Add the ETag (weak - the compressed response has other bytes) and the Last-Modified to the response
+    (the client must check them every time: 'no-cache')
+    """
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified_response(etag, last_modified=None):
+    """ 304 Not Modified (without a body - the client uses its copy) """
+    return set_validators(Response(status=304), etag, last_modified)
+
+
+def choose_encoding(accept_encodings):
+    """ 'br' / 'gzip' / None - the best encoding the client accepts (`request.accept_encodings`) """
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+class ResponseCompression:
+    """
+    Compresses the responses of the Flask `app` (gzip, or brotli - if the `brotli` package is installed)
+    that are at least `min_size` bytes long and of one of the `mimetypes`.
+    (not the streamed responses - the events, and not the files - they are sent as they are)
+    """
+
+    def __init__(self, app, min_size=MIN_COMPRESSED_SIZE, mimetypes=COMPRESSED_MIMETYPES):
+        self.min_size = min_size
+        self.mimetypes = mimetypes
+        self.counters = {'compressed': 0, 'bytes_before': 0, 'bytes_after': 0}
+        self._lock = threading.Lock()
+        app.after_request(self._after_request)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def _after_request(self, response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or response.mimetype not in self.mimetypes or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        data = response.get_data()
+        if encoding is None or len(data) < self.min_size:
+            return response
+        compressed = compress(data, encoding)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)  # (a strong ETag is for the exact bytes)
+        with self._lock:
+            self.counters['compressed'] += 1
+            self.counters['bytes_before'] += len(data)
+            self.counters['bytes_after'] += len(compressed)
+        return response
+
+
+class StaticFingerprints:
+    """
+    `url_for('static', filename=...)` gets `?v=<hash of the file's content>`, and the static files
+    requested with the current hash are cached by the browsers for a year ('immutable'):
+    when a file changes, its URL changes too - so the browsers never use an old version.
+    (the hash of a file is computed again only when its modification time changes)
+    """
+
+    def __init__(self, app, max_age=STATIC_MAX_AGE):
+        self.static_folder = app.static_folder
+        self.max_age = max_age
+        self._hashes = {}  # filename -> (modification time, hash)
+        self._lock = threading.Lock()
+        app.url_defaults(self._url_defaults)
+        app.after_request(self._after_request)
+
+    def fingerprint(self, filename):
+        """ The hash of the static file (None - there is no such file) """
+        path = safe_join(self.static_folder, filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (TypeError, OSError):  # (TypeError: the path is outside of the static folder)
+            return None
+        with self._lock:
+            cached = self._hashes.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            fingerprint = hashlib.sha256(f.read()).hexdigest()[:12]
+        with self._lock:
+            self._hashes[filename] = (mtime, fingerprint)
+        return fingerprint
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            fingerprint = self.fingerprint(values['filename'])
+            if fingerprint is not None:
+                values['v'] = fingerprint
+
+    def _after_request(self, response):
+        if request.endpoint != 'static' or response.status_code not in (200, 304) or not request.args.get('v'):
+            return response
+        if request.args['v'] == self.fingerprint(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
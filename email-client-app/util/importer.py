@@ -0,0 +1,297 @@
+"""Import of a whole mailbox: all the messages of all the folders (resumable, with bounded memory)"""
+
+import logging
+import re
+import threading
+import time
+from datetime import datetime
+from imap_tools import MailMessage, MailboxFetchError
+from imap_tools.utils import check_command_status, chunked
+
+from .bulk import parse_uid_set, to_uid_sets
+from .sync import FETCH_UID_RE, get_folder_status
+
+
+logger = logging.getLogger(__name__)
+
+FETCH_SIZE_RE = re.compile(r'RFC822\.SIZE (\d+)')
+
+
+class MailboxImporter:
+    """
+    Imports the messages of an account that the sync doesn't fetch: the sync stores the newest
+    `n_initial` messages of a folder and then only the new ones - the importer walks all the older ones.
+
+    Every folder is walked in chunks of uids, through a pipeline of generators
+    (so only one fetch of messages is in memory at a time):
+        search (UID SEARCH over a window of `search_window` uids, at most `chunk` uids are taken)
+        -> fetch (UID FETCH of the headers; with `bodies` - of the whole messages, split so that
+                  one fetch is at most `max_fetch_bytes`, by their RFC822.SIZE)
+        -> parse (`MailMessage`)
+        -> store (one write job per fetch: the rows, the counters, the search index (see `SyncEngine`),
+                  and the checkpoint of the folder - in the same transaction)
+
+    - the checkpoint (`Folder.import_next_uid`, `Folder.imported_at` when the folder is done) is in the
+      database: after a log out or a restart, `start` goes on from the last stored fetch
+    - a pooled connection is taken for one chunk at a time
+      (in between, the sync and the requests of the user can use it)
+    - the import of a folder starts after its first sync, below the UIDNEXT the sync has seen
+      (the sync stores the messages above it - they never store the same ones)
+    - `progress(email)` - how far it is; `on_progress(email, progress)` is called after every fetch
+      and when the import ends
+    """
+
+    def __init__(self, app, sync_engine, mailbox_pool, folder_cache, User, bodies=False, request_sync=None,
+                 chunk=500, search_window=50000, max_fetch_bytes=8 * 1024 * 1024, sync_timeout=300,
+                 on_progress=None):
+        self.app = app
+        self.sync_engine = sync_engine
+        self.db = sync_engine.db
+        self.Email = sync_engine.Email
+        self.Folder = sync_engine.Folder
+        self.mailbox_pool = mailbox_pool
+        self.folder_cache = folder_cache
+        self.User = User
+        self.bodies = bodies  # download the whole messages (False - only the headers, like the sync)
+        # `request_sync(email, folder)` - ask for the first sync of a folder (e.g. `SyncScheduler.request_sync`):
+        self.request_sync = request_sync
+        self.chunk = chunk
+        self.search_window = search_window
+        self.max_fetch_bytes = max_fetch_bytes
+        self.sync_timeout = sync_timeout  # seconds to wait for the first sync of a folder
+        self.on_progress = on_progress
+        self._imports = {}  # email -> {'thread', 'stop' (Event), 'progress'}
+        self._lock = threading.Lock()
+
+    def start(self, email, password):
+        """ Start (or go on with) the import of the account, in a background thread """
+        with self._lock:
+            running = self._imports.get(email)
+            if running is not None and running['thread'].is_alive() and not running['stop'].is_set():
+                return
+            # (an import that is being stopped - e.g. by a log out right before - is waited for by the new one)
+            previous = running['thread'] if running is not None else None
+            state = {'stop': threading.Event(),
+                     'progress': {'state': 'running', 'folder': None, 'folders': 0, 'folders_done': 0,
+                                  'imported': 0, 'stored': 0, 'total': 0, 'messages_per_second': 0,
+                                  'error': None}}
+            state['thread'] = threading.Thread(target=self._run, args=(email, password, state, previous),
+                                               name=f'import-{email}', daemon=True)
+            self._imports[email] = state
+            state['thread'].start()
+
+    def stop(self, email):
+        """ Stop the import after the current fetch (e.g. on log out); `start` goes on from there """
+        with self._lock:
+            state = self._imports.get(email)
+        if state is not None:
+            state['stop'].set()
+
+    def progress(self, email):
+        """ {'state': running / done / stopped / failed, 'folder', 'folders', 'folders_done',
+             'imported' (by this run), 'stored' (all the messages stored now), 'total' (on the server), ...}
+            None - if the import was not started (since the app started) """
+        with self._lock:
+            state = self._imports.get(email)
+            return dict(state['progress']) if state is not None else None
+
+
+    # Run by the import threads:
+
+    def _run(self, email, password, state, previous=None):
+        if previous is not None:
+            previous.join()
+        progress = state['progress']
+        started = time.monotonic()
+        with self.app.app_context():
+            try:
+                owner = self.db.session.execute(
+                    self.db.select(self.User).where(self.User.username == email)).scalar_one()
+                with self.mailbox_pool.connection(email, password) as mailbox:
+                    self.folder_cache.get(owner, mailbox)
+                    folders = self.db.session.execute(
+                        self.db.select(self.Folder).where(self.Folder.owner_id == owner.id)
+                        .order_by(self.Folder.name != 'inbox', self.Folder.name)
+                    ).scalars().all()
+                    totals = {folder.folder_id: self._server_count(mailbox, folder) for folder in folders}
+                progress.update(folders=len(folders), total=sum(totals.values()),
+                                folders_done=sum(folder.imported_at is not None for folder in folders),
+                                stored=self._count_stored(owner.id))
+                for folder in folders:
+                    if folder.imported_at is not None:
+                        continue
+                    if state['stop'].is_set():
+                        progress['state'] = 'stopped'
+                        return
+                    progress['folder'] = folder.name
+                    if self._import_folder(email, password, folder, state, started):
+                        progress['folders_done'] += 1
+                    progress['stored'] = self._count_stored(owner.id)  # (+ what the sync has stored meanwhile)
+                progress['state'] = 'stopped' if state['stop'].is_set() else 'done'
+            except Exception as e:
+                logger.exception('Import of %s failed', email)
+                progress.update(state='failed', error=str(e))
+            finally:
+                self.db.session.remove()
+                self._report(email, progress)
+
+    def _count_stored(self, owner_id):
+        return self.db.session.scalar(
+            self.db.select(self.db.func.coalesce(self.db.func.sum(self.Folder.n_messages), 0))
+            .where(self.Folder.owner_id == owner_id))
+
+    @staticmethod
+    def _server_count(mailbox, folder):
+        try:
+            return get_folder_status(mailbox, folder.server_name).get('MESSAGES', 0)
+        except Exception:
+            return 0  # (the folder can't be read - it's only for the progress)
+
+    def _import_folder(self, email, password, folder, state, started):
+        """ Import the folder from its checkpoint. Returns whether the folder is done """
+        progress = state['progress']
+        if folder.uidvalidity is None and not self._wait_for_sync(email, folder, state):
+            return False
+        folder_id, uidvalidity, until = folder.folder_id, folder.uidvalidity, folder.uidnext or 1
+        next_uid = folder.import_next_uid or 1
+        while next_uid < until:
+            if state['stop'].is_set():
+                return False
+            last_uid = min(next_uid + self.search_window, until) - 1
+            with self.mailbox_pool.connection(email, password) as mailbox:
+                mailbox.folder.set(folder.server_name, readonly=True)
+                uids = self._search(mailbox, next_uid, last_uid)
+                if len(uids) > self.chunk:
+                    uids = uids[:self.chunk]
+                    last_uid = uids[-1]
+                stored_until = next_uid
+                for batch, messages in self._parse(self._fetch(mailbox, self._batches(mailbox, uids))):
+                    stored_until = batch[-1] + 1
+                    n = self.sync_engine.write(self._store, folder_id, uidvalidity, messages, stored_until)
+                    if n is None:
+                        return False  # (the folder was reset by the sync - UIDVALIDITY has changed)
+                    progress['imported'] += n
+                    progress['stored'] += n
+                    progress['messages_per_second'] = round(progress['imported'] / (time.monotonic() - started), 1)
+                    self._report(email, progress)
+            next_uid = last_uid + 1
+            if stored_until < next_uid:
+                if self.sync_engine.write(self._save_checkpoint, folder_id, uidvalidity, next_uid) is None:
+                    return False
+        self.db.session.commit()  # (ends the read transaction - the folder was changed by the writer)
+        return self.sync_engine.write(self._save_checkpoint, folder_id, uidvalidity, until, True) is not None
+
+    def _wait_for_sync(self, email, folder, state):
+        """ Wait until the folder is synced for the first time (its UIDVALIDITY and UIDNEXT are known) """
+        if self.request_sync is not None:
+            try:
+                self.request_sync(email, folder.name)
+            except KeyError:
+                return False  # (the account is not synced anymore - logged out)
+        deadline = time.monotonic() + self.sync_timeout
+        while folder.uidvalidity is None:
+            if state['stop'].is_set() or time.monotonic() > deadline:
+                return False
+            time.sleep(0.5)
+            self.db.session.commit()  # (the next read sees what the sync has written)
+        return True
+
+    def _report(self, email, progress):
+        if self.on_progress is not None:
+            self.on_progress(email, dict(progress))
+
+
+    # The pipeline (run in the import thread, with the connection of the chunk):
+
+    @staticmethod
+    def _search(mailbox, first_uid, last_uid):
+        """ The uids of the messages in [first_uid, last_uid] """
+        typ, data = mailbox.client.uid('SEARCH', 'UID', f'{first_uid}:{last_uid}')
+        if typ != 'OK' or not data or not data[0]:
+            return []
+        # (a server answers "UID n:m" with the last message, even if its uid < n)
+        return sorted(uid for uid in map(int, data[0].split()) if first_uid <= uid <= last_uid)
+
+    def _batches(self, mailbox, uids):
+        """ Split the uids into fetches (with the bodies - at most `max_fetch_bytes` each) """
+        if not uids:
+            return
+        if not self.bodies:
+            yield uids
+            return
+        sizes = {}
+        for uid_set in to_uid_sets(uids):
+            typ, data = mailbox.client.uid('FETCH', uid_set, '(UID RFC822.SIZE)')
+            if typ != 'OK':
+                continue
+            for item in data:
+                item = item[0] if type(item) is tuple else item
+                if not item:
+                    continue
+                item = item.decode()
+                uid, size = FETCH_UID_RE.search(item), FETCH_SIZE_RE.search(item)
+                if uid and size:
+                    sizes[int(uid.group(1))] = int(size.group(1))
+        batch, batch_bytes = [], 0
+        for uid in uids:
+            size = sizes.get(uid, 0)
+            if batch and batch_bytes + size > self.max_fetch_bytes:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(uid)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _fetch(self, mailbox, batches):
+        """ One UID FETCH per batch (per UID set) -> (its uids, [fetched data of a message, ...]) """
+        parts = f"(UID FLAGS RFC822.SIZE BODY.PEEK[{'' if self.bodies else 'HEADER'}])"
+        for batch in batches:
+            for uid_set in to_uid_sets(batch):
+                fetch_result = mailbox.client.uid('FETCH', uid_set, parts)
+                check_command_status(fetch_result, MailboxFetchError)
+                # (the data of a message: (b'1 (UID ... {size}', b'<message>'), b')')
+                items = [item for item in chunked(fetch_result[1], 2) if type(item[0]) is tuple]
+                yield parse_uid_set(uid_set), items
+
+    def _parse(self, fetched):
+        """ -> (batch, [(row of `_header_row`, raw message or None, `MailMessage` or None), ...]) """
+        for batch, items in fetched:
+            messages = []
+            for item in items:
+                msg = MailMessage(item)
+                if self.bodies:
+                    messages.append((self.sync_engine._header_row(msg), item[0][1], msg))
+                else:
+                    messages.append((self.sync_engine._header_row(msg), None, None))
+            yield batch, messages
+
+
+    # Write jobs:
+
+    def _store(self, folder_id, uidvalidity, messages, next_uid):
+        """ Store the fetched messages and the checkpoint. Returns the number of the new ones (None - reset) """
+        folder = self.db.session.get(self.Folder, folder_id)
+        if folder.uidvalidity != uidvalidity:
+            return None
+        new_uids = self.sync_engine._store_new_messages(folder_id, [row for row, _, _ in messages])
+        if self.bodies and new_uids:
+            fetched = {row['uid']: (raw, msg) for row, raw, msg in messages}
+            emails = self.db.session.execute(
+                self.db.select(self.Email)
+                .where(self.Email.folder_id == folder_id)
+                .where(self.Email.uid.in_(new_uids))
+            ).scalars().all()
+            for email in emails:
+                self.sync_engine.store_message(email, *fetched[email.uid])
+        folder.import_next_uid = next_uid
+        return len(new_uids)
+
+    def _save_checkpoint(self, folder_id, uidvalidity, next_uid, done=False):
+        folder = self.db.session.get(self.Folder, folder_id)
+        if folder.uidvalidity != uidvalidity:
+            return None
+        folder.import_next_uid = next_uid
+        if done:
+            folder.imported_at = datetime.utcnow()
+        return next_uid
@@ -0,0 +1,79 @@
+"""Bulk writes to the local database (a few statements per batch, not one per row)"""
+
+from itertools import islice
+
+
+def dialect_insert(db, table):
+    """ INSERT statement that supports ON CONFLICT (in SQLite and in PostgreSQL) """
+    # (imported here: only the dialect of the database is needed - importing the other one slows down the start)
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def batched(iterable, size):
+    """ Split an iterable into lists of `size` items (the last one can be shorter) """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def upsert_folders(db, Folder, owner_id, folder_mapping, listed_at):
+    """
+    Insert the owner's folders, or update them if they already exist
+    (one INSERT ... ON CONFLICT DO UPDATE for all the folders)
+    """
+    rows = [{'owner_id': owner_id,
+             'name': name,
+             'server_name': server_name,
+             'listed_at': listed_at}
+            for name, server_name in folder_mapping.items()]
+    if not rows:
+        return
+    statement = dialect_insert(db, Folder)
+    statement = statement.on_conflict_do_update(
+        index_elements=['owner_id', 'name'],
+        set_={'server_name': statement.excluded.server_name,
+              'listed_at': statement.excluded.listed_at},
+    )
+    db.session.execute(statement, rows)
+
+
+def get_existing_uids(db, Email, folder, uids):
+    """ Which of the `uids` are already stored in the folder: {uid: email_id} (one query) """
+    if not uids:
+        return {}
+    rows = db.session.execute(
+        db.select(Email.uid, Email.email_id)
+        .where(Email.owner_id == folder.owner_id)
+        .where(Email.folder_id == folder.folder_id)
+        .where(Email.uid.in_(uids))
+    ).all()
+    return {row.uid: row.email_id for row in rows}
+
+
+def insert_emails(db, Email, folder, rows):
+    """
+    Insert new emails of the folder (one multi-row INSERT ... ON CONFLICT DO NOTHING).
+    `rows` - list of dicts with the `Email` attributes (`folder_id` is added here).
+    Returns the uids of the inserted emails (an email already stored - e.g. by another process
+    syncing the same folder - is skipped, not an error).
+    """
+    if not rows:
+        return set()
+    rows = [{**row, 'folder_id': folder.folder_id} for row in rows]
+    statement = dialect_insert(db, Email).on_conflict_do_nothing(
+        index_elements=['owner_id', 'folder_id', 'uid'],
+    )
+    return set(db.session.scalars(statement.returning(Email.uid), rows))
+
+
+def update_emails(db, Email, rows):
+    """ Update emails by their ids (`rows` - list of dicts with `email_id` and the changed attributes) """
+    if rows:
+        db.session.execute(db.update(Email), rows)
@@ -0,0 +1,390 @@
+"""Instrumentation: the IMAP commands, SMTP commands and SQL statements - counted and timed, per request"""
+
+import contextvars
+import imaplib
+import smtplib
+import threading
+import time
+
+from flask import request
+from imap_tools import MailBox, MailBoxUnencrypted
+from sqlalchemy import event
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+CALLS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)  # calls to a backend per request
+SQL_KINDS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')  # (the other statements are counted as 'OTHER')
+
+# The calls of the request that is handled in this thread (`RequestMetrics`), None - not in a request
+# (the background threads - the sync, the outbox, the write queue - are counted only in the `Metrics`):
+_current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class Metrics:
+    """
+    Counters and histograms of the process, in the Prometheus text format (`render`).
+
+    - a metric is identified by its name and its labels (a dict)
+    - `add_collector(name, function)`: the numbers of `function()` (e.g. the `stats()` of a pool)
+      are added as `<prefix>_<name>{stat="..."}` every time the metrics are rendered
+
+    (every worker process has its own metrics - they are scraped from each one)
+    """
+
+    def __init__(self, prefix='email_client'):
+        self.prefix = prefix
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self._buckets = {}  # histogram name -> buckets
+        self._help = {}  # name -> (type, help)
+        self._collectors = []  # [(name, function, help), ...]
+        self._lock = threading.Lock()
+
+    def describe(self, name, type_, help_):
+        self._help[name] = (type_, help_)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=DURATION_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._buckets.setdefault(name, buckets)
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def add_collector(self, name, function, help_=''):
+        self._collectors.append((name, function, help_))
+
+    def render(self):
+        """ All the metrics, in the Prometheus text exposition format (version 0.0.4) """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(counts)) for key, counts in self._histograms.items())
+        lines = []
+        described = set()
+
+        def header(name, default_type):
+            if name not in described:
+                described.add(name)
+                type_, help_ = self._help.get(name, (default_type, ''))
+                if help_:
+                    lines.append(f'# HELP {self.prefix}_{name} {help_}')
+                lines.append(f'# TYPE {self.prefix}_{name} {type_}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{self.prefix}_{name}{format_labels(labels)} {format_number(value)}')
+        for (name, labels), counts in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self._buckets[name], counts):
+                cumulative += count
+                lines.append(f'{self.prefix}_{name}_bucket{format_labels(labels + (("le", format_number(bound)),))} '
+                             f'{cumulative}')
+            lines.append(f'{self.prefix}_{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {counts[-1]}')
+            lines.append(f'{self.prefix}_{name}_sum{format_labels(labels)} {format_number(counts[-2])}')
+            lines.append(f'{self.prefix}_{name}_count{format_labels(labels)} {counts[-1]}')
+        for name, function, help_ in self._collectors:
+            if help_:
+                lines.append(f'# HELP {self.prefix}_{name} {help_}')
+            lines.append(f'# TYPE {self.prefix}_{name} untyped')
+            for stat, value in flatten(function()):
+                lines.append(f'{self.prefix}_{name}{format_labels((("stat", stat),))} {format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('backend_calls_total', 'counter', 'IMAP / SMTP commands and SQL statements')
+metrics.describe('backend_call_duration_seconds', 'histogram', 'Duration of the IMAP / SMTP commands and SQL statements')
+metrics.describe('backend_bytes_total', 'counter', 'Bytes sent to / received from the IMAP and SMTP servers')
+metrics.describe('http_requests_total', 'counter', 'Handled requests')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Duration of the requests')
+metrics.describe('request_backend_calls', 'histogram', 'Calls to a backend per request')
+metrics.describe('request_backend_seconds', 'histogram', 'Time spent in a backend per request')
+
+
+class RequestMetrics:
+    """ What one request did: (backend, command) -> [calls, seconds, bytes received, bytes sent] """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = {}
+
+    def add(self, backend, command, seconds, received, sent):
+        totals = self.calls.get((backend, command))
+        if totals is None:
+            totals = self.calls[(backend, command)] = [0, 0.0, 0, 0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += received
+        totals[3] += sent
+
+    def by_backend(self):
+        """ backend -> [calls, seconds, bytes received, bytes sent] """
+        backends = {}
+        for (backend, _), totals in self.calls.items():
+            backend_totals = backends.setdefault(backend, [0, 0.0, 0, 0])
+            for i, value in enumerate(totals):
+                backend_totals[i] += value
+        return backends
+
+    def server_timing(self, seconds):
+        """
+        The `Server-Timing` header: the time of every command (the slowest first), and of the whole request,
+        e.g. 'imap.LOGIN;dur=41.2;desc="1x", db.SELECT;dur=3.5;desc="12x", total;dur=52.0'
+        (shown in the Network panel of the browser's developer tools)
+        """
+        entries = [f'{backend}.{command.replace(" ", "-")};dur={totals[1] * 1000:.1f};desc="{totals[0]}x"'
+                   for (backend, command), totals in sorted(self.calls.items(), key=lambda item: -item[1][1])]
+        entries.append(f'total;dur={seconds * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def record(backend, command, seconds, received=0, sent=0):
+    """ Count one call to a backend ('imap' / 'smtp' / 'db'): in the current request (if any), and in the `metrics` """
+    request_metrics = _current_request.get()
+    if request_metrics is not None:
+        request_metrics.add(backend, command, seconds, received, sent)
+    labels = {'backend': backend, 'command': command}
+    metrics.inc('backend_calls_total', labels)
+    metrics.observe('backend_call_duration_seconds', labels, seconds)
+    if received:
+        metrics.inc('backend_bytes_total', dict(labels, direction='received'), received)
+    if sent:
+        metrics.inc('backend_bytes_total', dict(labels, direction='sent'), sent)
+
+
+class RequestInstrumentation:
+    """
+    Collects the calls of every request of the Flask `app` (`RequestMetrics`), and at its end:
+    - adds them to the `metrics` (by endpoint)
+    - adds the `Server-Timing` header to the response (if `server_timing`)
+    - gives the request to the `profiler` (`SlowRequestProfiler`, optional) - it keeps the profile if it was slow
+    """
+
+    def __init__(self, app, server_timing=True, profiler=None):
+        self.server_timing = server_timing
+        self.profiler = profiler
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    @staticmethod
+    def current():
+        """ The `RequestMetrics` of the current request (None - outside of a request) """
+        return _current_request.get()
+
+    def _before_request(self):
+        _current_request.set(RequestMetrics())
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def _after_request(self, response):
+        request_metrics = _current_request.get()
+        if request_metrics is None:
+            return response
+        seconds = time.perf_counter() - request_metrics.started
+        endpoint = request.endpoint or 'unknown'  # (not the path - so the number of the label values is bounded)
+        metrics.inc('http_requests_total', {'endpoint': endpoint, 'method': request.method,
+                                            'status': str(response.status_code)})
+        metrics.observe('http_request_duration_seconds', {'endpoint': endpoint}, seconds)
+        by_backend = request_metrics.by_backend()
+        for backend in ('imap', 'smtp', 'db'):
+            calls, backend_seconds, _, _ = by_backend.get(backend, (0, 0.0, 0, 0))
+            metrics.observe('request_backend_calls', {'endpoint': endpoint, 'backend': backend}, calls, CALLS_BUCKETS)
+            metrics.observe('request_backend_seconds', {'endpoint': endpoint, 'backend': backend}, backend_seconds)
+        if self.server_timing:
+            response.headers['Server-Timing'] = request_metrics.server_timing(seconds)
+        if self.profiler is not None:
+            self.profiler.stop(endpoint, seconds, request_metrics)
+        return response
+
+    def _teardown_request(self, exception):
+        if self.profiler is not None:
+            self.profiler.cancel()  # (if the request failed before `_after_request`)
+        _current_request.set(None)
+
+
+# IMAP (`imaplib`, under `imap_tools.MailBox`):
+
+class InstrumentedIMAP4Mixin:
+    """ Every command of the connection is recorded ('imap', e.g. 'UID FETCH'), with the bytes it sent and received """
+
+    bytes_received = 0
+    bytes_sent = 0
+
+    def open(self, *args, **kwargs):
+        # (TCP connect + the TLS handshake)
+        started = time.perf_counter()
+        try:
+            return super().open(*args, **kwargs)
+        finally:
+            record('imap', 'CONNECT', time.perf_counter() - started)
+
+    def read(self, size):
+        data = super().read(size)
+        self.bytes_received += len(data)
+        return data
+
+    def readline(self):
+        line = super().readline()
+        self.bytes_received += len(line)
+        return line
+
+    def send(self, data):
+        super().send(data)
+        self.bytes_sent += len(data)
+
+    def _simple_command(self, name, *args):
+        command = f'UID {args[0].upper()}' if name == 'UID' and args else name
+        received, sent, started = self.bytes_received, self.bytes_sent, time.perf_counter()
+        try:
+            return super()._simple_command(name, *args)
+        finally:
+            record('imap', command, time.perf_counter() - started,
+                   self.bytes_received - received, self.bytes_sent - sent)
+
+
+class InstrumentedIMAP4(InstrumentedIMAP4Mixin, imaplib.IMAP4):
+    pass
+
+
+class InstrumentedIMAP4_SSL(InstrumentedIMAP4Mixin, imaplib.IMAP4_SSL):
+    pass
+
+
+class InstrumentedMailBox(MailBox):
+    """ `MailBox` (TLS) with its commands recorded """
+
+    def _get_mailbox_client(self):
+        return InstrumentedIMAP4_SSL(self._host, self._port, ssl_context=self._ssl_context, timeout=self._timeout)
+
+
+class InstrumentedMailBoxUnencrypted(MailBoxUnencrypted):
+    """ `MailBoxUnencrypted` with its commands recorded """
+
+    def _get_mailbox_client(self):
+        return InstrumentedIMAP4(self._host, self._port, timeout=self._timeout)
+
+
+# SMTP (`smtplib`):
+
+class InstrumentedSMTPMixin:
+    """
+    The commands of the session are recorded ('smtp', e.g. 'SEND' - the whole `sendmail` or `send_file`),
+    with the bytes sent.
+    (only the outermost one - `login` runs EHLO itself, which is not recorded again)
+    """
+
+    bytes_sent = 0
+    _depth = 0
+
+    def send(self, s):
+        super().send(s)
+        self.bytes_sent += len(s)
+
+    def _timed(self, command, method, *args, **kwargs):
+        self._depth += 1
+        sent, started = self.bytes_sent, time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                record('smtp', command, time.perf_counter() - started, sent=self.bytes_sent - sent)
+
+    def connect(self, *args, **kwargs):
+        return self._timed('CONNECT', super().connect, *args, **kwargs)
+
+    def ehlo(self, *args, **kwargs):
+        return self._timed('EHLO', super().ehlo, *args, **kwargs)
+
+    def starttls(self, *args, **kwargs):
+        return self._timed('STARTTLS', super().starttls, *args, **kwargs)
+
+    def login(self, *args, **kwargs):
+        return self._timed('LOGIN', super().login, *args, **kwargs)
+
+    def sendmail(self, *args, **kwargs):
+        return self._timed('SEND', super().sendmail, *args, **kwargs)
+
+    def send_file(self, sender, recipients, file):
+        """ `util.smtp.send_file` - the message is read from the file while it's sent """
+        from .smtp import send_file  # (smtp.py imports this module)
+        return self._timed('SEND', send_file, self, sender, recipients, file)
+
+    def noop(self):
+        return self._timed('NOOP', super().noop)
+
+    def quit(self):
+        return self._timed('QUIT', super().quit)
+
+
+class InstrumentedSMTP(InstrumentedSMTPMixin, smtplib.SMTP):
+    pass
+
+
+class InstrumentedSMTP_SSL(InstrumentedSMTPMixin, smtplib.SMTP_SSL):
+    pass
+
+
+# SQL (SQLAlchemy):
+
+def instrument_engine(engine):
+    """ Record every SQL statement of the `engine` ('db', by its kind: 'SELECT' / 'INSERT' / ...) """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.instrumentation_started = time.perf_counter()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'instrumentation_started', None)
+    if started is not None:
+        record('db', statement_kind(statement), time.perf_counter() - started)
+
+
+def statement_kind(statement):
+    words = statement.split(None, 1)
+    kind = words[0].upper() if words else ''
+    return kind if kind in SQL_KINDS else 'OTHER'
+
+
+# Prometheus text format:
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(str(value))}"' for key, value in labels) + '}'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(int(value))
+
+
+def flatten(stats, prefix=''):
+    """ {'hits': 3, 'smtp_pool': {'misses': 1}} -> [('hits', 3), ('smtp_pool_misses', 1)] (only the numbers) """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}_')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
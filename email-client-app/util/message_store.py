@@ -0,0 +1,128 @@
+"""Raw messages (.eml files) as downloaded from the server, and a cache of the parsed ones"""
+
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+from imap_tools import MailMessage
+
+
+HEADER_END = b'\r\n\r\n'
+
+
+class RawMessageStore:
+    """
+    Every downloaded message is saved once, exactly as the server sent it
+    (with the HTML part and the whole MIME structure), as <root>/<owner_id>/<email_id>.eml.
+    So opening a message again, showing its HTML or re-indexing it - never downloads it again.
+
+    - a file is written to a temporary file and renamed into place (it's always complete)
+    - a file is read with mmap (the pages come from the OS page cache, without a copy per read),
+      and parsed only when it's needed:
+      - `headers(path)` - parses only the header block
+      - `message(path)` - the whole `MailMessage`, kept in an LRU cache
+    - the cache holds at most `cache_bytes` of messages (counted by their raw size),
+      the least recently used ones are dropped first
+    """
+
+    def __init__(self, root, cache_bytes=64 * 1024 * 1024):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()  # path -> (MailMessage, size) (the most recently used - at the end)
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'writes': 0}
+
+    def path(self, owner_id, email_id):
+        return os.path.join(self.root, str(owner_id), f'{email_id}.eml')
+
+    def put(self, owner_id, email_id, raw):
+        """ Save the raw message (bytes). Returns its path """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        path = self.path(owner_id, email_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._remove_from_cache(path)  # (in case an older version was cached)
+            self.counters['writes'] += 1
+        return path
+
+    def read(self, path):
+        """ Map the file into memory (read-only). Use as a context manager: `with store.read(path) as raw:` """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return _EmptyMap()  # (an empty file can't be mapped)
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def headers(self, path):
+        """ Parse only the headers of the message (`email.message.Message` without the body) """
+        with self.read(path) as raw:
+            end = raw.find(HEADER_END)
+            header_block = raw[:end + len(HEADER_END)] if end != -1 else raw[:]
+        return BytesHeaderParser(policy=compat32).parsebytes(header_block)
+
+    def message(self, path):
+        """ The parsed message (`MailMessage`), from the cache if possible """
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached is not None:
+                self._cache.move_to_end(path)
+                self.counters['hits'] += 1
+                return cached[0]
+            self.counters['misses'] += 1
+        with self.read(path) as raw:
+            size = len(raw)
+            message = MailMessage.from_bytes(raw[:])
+        with self._lock:
+            if path not in self._cache and size <= self.cache_bytes:
+                self._cache[path] = (message, size)
+                self._cached_bytes += size
+                while self._cached_bytes > self.cache_bytes:
+                    _, (_, evicted_size) = self._cache.popitem(last=False)
+                    self._cached_bytes -= evicted_size
+                    self.counters['evictions'] += 1
+        return message
+
+    def discard(self, path):
+        """ Delete the file (e.g. the message was deleted) """
+        with self._lock:
+            self._remove_from_cache(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, cached_messages=len(self._cache),
+                        cached_bytes=self._cached_bytes, cache_bytes=self.cache_bytes)
+
+
+    # Must be run with the lock held:
+
+    def _remove_from_cache(self, path):
+        cached = self._cache.pop(path, None)
+        if cached is not None:
+            self._cached_bytes -= cached[1]
+
+
+class _EmptyMap(bytes):
+    """ Stands in for the mmap of an empty file """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
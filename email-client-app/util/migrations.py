@@ -0,0 +1,394 @@
+"""Revisions of the database schema (to upgrade an existing emails.db in place)"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, text
+
+from .compression import decompress
+from .search import create_search_index
+
+
+BATCH_SIZE = 1000  # rows (of a revision that changes them one by one - they are not all loaded at once)
+
+def upgrade_schema(db):
+    """
+    Apply the revisions that the database doesn't have yet, then create the missing tables
+    (and the full-text search index, which is not a part of the models).
+    The number of the last applied revision is stored in the `schema_version` table.
+    All of it is one transaction: if a revision fails, the database is left as it was.
+    Must be run with app context.
+    """
+    with schema_transaction(db.engine) as connection:
+        tables = inspect(connection).get_table_names()
+        if 'schema_version' not in tables:
+            connection.execute(text('CREATE TABLE schema_version (version INTEGER NOT NULL)'))
+        version = connection.execute(text('SELECT version FROM schema_version')).scalar()
+        if version is None:
+            # (a new database is created right away with the current schema;
+            #  an old one - also with an empty `schema_version`, left by an upgrade of an earlier version that failed)
+            version = 0 if 'email' in tables else len(REVISIONS)
+            connection.execute(text('INSERT INTO schema_version (version) VALUES (:version)'),
+                               {'version': version})
+        for number, revision in enumerate(REVISIONS[version:], start=version + 1):
+            revision(connection, db.metadata)
+            connection.execute(text('UPDATE schema_version SET version = :version'), {'version': number})
+        db.metadata.create_all(connection)
+        create_search_index(connection)
+        create_folder_version_triggers(connection)
+
+
+@contextmanager
+def schema_transaction(engine):
+    """
+    A connection in a transaction that includes the DDL statements (CREATE / ALTER / DROP),
+    committed at the end of the block, or rolled back if it raises.
+    (pysqlite doesn't begin a transaction before a DDL statement - it would be committed on its own:
+    so for SQLite the driver is in autocommit mode, and the transaction is begun and ended here)
+    """
+    if engine.dialect.name != 'sqlite':
+        with engine.begin() as connection:
+            yield connection
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')  # (IMMEDIATE - the other writers wait until it's done)
+        try:
+            yield connection
+        except BaseException:
+            connection.exec_driver_sql('ROLLBACK')
+            raise
+        connection.exec_driver_sql('COMMIT')
+
+
+def schema_version(engine):
+    """ The number of the last revision applied to the database (None - the schema was never created) """
+    with engine.connect() as connection:
+        if 'schema_version' not in inspect(connection).get_table_names():
+            return None
+        return connection.execute(text('SELECT version FROM schema_version')).scalar()
+
+
+def check_schema(db):
+    """
+    Raise RuntimeError if the database is not at the current schema revision
+    (the schema is created / upgraded only by `flask --app app migrate` - not by every process that starts).
+    Must be run with app context.
+    """
+    version = schema_version(db.engine)
+    if version != len(REVISIONS):
+        state = 'has no schema' if version is None else f'is at revision {version} of {len(REVISIONS)}'
+        raise RuntimeError(f'The database {state} - run `flask --app app migrate` first')
+
+
+# Every change of the emails of a folder increments its `version` (and sets its `changed_at`)
+# - so a listing can be validated (ETag / Last-Modified) without reading the emails:
+FOLDER_VERSION_TRIGGERS_SQL = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS email_folder_version_insert AFTER INSERT ON email BEGIN
+        UPDATE folder SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE id = new.folder_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS email_folder_version_update AFTER UPDATE ON email BEGIN
+        UPDATE folder SET version = version + 1, changed_at = CURRENT_TIMESTAMP
+        WHERE id IN (old.folder_id, new.folder_id);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS email_folder_version_delete AFTER DELETE ON email BEGIN
+        UPDATE folder SET version = version + 1, changed_at = CURRENT_TIMESTAMP WHERE id = old.folder_id;
+    END
+    ''',
+]
+
+
+def create_folder_version_triggers(connection):
+    """ Create the triggers of `FOLDER_VERSION_TRIGGERS_SQL` (if they don't exist yet). Only for SQLite """
+    if connection.dialect.name != 'sqlite':
+        return
+    for trigger in FOLDER_VERSION_TRIGGERS_SQL:
+        connection.execute(text(trigger))
+
+
+def has_folder_versions(engine):
+    """ Whether the folder versions are maintained by the database (see `create_folder_version_triggers`) """
+    return engine.dialect.name == 'sqlite'
+
+
+def add_missing_columns(connection, table, columns):
+    """ ALTER TABLE ... ADD COLUMN for the columns the table doesn't have yet """
+    existing = {column['name'] for column in inspect(connection).get_columns(table)}
+    for column in columns:
+        if column.split()[0] not in existing:
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column}'))
+
+
+def revision_1(connection, metadata):
+    """ Folder mapping cache, sync state, counters and headers-first fetching """
+    add_missing_columns(connection, 'folder', [
+        'server_name VARCHAR(255)',
+        'listed_at DATETIME',
+        'uidvalidity BIGINT',
+        'uidnext BIGINT',
+        'highestmodseq BIGINT',
+        'synced_at DATETIME',
+        'n_messages INTEGER NOT NULL DEFAULT 0',
+        'n_unread INTEGER NOT NULL DEFAULT 0',
+    ])
+    add_missing_columns(connection, 'email', [
+        'flags VARCHAR',
+        'size INTEGER',
+        'body_fetched BOOLEAN NOT NULL DEFAULT FALSE',
+    ])
+    # The first version added the same folders again on every request - keep only the first of them:
+    connection.execute(text('''
+        UPDATE email_folder SET folder_id = (
+            SELECT MIN(f2.id) FROM folder f1 JOIN folder f2
+            ON f2.owner_id = f1.owner_id AND f2.name = f1.name
+            WHERE f1.id = email_folder.folder_id)
+    '''))
+    connection.execute(text('''
+        DELETE FROM folder WHERE id NOT IN (SELECT MIN(id) FROM folder GROUP BY owner_id, name)
+    '''))
+    connection.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_folder_owner_id_name ON folder (owner_id, name)'))
+
+
+# The `email` table as it was at revision 2 (the later revisions add their columns to it themselves
+# - so this must not be built from the current models):
+EMAIL_REVISION_2_COLUMNS = ['id', 'owner_id', 'folder_id', 'uid', 'date', 'from', 'to', 'subject', 'text',
+                            'flags', 'size', 'body_fetched']
+EMAIL_REVISION_2_SQL = '''
+    CREATE TABLE email_new (
+        id INTEGER NOT NULL PRIMARY KEY,
+        owner_id INTEGER NOT NULL REFERENCES "user" (id),
+        folder_id INTEGER NOT NULL REFERENCES folder (id),
+        uid INTEGER,
+        date DATETIME,
+        "from" VARCHAR(254),
+        "to" VARCHAR(254),
+        subject VARCHAR(255),
+        text VARCHAR,
+        flags VARCHAR,
+        size INTEGER,
+        body_fetched BOOLEAN NOT NULL DEFAULT FALSE,
+        CONSTRAINT uq_email_owner_id_folder_id_uid UNIQUE (owner_id, folder_id, uid)
+    )
+'''
+
+
+def revision_2(connection, metadata):
+    """ An email belongs to exactly one folder: `email.folder_id` instead of the `email_folder` table """
+    # The new `email` table is created next to the old one, filled, and then renamed:
+    connection.execute(text(EMAIL_REVISION_2_SQL))
+
+    # (emails without a folder can't be placed - the sync will fetch them again;
+    #  the columns added by the later revisions are not in the old table yet)
+    old_columns = {column['name'] for column in inspect(connection).get_columns('email')}
+    columns = ', '.join(f'"{column}"' for column in EMAIL_REVISION_2_COLUMNS
+                        if column != 'folder_id' and column in old_columns)
+    connection.execute(text(f'''
+        INSERT INTO email_new ({columns}, folder_id)
+        SELECT {', '.join(f'e.{column}' for column in columns.split(', '))}, link.folder_id
+        FROM email e
+        JOIN (SELECT email_id, MIN(folder_id) AS folder_id FROM email_folder GROUP BY email_id) link
+          ON link.email_id = e.id
+        WHERE TRUE
+        ORDER BY e.id DESC
+        ON CONFLICT DO NOTHING
+    '''))
+    connection.execute(text('DELETE FROM attachment WHERE email_id NOT IN (SELECT id FROM email_new)'))
+    connection.execute(text('DROP TABLE email'))
+    connection.execute(text('DROP TABLE email_folder'))
+    connection.execute(text('ALTER TABLE email_new RENAME TO email'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_attachment_email_id ON attachment (email_id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_email_owner_id_folder_id_date '
+                            'ON email (owner_id, folder_id, date DESC, uid DESC)'))
+
+    # Counters of the moved emails
+    # (the sync state is kept - the uids haven't changed: a synced folder keeps its emails;
+    #  one that has no UIDVALIDITY yet - of the first version - is fetched again by its first sync):
+    connection.execute(text('''
+        UPDATE folder SET
+            n_messages = (SELECT COUNT(*) FROM email WHERE email.folder_id = folder.id),
+            n_unread = (SELECT COUNT(*) FROM email WHERE email.folder_id = folder.id
+                        AND COALESCE(email.flags, '') NOT LIKE '%\\Seen%')
+    '''))
+
+
+def revision_3(connection, metadata):
+    """ Content-addressed attachment store """
+    add_missing_columns(connection, 'attachment', [
+        'sha256 VARCHAR(64)',
+        'size INTEGER',
+    ])
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_attachment_sha256 ON attachment (sha256)'))
+
+
+def revision_4(connection, metadata):
+    """ Raw message store (.eml files) """
+    add_missing_columns(connection, 'email', [
+        'path VARCHAR',
+    ])
+
+
+def revision_5(connection, metadata):
+    """ Compressed bodies (`email_body`): the search index gets the body from the app, not from a trigger """
+    # (the tables are created by `create_all`, the trigger again - without the body - by `create_search_index`)
+    connection.execute(text('DROP TRIGGER IF EXISTS email_fts_update'))
+
+
+def revision_6(connection, metadata):
+    """ Snippets of the bodies, and the total size of each folder """
+    from .database import make_snippet  # (database.py imports this module)
+    add_missing_columns(connection, 'email', [
+        'snippet VARCHAR(200)',
+    ])
+    add_missing_columns(connection, 'folder', [
+        'total_size BIGINT NOT NULL DEFAULT 0',
+    ])
+    connection.execute(text('''
+        UPDATE folder SET total_size = (
+            SELECT COALESCE(SUM(email.size), 0) FROM email WHERE email.folder_id = folder.id)
+    '''))
+    # (the bodies are compressed - their snippets are made here, not with SQL)
+    metadata.tables['compression_dictionary'].create(connection, checkfirst=True)
+    metadata.tables['email_body'].create(connection, checkfirst=True)
+    # (`BATCH_SIZE` bodies at a time, in the order of the ids)
+    dictionaries = {}
+    last_id = 0
+    while True:
+        rows = connection.execute(text('''
+            SELECT e.id, e.text, b.codec, b.data, b.dictionary_id
+            FROM email e
+            LEFT JOIN email_body b ON b.email_id = e.id
+            WHERE (e.text IS NOT NULL OR b.email_id IS NOT NULL) AND e.id > :last_id
+            ORDER BY e.id
+            LIMIT :batch_size
+        '''), {'last_id': last_id, 'batch_size': BATCH_SIZE}).all()
+        if not rows:
+            break
+        snippets = []
+        for row in rows:
+            if row.codec is None:
+                body = row.text
+            else:
+                dictionary = None
+                if row.dictionary_id is not None:
+                    if row.dictionary_id not in dictionaries:
+                        data = connection.execute(text('SELECT data FROM compression_dictionary WHERE id = :id'),
+                                                  {'id': row.dictionary_id}).scalar_one()
+                        dictionaries[row.dictionary_id] = _Dictionary(row.dictionary_id, data)
+                    dictionary = dictionaries[row.dictionary_id]
+                body = decompress(row.data, row.codec, dictionary)
+            snippets.append({'email_id': row.id, 'snippet': make_snippet(body)})
+        connection.execute(text('UPDATE email SET snippet = :snippet WHERE id = :email_id'), snippets)
+        last_id = rows[-1].id
+
+
+class _Dictionary:
+    """ (what `decompress` needs of a `CompressionDictionary` row) """
+    def __init__(self, dictionary_id, data):
+        self.dictionary_id = dictionary_id
+        self.data = data
+
+
+def revision_7(connection, metadata):
+    """ Import of the whole mailbox (checkpoint of every folder) """
+    add_missing_columns(connection, 'folder', [
+        'import_next_uid BIGINT',
+        'imported_at DATETIME',
+    ])
+
+
+def revision_8(connection, metadata):
+    """ Threading: the Message-ID and References of the emails, and their thread """
+    metadata.tables['message_thread'].create(connection, checkfirst=True)
+    add_missing_columns(connection, 'email', [
+        'message_id VARCHAR(255)',
+        'message_references VARCHAR',
+        'thread_id INTEGER REFERENCES message_thread (id)',
+    ])
+    # (the threads of the stored emails are found by the next sync - it fetches their headers again)
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_email_thread_id ON email (thread_id)'))
+
+
+def revision_9(connection, metadata):
+    """ Version of every folder (for the validation of the listings - the triggers are created by `upgrade_schema`) """
+    add_missing_columns(connection, 'folder', [
+        'version BIGINT NOT NULL DEFAULT 0',
+        'changed_at DATETIME',
+    ])
+
+
+def revision_10(connection, metadata):
+    """ Leases of the outbox messages being sent (several processes share the outbox) """
+    if inspect(connection).has_table('outbox'):  # (else it's created by `create_all`)
+        add_missing_columns(connection, 'outbox', [
+            'lease_expires_at DATETIME',
+        ])
+
+
+
+# The `outbox` table as it is at revision 11 (`raw` may be NULL - SQLite can't change that in place):
+OUTBOX_REVISION_11_COLUMNS = ['id', 'owner_id', 'recipients', 'subject', 'path', 'raw', 'status',
+                              'lease_expires_at', 'attempts', 'next_attempt_at', 'last_error', 'created_at',
+                              'sent_at', 'copied_to_sent']
+OUTBOX_REVISION_11_SQL = '''
+    CREATE TABLE outbox_new (
+        id INTEGER NOT NULL PRIMARY KEY,
+        owner_id INTEGER NOT NULL REFERENCES "user" (id),
+        recipients VARCHAR NOT NULL,
+        subject VARCHAR(255),
+        path VARCHAR,
+        raw BLOB,
+        status VARCHAR(8) NOT NULL,
+        lease_expires_at DATETIME,
+        attempts INTEGER NOT NULL,
+        next_attempt_at DATETIME NOT NULL,
+        last_error VARCHAR,
+        created_at DATETIME NOT NULL,
+        sent_at DATETIME,
+        copied_to_sent BOOLEAN NOT NULL
+    )
+'''
+
+
+def revision_11(connection, metadata):
+    """ Outgoing messages are in files of the outbox spool (`outbox.path`), not in `outbox.raw` """
+    if not inspect(connection).has_table('outbox'):  # (else it's created by `create_all`)
+        return
+    if connection.dialect.name != 'sqlite':
+        connection.execute(text('ALTER TABLE outbox ALTER COLUMN raw DROP NOT NULL'))
+        add_missing_columns(connection, 'outbox', ['path VARCHAR'])
+        return
+    connection.execute(text(OUTBOX_REVISION_11_SQL))
+    columns = ', '.join(f'"{column}"' for column in OUTBOX_REVISION_11_COLUMNS if column != 'path')
+    connection.execute(text(f'INSERT INTO outbox_new ({columns}) SELECT {columns} FROM outbox'))
+    connection.execute(text('DROP TABLE outbox'))
+    connection.execute(text('ALTER TABLE outbox_new RENAME TO outbox'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_outbox_status_next_attempt_at '
+                            'ON outbox (status, next_attempt_at)'))
+
+
+def revision_12(connection, metadata):
+    """ The number of messages of every folder on the server (for finding the expunged ones) """
+    add_missing_columns(connection, 'folder', [
+        'n_server_messages INTEGER',
+    ])
+
+
+# In the order of application (never change or remove a revision that was already released):
+REVISIONS = [
+    revision_1,
+    revision_2,
+    revision_3,
+    revision_4,
+    revision_5,
+    revision_6,
+    revision_7,
+    revision_8,
+    revision_9,
+    revision_10,
+    revision_11,
+    revision_12,
+]
@@ -0,0 +1,357 @@
+"""Outgoing messages: a persistent queue (the `Outbox` table) and the threads that send it"""
+
+import base64
+import io
+import logging
+import mimetypes
+import os
+import secrets
+import smtplib
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from email import policy
+from email.message import EmailMessage, MIMEPart
+from email.utils import formatdate, make_msgid
+
+
+logger = logging.getLogger(__name__)
+
+
+def header_bytes(msg):
+    """ The header block of the message (and the empty line after it) """
+    return b''.join(msg.policy.fold_binary(name, value) for name, value in msg.items()) + b'\r\n'
+
+
+ATTACHMENT_CHUNK_SIZE = 57 * 1024  # bytes (a multiple of 57: base64 lines of 76 characters)
+
+
+def write_message(file, sender, recipients, subject, body, attachments=()):
+    """
+    Write the message to send (RFC 5322, CRLF line endings) into the binary `file`.
+    `attachments` - list of (filename, content_type or None, binary file - e.g. the stream of an upload):
+    they are base64-encoded a chunk at a time, straight into the file (never whole in memory).
+    """
+    msg = EmailMessage(policy=policy.SMTP)
+    msg['From'] = sender
+    msg['To'] = ', '.join(recipients)
+    msg['Subject'] = subject
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid(domain=sender.split('@')[-1])
+    if not attachments:
+        msg.set_content(body)
+        file.write(msg.as_bytes())
+        return
+    boundary = f'=_{secrets.token_hex(16)}'
+    msg['MIME-Version'] = '1.0'
+    msg['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+    file.write(header_bytes(msg))  # (the parts are written here)
+    text = MIMEPart(policy=policy.SMTP)
+    text.set_content(body)
+    file.write(f'--{boundary}\r\n'.encode() + text.as_bytes())
+    for filename, content_type, attachment in attachments:
+        part = MIMEPart(policy=policy.SMTP)
+        part['Content-Type'] = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        file.write(f'\r\n--{boundary}\r\n'.encode() + header_bytes(part))
+        while chunk := attachment.read(ATTACHMENT_CHUNK_SIZE):
+            file.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+    file.write(f'\r\n--{boundary}--\r\n'.encode())
+
+
+def is_permanent(error):
+    """ Whether retrying the send can't help (the server rejected the message / the recipients) """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False  # (the user can log in again with the right password)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+class OutboxSender:
+    """
+    Sends the messages of the `Outbox` table in background threads:
+    `enqueue(...)` only stores the message, and the request returns right away.
+
+    - the message is written to a file in `spool` (the `Outbox` row has its name) with its attachments,
+      and it's sent from there - read while it's sent (`send_file`); the file is deleted when the message
+      is sent, or given up on
+
+    - a worker takes up to `batch` due messages of one account,
+      and sends them over one SMTP session (taken from `smtp_pool`)
+    - a failed message is retried after `retry_delay * 2**attempts` seconds
+      (at most `max_retry_delay`), and given up on after `max_attempts` attempts
+      or at once if the server rejected it permanently (5xx)
+    - after a message is sent, `on_sent(email, password, raw)` is called
+      (to put a copy in the "Sent" folder), it returns whether the copy was saved
+      (IMAP APPEND sends the message from memory - so it's read from the file only for that)
+    - the messages are sent only while the account's password is known
+      (`set_credentials` - on log in), since it's not stored in the database
+    - several processes can share the outbox: a message is claimed with one conditional UPDATE
+      (only the rows still 'queued' are taken), for `lease` seconds - if its process dies meanwhile,
+      the message is claimed again after that (so `lease` must be longer than sending a batch takes)
+
+    Must be given the app, since the workers run outside of the requests.
+    """
+
+    def __init__(self, app, db, Outbox, User, smtp_pool, spool, on_sent=None, workers=2, batch=20,
+                 max_attempts=8, retry_delay=30, max_retry_delay=3600, poll_interval=10, lease=900):
+        self.app = app
+        self.db = db
+        self.Outbox = Outbox
+        self.User = User
+        self.smtp_pool = smtp_pool
+        self.spool = spool
+        self.on_sent = on_sent
+        self.n_workers = workers
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval  # (retries are looked for that often)
+        self.lease = lease  # seconds
+        self._passwords = {}  # email -> password
+        self._busy = set()  # accounts whose messages are being sent now
+        self._condition = threading.Condition()
+        self._workers = []
+        self._stopped = False
+        self.counters = {'sent': 0, 'retried': 0, 'failed': 0, 'sessions': 0}
+        self._latencies = deque(maxlen=1000)  # seconds from enqueue to sent (of the last messages)
+
+    def set_credentials(self, email, password):
+        """ Allow sending the account's messages (and start the workers) """
+        with self._condition:
+            self._passwords[email] = password
+            self._start_workers()
+            self._condition.notify_all()
+
+    def forget_credentials(self, email):
+        with self._condition:
+            self._passwords.pop(email, None)
+
+    def enqueue(self, owner, recipients, subject, body, attachments=()):
+        """
+        Store the message to be sent (see `write_message` - the attachments are read into its file in the spool).
+        Returns its id. Must be run with app context
+        """
+        os.makedirs(self.spool, exist_ok=True)
+        name = f'{secrets.token_hex(16)}.eml'
+        try:
+            with open(os.path.join(self.spool, name), 'wb') as f:
+                write_message(f, owner.username, recipients, subject, body, attachments)
+            now = datetime.utcnow()
+            message = self.Outbox(owner_id=owner.id,
+                                  recipients=', '.join(recipients),
+                                  subject=subject,
+                                  path=name,
+                                  status='queued',
+                                  next_attempt_at=now,
+                                  created_at=now)
+            self.db.session.add(message)
+            self.db.session.commit()
+        except BaseException:
+            # (no row refers to the file)
+            self.db.session.rollback()
+            self._remove_spool_file(name)
+            raise
+        with self._condition:
+            self._condition.notify()
+        return message.outbox_id
+
+    def stats(self):
+        """ Queue depth (by status) and send latency. Must be run with app context """
+        Outbox = self.Outbox
+        depth = dict(self.db.session.execute(
+            self.db.select(Outbox.status, self.db.func.count()).group_by(Outbox.status)).all())
+        with self._condition:
+            latencies = sorted(self._latencies)
+            counters = dict(self.counters)
+        percentile = lambda p: round(latencies[int(p * (len(latencies) - 1))], 3) if latencies else None
+        return {'queue': {status: depth.get(status, 0) for status in ('queued', 'sending', 'sent', 'failed')},
+                'latency_seconds': {'p50': percentile(0.5), 'p95': percentile(0.95),
+                                    'max': percentile(1.0), 'n': len(latencies)},
+                'messages_per_session': round(counters['sent'] / counters['sessions'], 2)
+                                        if counters['sessions'] else None,
+                **counters}
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+
+    # Must be run with the condition's lock held:
+
+    def _start_workers(self):
+        if not self._workers:
+            for i in range(self.n_workers):
+                worker = threading.Thread(target=self._work, name=f'outbox-worker-{i}', daemon=True)
+                self._workers.append(worker)
+                worker.start()
+
+
+    # Run by the worker threads:
+
+    def _work(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                logger.warning('Could not read the outbox: %s', e)
+                claimed = None
+            if claimed is None:
+                with self._condition:
+                    if not self._stopped:
+                        self._condition.wait(self.poll_interval)
+                continue
+            email, password, messages = claimed
+            try:
+                self._send(email, password, messages)
+            finally:
+                self._release(email)
+
+    def _claim(self):
+        """
+        Take the due messages of one account (marking them as 'sending', until the lease expires).
+        Returns (email, password, [(outbox_id, recipients, path, raw, created_at), ...]) or None
+        (the messages another process has claimed first are not in the list)
+        """
+        db, Outbox, User = self.db, self.Outbox, self.User
+        with self._condition:
+            emails = [email for email in self._passwords if email not in self._busy]
+        if not emails:
+            return None
+        # (the queries are made without the condition's lock - it's taken only to reserve the account)
+        with self.app.app_context():
+            now = datetime.utcnow()
+            # (queued - or being sent by a process that has died: its lease has expired)
+            claimable = db.or_(Outbox.status == 'queued',
+                               db.and_(Outbox.status == 'sending',
+                                       db.or_(Outbox.lease_expires_at.is_(None), Outbox.lease_expires_at < now)))
+            due = (db.select(Outbox.outbox_id, Outbox.recipients, Outbox.path, Outbox.raw, Outbox.created_at,
+                             User.username)
+                   .join(User, User.id == Outbox.owner_id)
+                   .where(claimable)
+                   .where(Outbox.next_attempt_at <= now))
+            first = db.session.execute(
+                due.where(User.username.in_(emails)).order_by(Outbox.next_attempt_at).limit(1)).first()
+            if first is None:
+                return None
+            email = first.username
+            with self._condition:
+                if email in self._busy:
+                    return None  # (another worker has taken the account meanwhile)
+                self._busy.add(email)
+            try:
+                rows = db.session.execute(
+                    due.where(User.username == email).order_by(Outbox.created_at).limit(self.batch)).all()
+                # (the same condition again - a row that another process has claimed since the SELECT is not updated)
+                claimed = set(db.session.scalars(
+                    db.update(Outbox)
+                    .where(Outbox.outbox_id.in_([row.outbox_id for row in rows]))
+                    .where(claimable)
+                    .values(status='sending', lease_expires_at=now + timedelta(seconds=self.lease))
+                    .returning(Outbox.outbox_id)).all())
+                db.session.commit()
+            except BaseException:
+                self._release(email)
+                raise
+        with self._condition:
+            password = self._passwords.get(email)
+        if not claimed:
+            self._release(email)
+            return None
+        return email, password, [(row.outbox_id, row.recipients, row.path, row.raw, row.created_at)
+                                 for row in rows if row.outbox_id in claimed]
+
+    def _release(self, email):
+        """ Let the other workers take the account's messages """
+        with self._condition:
+            self._busy.discard(email)
+            self._condition.notify_all()
+
+    def _send(self, email, password, messages):
+        """ Send the messages over one SMTP session, and store the results """
+        outcomes = {}  # outbox_id -> (status, error)
+        try:
+            with self.smtp_pool.connection(email, password) as smtp:
+                for outbox_id, recipients, path, raw, _ in messages:
+                    try:
+                        with self._open_message(path, raw) as f:
+                            smtp.send_file(email, recipients.split(', '), f)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                            smtplib.SMTPDataError) as e:
+                        # (the session is still fine - go on with the next message)
+                        outcomes[outbox_id] = ('failed' if is_permanent(e) else 'retry', str(e))
+                    else:
+                        outcomes[outbox_id] = ('sent', None)
+            with self._condition:
+                self.counters['sessions'] += 1
+        except (smtplib.SMTPException, OSError) as e:
+            logger.warning('Sending the messages of %s failed: %s', email, e)
+            for outbox_id, _, _, _, _ in messages:
+                outcomes.setdefault(outbox_id, ('failed' if is_permanent(e) else 'retry', str(e) or type(e).__name__))
+        self._store_outcomes(email, password, messages, outcomes)
+
+    def _store_outcomes(self, email, password, messages, outcomes):
+        db, Outbox = self.db, self.Outbox
+        with self.app.app_context():
+            now = datetime.utcnow()
+            sent, given_up = [], []
+            for outbox_id, _, path, raw, created_at in messages:
+                status, error = outcomes[outbox_id]
+                message = db.session.get(Outbox, outbox_id)
+                message.attempts += 1
+                message.lease_expires_at = None
+                message.last_error = error
+                if status == 'sent':
+                    message.status = 'sent'
+                    message.sent_at = now
+                    sent.append((message, path, raw))
+                    with self._condition:
+                        self.counters['sent'] += 1
+                        self._latencies.append((now - created_at).total_seconds())
+                elif status == 'retry' and message.attempts < self.max_attempts:
+                    message.status = 'queued'
+                    delay = min(self.retry_delay * 2 ** (message.attempts - 1), self.max_retry_delay)
+                    message.next_attempt_at = now + timedelta(seconds=delay)
+                    with self._condition:
+                        self.counters['retried'] += 1
+                else:
+                    message.status = 'failed'
+                    given_up.append(message)
+                    with self._condition:
+                        self.counters['failed'] += 1
+            db.session.commit()
+
+            for message, path, raw in sent:
+                if self.on_sent is not None:
+                    try:
+                        with self._open_message(path, raw) as f:
+                            message.copied_to_sent = bool(self.on_sent(email, password, f.read()))
+                    except Exception as e:
+                        logger.warning('Could not save a copy of the sent message %s: %s', message.outbox_id, e)
+            # (the file of a sent or a failed message isn't needed anymore)
+            for message in [message for message, _, _ in sent] + given_up:
+                if message.path is not None:
+                    self._remove_spool_file(message.path)
+                    message.path = None
+            db.session.commit()
+
+    def _remove_spool_file(self, name):
+        try:
+            os.remove(os.path.join(self.spool, name))
+        except OSError:
+            pass
+
+    def _open_message(self, path, raw):
+        """ The message as a binary file: from the spool, or (queued before the spool) from the row """
+        return open(os.path.join(self.spool, path), 'rb') if path is not None else io.BytesIO(raw)
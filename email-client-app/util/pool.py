@@ -0,0 +1,244 @@
+"""Pools of logged-in connections (IMAP here, SMTP in smtp.py)"""
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from .configs import IMAP_CONFIGS
+from .instrumentation import InstrumentedMailBox, InstrumentedMailBoxUnencrypted
+
+
+def get_imap_server(email):
+    """ Return (host, port, use_ssl) of the IMAP server of this email address """
+    config = IMAP_CONFIGS[email.split('@')[-1]]
+    return config['MAIL_SERVER'], config['MAIL_PORT'], config['MAIL_USE_SSL']
+
+
+def connect_imap(email, password):
+    """ Open a new connection to the IMAP server of this email address, and log in (its commands are recorded) """
+    host, port, use_ssl = get_imap_server(email)
+    mailbox_class = InstrumentedMailBox if use_ssl else InstrumentedMailBoxUnencrypted
+    return mailbox_class(host=host, port=port).login(email, password)
+
+
+class ConnectionPool:
+    """
+    Keeps logged-in connections open between their uses, per account
+    (the subclasses say how a connection is opened, checked and closed: `_open`, `_is_alive`, `_close`).
+
+    Usage:
+        with pool.connection(email, password) as connection:
+            ...
+        # (or, for a connection kept for long - e.g. for IDLE:)
+        connection = pool.acquire(email, password)
+        ...
+        pool.discard(connection, email)
+
+    - every account has at most `max_checked_out` connections given out at once (servers limit
+      the connections of an account) - `acquire` waits for one of them to come back, at most
+      `checkout_timeout` seconds (then raises `TimeoutError`)
+    - every account has at most `max_per_user` idle connections,
+      and all accounts together - at most `max_total` (the least recently
+      used connection is evicted when this limit is reached; None - no limit)
+    - idle connections are closed after `idle_timeout` seconds
+    - a connection that was idle for more than `check_after` seconds
+      is checked (`_is_alive`) before it is given out
+    - a connection is not returned to the pool if an exception happened
+      while it was used (it could be in a broken state)
+    - connections are closed by one thread (closing may block on the network - but not the thread that used it)
+    """
+
+    def __init__(self, max_per_user, max_total, idle_timeout, check_after, max_checked_out, checkout_timeout=30):
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.max_checked_out = max_checked_out
+        self.checkout_timeout = checkout_timeout
+        # email -> list of idle connections: [(connection, password, last_used), ...]
+        # (the most recently used connection is at the end of the list)
+        self._idle = {}
+        self._checkouts = {}  # email -> semaphore (of the connections that can still be given out)
+        self._lock = threading.Lock()
+        self._to_close = queue.Queue()
+        self._closer = None  # the thread that closes the connections (started with the first one)
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'failed_checks': 0, 'checkout_waits': 0}
+
+    @contextmanager
+    def connection(self, email, password):
+        """ Give out a logged-in connection, and take it back afterwards """
+        connection = self.acquire(email, password)
+        try:
+            yield connection
+        except BaseException:
+            self.discard(connection, email)
+            raise
+        self.release(connection, email, password)
+
+    def acquire(self, email, password):
+        """
+        Return a logged-in connection of this account (raises what `_open` raises,
+        and `TimeoutError` if the account's connections are all given out for `checkout_timeout` seconds).
+        It must be given back - with `release` or `discard`.
+        """
+        with self._lock:
+            checkouts = self._checkouts.setdefault(email, threading.BoundedSemaphore(self.max_checked_out))
+        if not checkouts.acquire(blocking=False):
+            self._increment('checkout_waits')
+            if not checkouts.acquire(timeout=self.checkout_timeout):
+                raise TimeoutError(f'All {self.max_checked_out} connections of {email} are in use')
+        try:
+            return self._checkout(email, password)
+        except BaseException:
+            checkouts.release()
+            raise
+
+    def release(self, connection, email, password):
+        """ Return the connection into the pool (or close it, if the pool is full) """
+        with self._lock:
+            self._checkouts[email].release()  # (raises ValueError if it's given back twice)
+            connections = self._idle.setdefault(email, [])
+            connections.append((connection, password, time.monotonic()))
+            while len(connections) > self.max_per_user:
+                self.counters['evictions'] += 1
+                self._close_later(connections.pop(0)[0])
+            while self.max_total is not None and self._n_idle() > self.max_total:
+                self.counters['evictions'] += 1
+                self._close_later(self._pop_least_recently_used())
+
+    def discard(self, connection, email):
+        """ Close the connection instead of returning it into the pool (e.g. it's broken) """
+        with self._lock:
+            self._checkouts[email].release()
+            self._close_later(connection)
+
+    def close_user(self, email):
+        """ Close all idle connections of this account (e.g. on log out) """
+        with self._lock:
+            for connection, _, _ in self._idle.pop(email, []):
+                self._close_later(connection)
+
+    def stats(self):
+        """ Counters to tune the pool with """
+        with self._lock:
+            n_idle = self._n_idle()
+            n_users = len(self._idle)
+        return dict(self.counters, idle_connections=n_idle, users=n_users, closing=self._to_close.qsize())
+
+    def _checkout(self, email, password):
+        while True:
+            with self._lock:
+                self._remove_expired()
+                connection, last_used = self._pop_idle(email, password)
+            if connection is None:
+                break
+            if time.monotonic() - last_used < self.check_after or self._is_alive(connection):
+                self._increment('hits')
+                return connection
+            self._increment('failed_checks')
+            with self._lock:
+                self._close_later(connection)
+
+        self._increment('misses')
+        return self._open(email, password)
+
+
+    # Must be run with the lock held:
+
+    def _pop_idle(self, email, password):
+        connections = self._idle.get(email, [])
+        while connections:
+            connection, pool_password, last_used = connections.pop()
+            if pool_password == password:
+                return connection, last_used
+            # the password has changed - this connection can't be given out:
+            self._close_later(connection)
+        return None, None
+
+    def _remove_expired(self):
+        now = time.monotonic()
+        for email in list(self._idle):
+            connections = self._idle[email]
+            while connections and now - connections[0][2] > self.idle_timeout:
+                self._close_later(connections.pop(0)[0])
+            if not connections:
+                del self._idle[email]
+
+    def _pop_least_recently_used(self):
+        email = min(self._idle, key=lambda email: self._idle[email][0][2])
+        connection = self._idle[email].pop(0)[0]
+        if not self._idle[email]:
+            del self._idle[email]
+        return connection
+
+    def _n_idle(self):
+        return sum(len(connections) for connections in self._idle.values())
+
+    def _close_later(self, connection):
+        # (closing may block on the network - so it's done by the closing thread, not while holding the lock)
+        self._to_close.put(connection)
+        if self._closer is None or not self._closer.is_alive():
+            # (started again in a forked worker process - the threads of the parent don't run there)
+            self._closer = threading.Thread(target=self._close_queued, name='pool-closer', daemon=True)
+            self._closer.start()
+
+
+    # Can be run without the lock:
+
+    def _increment(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+
+    # Run by the closing thread:
+
+    def _close_queued(self):
+        while True:
+            connection = self._to_close.get()
+            try:
+                self._close(connection)
+            finally:
+                self._to_close.task_done()
+
+
+    # Defined by the subclasses:
+
+    def _open(self, email, password):
+        """ A new logged-in connection """
+        raise NotImplementedError
+
+    def _is_alive(self, connection):
+        raise NotImplementedError
+
+    def _close(self, connection):
+        """ Close the connection (never raises) """
+        raise NotImplementedError
+
+
+class MailBoxPool(ConnectionPool):
+    """
+    Keeps authenticated `MailBox` connections open between requests,
+    so that a request doesn't have to do the TLS handshake + LOGIN every time
+    (a connection idle for more than `check_after` seconds is checked with NOOP).
+    An account has at most `max_checked_out` connections open at once (IDLE and the import included
+    - servers allow an account 10-20 connections).
+    """
+
+    def __init__(self, max_per_user=2, max_total=100, idle_timeout=300, check_after=30, max_checked_out=6):
+        super().__init__(max_per_user, max_total, idle_timeout, check_after, max_checked_out)
+
+    def _open(self, email, password):
+        # (raises `MailboxLoginError` if the credentials are wrong)
+        return connect_imap(email, password)
+
+    def _is_alive(self, mailbox):
+        try:
+            return mailbox.client.noop()[0] == 'OK'
+        except Exception:
+            return False
+
+    def _close(self, mailbox):
+        try:
+            mailbox.logout()
+        except Exception:
+            pass
@@ -0,0 +1,120 @@
+"""Sampling profiler of the slow requests"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+class SlowRequestProfiler:
+    """
+    Samples the stacks of the threads that are handling requests, and keeps the samples
+    of the requests that took longer than `threshold` seconds.
+
+    Usage (`RequestInstrumentation` does it for every request):
+        profiler.start()  # at the beginning of the request, in its thread
+        profiler.stop(label, seconds, request_metrics)  # at its end
+
+    - one background thread takes a sample of every profiled thread every `interval` seconds
+      (it sleeps while there are no requests) - so the fast requests cost only the sampling
+    - the profile of a slow request is written to `directory` in the "folded" format
+      (one line per stack: 'module:function;module:function;... count' - for flamegraph.pl or speedscope.app),
+      with the IMAP / SMTP / SQL calls of the request in the header lines ('# ...')
+    - at most `keep` profiles are kept (the oldest ones are deleted)
+    """
+
+    def __init__(self, directory, threshold=1.0, interval=0.005, keep=100):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self.keep = keep
+        self._samples = {}  # thread id -> Counter of the folded stacks
+        self._condition = threading.Condition()
+        self._thread = None
+        self.counters = {'profiled': 0, 'slow': 0}
+
+    def start(self):
+        """ Start sampling the current thread """
+        with self._condition:
+            self._samples[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self, label, seconds, request_metrics=None):
+        """ Stop sampling the current thread. Returns the path of the profile if the request was slow (else None) """
+        with self._condition:
+            samples = self._samples.pop(threading.get_ident(), None)
+            self.counters['profiled'] += 1
+            if samples is None or seconds < self.threshold:
+                return None
+            self.counters['slow'] += 1
+        path = self._write(label, seconds, samples, request_metrics)
+        logger.warning('Slow request %s: %.0f ms (profile: %s)', label, seconds * 1000, path)
+        return path
+
+    def cancel(self):
+        """ Stop sampling the current thread, without a profile (e.g. the request failed) """
+        with self._condition:
+            self._samples.pop(threading.get_ident(), None)
+
+    def stats(self):
+        with self._condition:
+            return dict(self.counters, active=len(self._samples))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._samples:
+                    self._condition.wait()
+                thread_ids = list(self._samples)
+            frames = sys._current_frames()
+            stacks = {thread_id: fold(frames[thread_id]) for thread_id in thread_ids if thread_id in frames}
+            del frames  # (don't keep the frames - and their local variables - alive until the next sample)
+            with self._condition:
+                for thread_id, stack in stacks.items():
+                    samples = self._samples.get(thread_id)
+                    if samples is not None:
+                        samples[stack] += 1
+            time.sleep(self.interval)
+
+    def _write(self, label, seconds, samples, request_metrics):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'{datetime.now():%Y%m%d-%H%M%S-%f}-{label}-{seconds * 1000:.0f}ms.folded'
+        path = os.path.join(self.directory, name.replace(os.sep, '_'))
+        with open(path, 'w') as f:
+            f.write(f'# {label}: {seconds * 1000:.1f} ms, {sum(samples.values())} samples '
+                    f'every {self.interval * 1000:g} ms\n')
+            if request_metrics is not None:
+                for (backend, command), (calls, call_seconds, received, sent) in sorted(request_metrics.calls.items()):
+                    f.write(f'# {backend} {command}: {calls}x, {call_seconds * 1000:.1f} ms, '
+                            f'{received} bytes received, {sent} bytes sent\n')
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        self._remove_old()
+        return path
+
+    def _remove_old(self):
+        profiles = sorted(name for name in os.listdir(self.directory) if name.endswith('.folded'))
+        for name in profiles[:-self.keep]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+def fold(frame):
+    """ The stack of the frame, from the outermost call: 'module:function;module:function;...' """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
@@ -0,0 +1,197 @@
+"""Push of the changes to the browser: IMAP IDLE listener + Server-Sent Events"""
+
+import json
+import logging
+import queue
+import socket
+import threading
+
+from .sync import get_capabilities
+
+
+logger = logging.getLogger(__name__)
+
+# Untagged responses that mean the selected folder has changed:
+CHANGE_RESPONSES = ('EXISTS', 'EXPUNGE', 'FETCH', 'RECENT')
+
+
+class EventBroker:
+    """
+    Delivers the events of a user to all the user's open event streams (browser tabs).
+    An event is a dict with a 'type' (e.g. {'type': 'new_messages', 'folder': 'inbox', 'uids': [...]})
+    """
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued  # events of a stream that isn't read are dropped after that
+        self._subscriptions = {}  # email -> list of queues
+        self._lock = threading.Lock()
+
+    def subscribe(self, email):
+        """ Open a stream of the user's events (a queue to read them from) """
+        subscription = queue.Queue(self.max_queued)
+        with self._lock:
+            self._subscriptions.setdefault(email, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, email, subscription):
+        """ Close the stream. Returns the number of the user's streams that are still open """
+        with self._lock:
+            subscriptions = self._subscriptions.get(email, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(email, None)
+            return len(subscriptions)
+
+    def publish(self, email, event):
+        """ Send the event to all the user's open streams """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(email, []))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def close(self, email):
+        """ End all the user's streams (e.g. on log out) """
+        self.publish(email, None)
+
+    def n_subscribers(self, email):
+        with self._lock:
+            return len(self._subscriptions.get(email, []))
+
+
+def event_stream(subscription, keep_alive=15):
+    """
+    Generator of the Server-Sent Events of a subscription (the body of the response).
+    A comment is sent every `keep_alive` seconds, so proxies don't close an idle stream.
+    """
+    yield 'retry: 5000\n\n'  # (reconnect after 5 s if the connection is lost)
+    while True:
+        try:
+            event = subscription.get(timeout=keep_alive)
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+            continue
+        if event is None:
+            return
+        yield f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+
+
+class IdleListener:
+    """
+    Watches the INBOX of the active accounts (the ones that have the page open),
+    so that new messages and flag changes appear without polling the server.
+
+    Every watched account has its own IMAP connection (taken from the pool), which is:
+    - in IDLE mode, if the server supports it (the server tells about a change right away)
+      - IDLE is renewed every `idle_timeout` seconds (RFC 2177: at least every 29 minutes)
+    - otherwise - checked with NOOP every `poll_interval` seconds
+
+    On a change, `on_change(email, folder)` is called (`folder` - the client folder name).
+    At most `max_connections` accounts are watched at the same time
+    (the others are kept fresh only by the periodic sync).
+    """
+
+    def __init__(self, mailbox_pool, on_change, max_connections=50, idle_timeout=5 * 60,
+                 poll_interval=60, retry_after=60, server_folder='INBOX', folder='inbox', use_idle=True):
+        self.mailbox_pool = mailbox_pool
+        self.on_change = on_change
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.retry_after = retry_after  # after a connection error
+        self.server_folder = server_folder  # (INBOX is the same name on every server - RFC 3501)
+        self.folder = folder
+        self.use_idle = use_idle
+        self._watchers = {}  # email -> {'stop': threading.Event, 'mailbox': MailBox or None, 'mode': ...}
+        self._lock = threading.Lock()
+
+    def watch(self, email, password):
+        """ Start watching the account. Returns False if the connection limit is reached """
+        with self._lock:
+            if email in self._watchers:
+                return True
+            if len(self._watchers) >= self.max_connections:
+                return False
+            watcher = {'stop': threading.Event(), 'mailbox': None, 'mode': None}
+            self._watchers[email] = watcher
+        threading.Thread(target=self._run, args=(email, password, watcher),
+                         name=f'idle-{email}', daemon=True).start()
+        return True
+
+    def unwatch(self, email):
+        """ Stop watching the account (its connection is closed) """
+        with self._lock:
+            watcher = self._watchers.pop(email, None)
+        if watcher is not None:
+            watcher['stop'].set()
+            self._interrupt(watcher['mailbox'])
+
+    def stats(self):
+        with self._lock:
+            modes = [watcher['mode'] for watcher in self._watchers.values()]
+        return {'watched': len(modes),
+                'idle': modes.count('idle'),
+                'polling': modes.count('poll'),
+                'max_connections': self.max_connections}
+
+
+    # Run by the watcher threads:
+
+    def _run(self, email, password, watcher):
+        stop = watcher['stop']
+        while not stop.is_set():
+            try:
+                mailbox = self.mailbox_pool.acquire(email, password)
+            except Exception as e:
+                logger.warning('IDLE listener of %s could not connect: %s', email, e)
+                stop.wait(self.retry_after)
+                continue
+            watcher['mailbox'] = mailbox
+            try:
+                self._listen(email, mailbox, watcher)
+            except Exception as e:
+                if not stop.is_set():
+                    logger.warning('IDLE listener of %s lost the connection: %s', email, e)
+                    stop.wait(self.retry_after)
+            finally:
+                watcher['mailbox'] = None
+                self.mailbox_pool.discard(mailbox, email)  # (a connection after IDLE isn't given out again)
+
+    def _listen(self, email, mailbox, watcher):
+        stop = watcher['stop']
+        mailbox.folder.set(self.server_folder, readonly=True)
+        # (something could have changed while we were not listening)
+        self.on_change(email, self.folder)
+        if self.use_idle and 'IDLE' in get_capabilities(mailbox):
+            watcher['mode'] = 'idle'
+            while not stop.is_set():
+                responses = mailbox.idle.wait(timeout=self.idle_timeout)
+                if any(self._is_change(response) for response in responses):
+                    self.on_change(email, self.folder)
+        else:
+            watcher['mode'] = 'poll'
+            while not stop.wait(self.poll_interval):
+                # (the untagged responses that came with NOOP are collected by imaplib)
+                mailbox.client.noop()
+                untagged = mailbox.client.untagged_responses
+                if any(untagged.pop(name, None) for name in CHANGE_RESPONSES):
+                    self.on_change(email, self.folder)
+
+    @staticmethod
+    def _is_change(response):
+        # e.g. b'* 36 EXISTS', b'* 3 FETCH (FLAGS (\\Seen))', b'* 2 EXPUNGE'
+        words = response.split()
+        return len(words) >= 3 and words[2].decode(errors='replace').upper() in CHANGE_RESPONSES
+
+    @staticmethod
+    def _interrupt(mailbox):
+        """ Wake up a connection that is waiting in IDLE (so that its thread can stop) """
+        if mailbox is None:
+            return
+        try:
+            mailbox.client.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
@@ -0,0 +1,169 @@
+"""Background synchronization of the logged-in accounts (so the requests only read the database)"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+# Priorities of the sync jobs (lower - earlier):
+URGENT = 0  # the folder the user is looking at
+PERIODIC = 1  # all the folders of an account
+
+
+class SyncScheduler:
+    """
+    Runs the sync jobs of the logged-in accounts in a pool of worker threads.
+
+    A job is `sync_job(email, password, folder)`, where `folder` is the client
+    folder name, or None - to sync all the folders of the account.
+
+    - every account is synced in full every `interval` seconds
+    - `request_sync(...)` puts a folder in front of the periodic jobs
+      (the user is looking at it right now)
+    - at most `max_per_account` jobs of one account run at the same time
+      (so one slow account can't take all the workers, or all its IMAP connections)
+    - after a failed job, the account waits `interval * 2**failures` seconds
+      (at most `max_backoff`) before its next job
+    """
+
+    def __init__(self, sync_job, workers=4, max_per_account=1, interval=120, max_backoff=1800):
+        self.sync_job = sync_job
+        self.n_workers = workers
+        self.max_per_account = max_per_account
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._accounts = {}  # email -> account state (see `add_account`)
+        self._jobs = []  # [(priority, due time, sequence number, email, folder), ...]
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._workers = []
+        self._stopped = False
+
+    def add_account(self, email, password):
+        """ Start syncing the account (e.g. on log in). Its full sync is scheduled right away """
+        with self._condition:
+            account = self._accounts.get(email)
+            if account is not None:
+                account['password'] = password
+                return
+            self._accounts[email] = {
+                'password': password,
+                'running': 0,  # number of its jobs that are running now
+                'failures': 0,  # number of failed jobs in a row
+                'not_before': 0,  # (monotonic time) no jobs until then - after a failure
+                'last_error': None,
+                'synced_at': {},  # folder (None - all) -> datetime of the last successful sync
+            }
+            self._schedule(PERIODIC, time.monotonic(), email, None)
+            self._start_workers()
+
+    def remove_account(self, email):
+        """ Stop syncing the account (e.g. on log out). Its running jobs are let to finish """
+        with self._condition:
+            self._accounts.pop(email, None)
+            self._jobs = [job for job in self._jobs if job[3] != email]
+
+    def request_sync(self, email, folder):
+        """ Sync this folder of the account as soon as possible """
+        with self._condition:
+            if email not in self._accounts:
+                raise KeyError(f'Account {email} is not synced (add it first)')
+            if any(job[0] == URGENT and job[3] == email and job[4] == folder for job in self._jobs):
+                return  # (already waiting)
+            self._schedule(URGENT, time.monotonic(), email, folder)
+
+    def status(self, email):
+        """ State of the account's syncing (for the client), None - if it isn't synced """
+        with self._condition:
+            account = self._accounts.get(email)
+            if account is None:
+                return None
+            return {'running': account['running'],
+                    'pending': sum(job[3] == email for job in self._jobs),
+                    'failures': account['failures'],
+                    'last_error': account['last_error'],
+                    'synced_at': dict(account['synced_at'])}
+
+    def stop(self):
+        """ Stop the workers (the running jobs are let to finish) """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+
+    # Must be run with the condition's lock held:
+
+    def _schedule(self, priority, due, email, folder):
+        self._sequence += 1
+        self._jobs.append((priority, due, self._sequence, email, folder))
+        self._condition.notify()
+
+    def _start_workers(self):
+        while len(self._workers) < self.n_workers:
+            worker = threading.Thread(target=self._work, name=f'sync-worker-{len(self._workers)}', daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _next_job(self):
+        """
+        Remove and return the most important job that can run now,
+        or (None, seconds to wait for the next one)
+        """
+        now = time.monotonic()
+        wait = None
+        for job in sorted(self._jobs):
+            priority, due, _, email, folder = job
+            account = self._accounts[email]
+            start = max(due, account['not_before'])
+            if start > now:
+                wait = start - now if wait is None else min(wait, start - now)
+            elif account['running'] < self.max_per_account:
+                self._jobs.remove(job)
+                return job, None
+        return None, wait
+
+
+    # Run by the worker threads:
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    job, wait = self._next_job()
+                    if job is not None:
+                        break
+                    self._condition.wait(wait)
+                priority, _, _, email, folder = job
+                account = self._accounts[email]
+                account['running'] += 1
+                password = account['password']
+
+            try:
+                self.sync_job(email, password, folder)
+            except Exception as e:
+                logger.warning('Sync of %s (%s) failed: %s', email, folder or 'all folders', e)
+                error = str(e) or type(e).__name__
+            else:
+                error = None
+
+            with self._condition:
+                account['running'] -= 1
+                if error is None:
+                    account['failures'] = 0
+                    account['last_error'] = None
+                    account['synced_at'][folder] = datetime.utcnow()
+                else:
+                    account['failures'] += 1
+                    account['last_error'] = error
+                    backoff = min(self.interval * 2 ** account['failures'], self.max_backoff)
+                    account['not_before'] = time.monotonic() + backoff
+                if priority == PERIODIC and self._accounts.get(email) is account:
+                    self._schedule(PERIODIC, time.monotonic() + self.interval, email, None)
+                self._condition.notify_all()
@@ -0,0 +1,160 @@
+"""Full-text search over the locally stored emails (SQLite FTS5)"""
+
+import html
+
+from sqlalchemy import text
+
+
+# The index: one row per email (rowid = email.id).
+# It is kept up to date by the triggers below, so the code that writes emails doesn't need to know about it
+# - except the body: it's stored compressed, so `Email.store_body` puts it into the index (`index_email_text`).
+SEARCH_INDEX_SQL = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS email_fts USING fts5(
+    subject, from_, to_, text, attachments,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+'''
+
+SEARCH_TRIGGERS_SQL = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS email_fts_insert AFTER INSERT ON email BEGIN
+        INSERT INTO email_fts (rowid, subject, from_, to_, text, attachments)
+        VALUES (new.id, new.subject, new."from", new."to", new.text, '');
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS email_fts_update AFTER UPDATE OF subject, "from", "to" ON email BEGIN
+        UPDATE email_fts SET subject = new.subject, from_ = new."from", to_ = new."to"
+        WHERE rowid = new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS email_fts_delete AFTER DELETE ON email BEGIN
+        DELETE FROM email_fts WHERE rowid = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS attachment_fts_insert AFTER INSERT ON attachment BEGIN
+        UPDATE email_fts SET attachments = trim(attachments || ' ' || new.filename)
+        WHERE rowid = new.email_id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS attachment_fts_delete AFTER DELETE ON attachment BEGIN
+        UPDATE email_fts SET attachments = (
+            SELECT COALESCE(group_concat(filename, ' '), '') FROM attachment WHERE email_id = old.email_id)
+        WHERE rowid = old.email_id;
+    END
+    ''',
+]
+
+# Weights of the columns in the ranking (bm25): subject, from_, to_, text, attachments
+RANK_WEIGHTS = (10.0, 5.0, 3.0, 1.0, 2.0)
+
+# Marks of the matched words in a snippet (replaced by <mark> after the snippet is escaped):
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+
+def create_search_index(connection):
+    """
+    Create the index and its triggers (if they don't exist yet).
+    If the index is new - fill it with the emails that are already stored.
+    Only for SQLite (does nothing with other databases).
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+    exists = connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_fts'")).first()
+    connection.execute(text(SEARCH_INDEX_SQL))
+    for trigger in SEARCH_TRIGGERS_SQL:
+        connection.execute(text(trigger))
+    if not exists:
+        connection.execute(text('''
+            INSERT INTO email_fts (rowid, subject, from_, to_, text, attachments)
+            SELECT e.id, e.subject, e."from", e."to", e.text,
+                   (SELECT COALESCE(group_concat(a.filename, ' '), '') FROM attachment a WHERE a.email_id = e.id)
+            FROM email e
+        '''))
+
+
+def index_email_text(session, email_id, body):
+    """ Put the body (plain text) of a stored email into the index. Only for SQLite """
+    if session.get_bind().dialect.name != 'sqlite':
+        return
+    session.execute(text('UPDATE email_fts SET text = :body WHERE rowid = :email_id'),
+                    {'body': body, 'email_id': email_id})
+
+
+def to_match_expression(query):
+    """
+    Turn the user's query into an FTS5 expression:
+    every word must be present (the last one - as a prefix, as the user may still be typing).
+    Returns None if there are no words in the query.
+    """
+    words = query.split()
+    if not words:
+        return None
+    phrases = ['"' + word.replace('"', '""') + '"' for word in words]
+    phrases[-1] += '*'
+    return ' '.join(phrases)
+
+
+def search_emails(db, owner_id, query, folder_id=None, since=None, until=None, n=20, offset=0):
+    """
+    Find the owner's emails that match the `query` (best matches first).
+    Optional filters: `folder_id`, `since` <= date < `until` (datetimes).
+    Returns a list of dicts (like the page of a folder + 'folder' and 'snippet').
+
+    Every match is ranked (bm25), so the best match is found however old it is
+    - only the `offset + n` best ones are kept while the matches are scored (the sort has a LIMIT).
+    (scoring costs ~1 ms per thousand matches: a word that is in most of 100k emails takes ~70 ms)
+    """
+    match = to_match_expression(query)
+    if match is None:
+        return []
+    conditions = ['email_fts MATCH :match', 'e.owner_id = :owner_id']
+    params = {'match': match, 'owner_id': owner_id, 'n': n, 'offset': offset}
+    if folder_id is not None:
+        conditions.append('e.folder_id = :folder_id')
+        params['folder_id'] = folder_id
+    # (dates are stored as text by SQLAlchemy, in the same format as str(datetime))
+    if since is not None:
+        conditions.append('e.date >= :since')
+        params['since'] = str(since)
+    if until is not None:
+        conditions.append('e.date < :until')
+        params['until'] = str(until)
+    rows = db.session.execute(text(f'''
+        SELECT e.id, e.uid, e.date, e."from" AS from_, e."to" AS to_, e.subject, e.size, f.name AS folder
+        FROM email_fts
+        JOIN email e ON e.id = email_fts.rowid
+        JOIN folder f ON f.id = e.folder_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY bm25(email_fts, {', '.join(map(str, RANK_WEIGHTS))}), e.id DESC
+        LIMIT :n OFFSET :offset
+    '''), params).all()
+    if not rows:
+        return []
+
+    # Snippets - only of the emails on this page:
+    snippets = dict(db.session.execute(text(f'''
+        SELECT rowid, snippet(email_fts, -1, '{MATCH_START}', '{MATCH_END}', '…', 12)
+        FROM email_fts
+        WHERE email_fts MATCH :match AND rowid IN ({', '.join(str(row.id) for row in rows)})
+    '''), {'match': match}).all())
+
+    results = []
+    for row in rows:
+        snippet = html.escape(snippets.get(row.id) or '')
+        snippet = snippet.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+        results.append({
+            'uid': row.uid,
+            'date': row.date.replace(' ', 'T') if row.date else None,
+            'from_': row.from_,
+            'to': row.to_,
+            'subject': row.subject,
+            'size': row.size,
+            'folder': row.folder,
+            'snippet': snippet,
+        })
+    return results
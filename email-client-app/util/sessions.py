@@ -0,0 +1,237 @@
+"""Server-side sessions: the cookie holds only a random session id, the data is kept in a `SessionStore`"""
+
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+serializer = TaggedJSONSerializer()  # (like Flask's cookie sessions: JSON + bytes, datetimes, tuples...)
+
+
+def load_secret_key(path):
+    """
+    The secret key of the app: generated once, and kept in the file `path`
+    (so the signed data stays valid after a restart, and is the same in every worker process)
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    key = secrets.token_hex(32)
+    try:
+        # (O_EXCL - if several workers start at the same time, the first one's key is used by all)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path) as f:
+            return f.read().strip()
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
+
+
+class SQLiteSessionStore:
+    """
+    Sessions in an SQLite database (WAL mode - the readers don't wait for the writer).
+    All the worker processes that use the same file share the sessions.
+    The expired sessions are deleted at most once every `sweep_interval` seconds.
+    (the file is opened only by the first request - not when the app is imported, so the store can be
+    created before the worker processes are forked; every process opens its own connections)
+    """
+
+    def __init__(self, path, sweep_interval=300):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()  # (an SQLite connection can't be shared between threads)
+        self._next_sweep = 0
+        self._created = False  # (whether the table was created - by this process)
+
+    def get(self, sid):
+        row = self._connection().execute(
+            'SELECT data FROM session WHERE id = ? AND expires_at > ?', (sid, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, sid, data, expires_at):
+        connection = self._connection()
+        connection.execute('INSERT INTO session (id, data, expires_at) VALUES (?, ?, ?) '
+                           'ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at',
+                           (sid, data, expires_at))
+        self._sweep(connection)
+
+    def delete(self, sid):
+        self._connection().execute('DELETE FROM session WHERE id = ?', (sid,))
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # (a connection opened before a fork belongs to the parent process - the child opens its own)
+        if connection is None or self._local.pid != os.getpid():
+            if not self._created:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # (autocommit: every statement is its own short transaction)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')  # (with WAL - still safe after a crash of the app)
+            if not self._created:  # (IF NOT EXISTS - several threads / processes may get here at the same time)
+                connection.execute('CREATE TABLE IF NOT EXISTS session '
+                                   '(id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS ix_session_expires_at ON session (expires_at)')
+                self._created = True
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _sweep(self, connection):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        connection.execute('DELETE FROM session WHERE expires_at <= ?', (now,))
+
+
+class MemorySessionStore:
+    """
+    Sessions in the memory of this process (the fastest, but not shared between the
+    worker processes, and lost on restart - for a single process / development).
+    At most `max_sessions` are kept, the least recently used ones are dropped first.
+    """
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # sid -> (data, expires_at) (the most recently used - at the end)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return entry[0]
+
+    def set(self, sid, data, expires_at):
+        with self._lock:
+            self._sessions[sid] = (data, expires_at)
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+
+class RedisSessionStore:
+    """
+    Sessions in Redis (shared by all the processes and machines; Redis deletes the expired ones itself).
+    `client` - a `redis.Redis` (or anything with the same `get`, `set(..., exat=...)` and `delete`)
+    """
+
+    def __init__(self, client, prefix='session:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis  # (optional dependency - only needed for this store)
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, sid):
+        return self.client.get(self.prefix + sid)
+
+    def set(self, sid, data, expires_at):
+        self.client.set(self.prefix + sid, data, exat=int(expires_at) + 1)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at  # (what the store has now)
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Flask session interface over a `SessionStore` (`SQLiteSessionStore`, `MemorySessionStore`,
+    `RedisSessionStore`).
+
+    A session is written to the store only when it has changed, or when less than half of
+    its lifetime is left (so most requests only read it - one lookup by the primary key).
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                content = serializer.loads(data if isinstance(data, str) else data.decode())
+                return ServerSideSession(content['data'], sid=sid, expires_at=content['expires_at'])
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def regenerate(self, session):
+        """
+        Give the session a new id, and delete the record of the old one - on the log in
+        (an id that was known before it, e.g. planted by an attacker, doesn't become a logged-in session)
+        """
+        if not session.new:
+            self.store.delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        needs_refresh = session.expires_at is None or session.expires_at - now < lifetime / 2
+        if not (session.modified or needs_refresh):
+            return
+        expires_at = now + lifetime
+        data = serializer.dumps({'data': dict(session), 'expires_at': expires_at})
+        self.store.set(session.sid, data.encode(), expires_at)
+        response.set_cookie(name, session.sid,
+                            expires=datetime.fromtimestamp(expires_at, timezone.utc)
+                                    if app.config.get('SESSION_PERMANENT', True) else None,
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain,
+                            path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+def create_session_store(backend, instance_path, redis_url=None):
+    """ The session store by its name: 'sqlite' (default), 'memory' or 'redis' """
+    if backend == 'sqlite':
+        return SQLiteSessionStore(os.path.join(instance_path, 'sessions.db'))
+    if backend == 'memory':
+        return MemorySessionStore()
+    if backend == 'redis':
+        return RedisSessionStore.from_url(redis_url or 'redis://localhost:6379/0')
+    raise ValueError(f'Unknown session backend: {backend}')
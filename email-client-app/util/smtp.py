@@ -0,0 +1,109 @@
+"""Pool of logged-in SMTP connections, and sending a message from a file"""
+
+import smtplib
+
+from .configs import SMTP_CONFIGS
+from .instrumentation import InstrumentedSMTP, InstrumentedSMTP_SSL
+from .pool import ConnectionPool
+
+
+def get_smtp_server(email):
+    """ Return (host, port, use_ssl, use_tls) of the SMTP server of this email address """
+    config = SMTP_CONFIGS[email.split('@')[-1]]
+    return config['MAIL_SERVER'], config['MAIL_PORT'], config['MAIL_USE_SSL'], config['MAIL_USE_TLS']
+
+
+def connect_smtp(email, password, timeout=30):
+    """ Open a new SMTP session and log in (raises `smtplib.SMTPException` / `OSError`; its commands are recorded) """
+    host, port, use_ssl, use_tls = get_smtp_server(email)
+    if use_ssl:
+        smtp = InstrumentedSMTP_SSL(host, port, timeout=timeout)
+    else:
+        smtp = InstrumentedSMTP(host, port, timeout=timeout)
+        if use_tls:
+            smtp.starttls()
+    smtp.login(email, password)
+    return smtp
+
+
+SEND_CHUNK_SIZE = 64 * 1024  # bytes (sent with one `send`)
+
+
+def send_file(smtp, sender, recipients, file):
+    """
+    Like `smtp.sendmail`, but the message is read from the binary `file` (CRLF line endings) while it's sent
+    - so a message with large attachments is never whole in memory.
+    Returns the refused recipients {recipient: (code, response)}, raises what `sendmail` raises.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    code, response = smtp.mail(sender)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    refused = {}
+    for recipient in recipients:
+        code, response = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, response = smtp.docmd('DATA')
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, response)
+    chunk, size = [], 0
+    for line in file:
+        if line.startswith(b'.'):
+            line = b'.' + line  # (a line with only a dot would end the message)
+        if not line.endswith(b'\r\n'):
+            line = line.rstrip(b'\r\n') + b'\r\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= SEND_CHUNK_SIZE:
+            smtp.send(b''.join(chunk))
+            chunk, size = [], 0
+    chunk.append(b'.\r\n')
+    smtp.send(b''.join(chunk))
+    code, response = smtp.getreply()
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+class SMTPPool(ConnectionPool):
+    """
+    Keeps authenticated SMTP sessions open between the sends of an account
+    (one TLS handshake + AUTH for many messages).
+
+    Usage:
+        with smtp_pool.connection(email, password) as smtp:
+            smtp.send_file(...)  # (or smtp.sendmail)
+
+    Idle sessions are closed after `idle_timeout` seconds (servers close them themselves
+    after a few minutes), and a session idle for more than `check_after` seconds is checked with NOOP.
+    An account has at most `max_checked_out` sessions open at once (the outbox's workers).
+    """
+
+    def __init__(self, max_per_user=1, idle_timeout=120, check_after=10, connect=connect_smtp, max_checked_out=2):
+        super().__init__(max_per_user, None, idle_timeout, check_after, max_checked_out)
+        self.connect = connect
+
+    def _open(self, email, password):
+        return self.connect(email, password)
+
+    def _is_alive(self, smtp):
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _close(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
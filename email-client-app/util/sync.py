@@ -0,0 +1,496 @@
+"""Incremental synchronization of a folder: server -> local database"""
+
+import os
+import re
+from datetime import datetime
+from imap_tools import MailMessage, MailboxFetchError, MailboxFolderStatusError
+from imap_tools.utils import check_command_status, encode_folder
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .conversations import THREAD_HEADER_FIELDS, parse_thread_headers, thread_headers
+from .ingest import batched, get_existing_uids, insert_emails, update_emails
+
+
+STATUS_ITEM_RE = re.compile(r'([A-Z]+) (\d+)')
+FETCH_UID_RE = re.compile(r'UID (\d+)')
+FETCH_FLAGS_RE = re.compile(r'FLAGS \(([^)]*)\)')
+
+
+def get_capabilities(mailbox):
+    """
+    Capabilities of the server, requested once per connection
+    (some servers list e.g. CONDSTORE only after the login)
+    """
+    if getattr(mailbox, 'sync_capabilities', None) is None:
+        typ, data = mailbox.client.capability()
+        if typ == 'OK' and data and data[0]:
+            mailbox.sync_capabilities = set(data[0].decode().upper().split())
+        else:
+            mailbox.sync_capabilities = set(mailbox.client.capabilities)
+    return mailbox.sync_capabilities
+
+
+def get_folder_status(mailbox, server_folder):
+    """
+    Request the state of the folder with one STATUS command (without selecting it).
+    Example: {'MESSAGES': 41, 'UIDNEXT': 11996, 'UIDVALIDITY': 1, 'UNSEEN': 5, 'HIGHESTMODSEQ': 7001}
+    """
+    options = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY', 'UNSEEN']
+    if 'CONDSTORE' not in get_capabilities(mailbox):
+        return mailbox.folder.status(server_folder, options)
+    # (HIGHESTMODSEQ - RFC 7162 - is not one of the options `folder.status` accepts: imaplib's STATUS is used)
+    typ, data = mailbox.client.status(encode_folder(server_folder), f'({" ".join(options)} HIGHESTMODSEQ)')
+    check_command_status((typ, data), MailboxFolderStatusError)
+    status_data = [item for item in data if type(item) is bytes][-1]
+    values = status_data.decode().rsplit('(', 1)[-1]
+    return {name: int(value) for name, value in STATUS_ITEM_RE.findall(values)}
+
+
+def parse_fetched_flags(fetch_data):
+    """ Parse the response of `UID FETCH ... (FLAGS)` -> {uid: 'flags string'} """
+    flags_by_uid = {}
+    for item in fetch_data:
+        if type(item) is tuple:
+            item = item[0]
+        if not item:
+            continue
+        item = item.decode()
+        uid_match = FETCH_UID_RE.search(item)
+        flags_match = FETCH_FLAGS_RE.search(item)
+        if uid_match and flags_match:
+            flags_by_uid[int(uid_match.group(1))] = flags_match.group(1)
+    return flags_by_uid
+
+
+def parse_fetched_thread_headers(fetch_data):
+    """ Parse the response of `UID FETCH ... (UID BODY.PEEK[HEADER.FIELDS (...)])` -> {uid: `thread_headers`} """
+    headers = {}
+    for item in fetch_data:
+        if type(item) is tuple:
+            uid_match = FETCH_UID_RE.search(item[0].decode())
+            if uid_match:
+                headers[int(uid_match.group(1))] = parse_thread_headers(item[1])
+    return headers
+
+
+def parse_searched_uids(search_data):
+    """ Parse the response of `UID SEARCH` -> {uid, ...} """
+    return {int(uid) for item in search_data if item for uid in item.split()}
+
+
+def may_have_expunged(folder, status):
+    """
+    Whether messages of the `folder` (its sync state) may have been expunged on the server since its last sync:
+    the messages it had then, plus at most one per new uid, are more than the server has now
+    (None - the number is not known yet: checked once)
+    """
+    if folder.uidnext is None:
+        return False
+    if folder.n_server_messages is None:
+        return True
+    return status['MESSAGES'] < folder.n_server_messages + (status['UIDNEXT'] - folder.uidnext)
+
+
+def flag_changes(local, flags_by_uid):
+    """
+    The flags that differ from the stored ones (`local` - {uid: (email_id, uid, flags)}, see `_local_flags`):
+    [{'email_id', 'uid', 'old_flags', 'flags'}, ...]
+    """
+    changes = []
+    for uid, flags in flags_by_uid.items():
+        row = local.get(uid)
+        if row is not None and row.flags != flags:
+            changes.append({'email_id': row.email_id, 'uid': uid, 'old_flags': row.flags, 'flags': flags})
+    return changes
+
+
+class SyncEngine:
+    """
+    Brings the local copy of a folder up to date, transferring as little as possible.
+
+    For every folder its last known UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ
+    are stored in the `Folder` row. On every sync:
+    - STATUS tells whether anything changed at all (if not - that's the whole sync)
+    - only the messages with uid >= UIDNEXT are fetched (these are the new ones)
+    - only the flags that changed since HIGHESTMODSEQ are fetched (if the server
+      supports CONDSTORE, otherwise the flags of the locally stored messages)
+    - if the server has fewer messages than it had plus the new ones - the uids of the stored range
+      are searched on the server, and the stored messages that are not there anymore are deleted
+    - if UIDVALIDITY has changed - the local copy of the folder is dropped,
+      and the newest `n_initial` messages are fetched again
+
+    Only the headers (+ flags and size) of the messages are fetched during a sync,
+    the body and the attachments of a message - only when it's opened (`fetch_body`),
+    and then the raw message is kept in the `message_store` (it's never downloaded again).
+
+    The stored messages are grouped into threads by the `thread_index` (`ThreadIndex`), in the same write jobs
+    (the emails stored before the threading get their threads in the next sync of their folder).
+
+    Must be run with app context (it uses the database).
+    """
+
+    def __init__(self, db, Email, Folder, Attachment, EmailBody, attachment_store, message_store, write_queue=None,
+                 thread_index=None, n_initial=10, bulk=100):
+        self.db = db
+        self.Email = Email
+        self.Folder = Folder
+        self.Attachment = Attachment
+        self.EmailBody = EmailBody
+        self.attachment_store = attachment_store  # (`AttachmentStore`) attachment files are saved there
+        self.message_store = message_store  # (`RawMessageStore`) raw messages are saved there
+        # (`WriteQueue`) the writes of `sync_folder` are run there, None - in the calling thread:
+        self.write_queue = write_queue
+        self.thread_index = thread_index  # None - the emails are not grouped into threads
+        self.n_initial = n_initial
+        self.bulk = bulk
+
+    def sync_folder(self, mailbox, folder):
+        """
+        Sync one `Folder` (database row) of the mailbox's user.
+        Returns a summary: {'new_uids': [...], 'changed_uids': [...], 'expunged_uids': [...], 'full_resync': bool}
+
+        The server is queried in the calling thread, and the database is changed
+        by write jobs (see `write`) - each one a short transaction.
+        """
+        summary = {'new_uids': [], 'changed_uids': [], 'expunged_uids': [], 'full_resync': False}
+        folder_id = folder.folder_id
+        uidnext = folder.uidnext
+        status = get_folder_status(mailbox, folder.server_name)
+        highestmodseq = status.get('HIGHESTMODSEQ')
+
+        if folder.uidvalidity != status['UIDVALIDITY']:
+            # The uids we have are not valid anymore (or the folder was never synced):
+            self.write(self._drop_local_emails, folder_id)
+            uidnext = None
+            summary['full_resync'] = True
+        elif uidnext == status['UIDNEXT'] and folder.n_server_messages == status['MESSAGES'] and (
+                highestmodseq is None or folder.highestmodseq == highestmodseq):
+            # Nothing has changed on the server:
+            self._thread_old_emails(mailbox, folder)
+            self.write(self._save_sync_state, folder_id, {'synced_at': datetime.utcnow()})
+            self.db.session.commit()
+            return summary
+
+        mailbox.folder.set(folder.server_name, readonly=True)
+
+        # New messages (stored in batches of `bulk` messages):
+        if uidnext is None:
+            messages = mailbox.fetch(limit=self.n_initial, reverse=True, mark_seen=False,
+                                     headers_only=True, bulk=self.bulk)
+        else:
+            new_uids = [uid for uid in mailbox.uids(f'UID {uidnext}:*') if int(uid) >= uidnext]
+            messages = mailbox.fetch(uid_list=new_uids, mark_seen=False,
+                                     headers_only=True, bulk=self.bulk) if new_uids else []
+        for batch in batched(messages, self.bulk):
+            rows = [self._header_row(msg) for msg in batch]
+            summary['new_uids'].extend(self.write(self._store_new_messages, folder_id, rows))
+
+        # Messages expunged on the server (only if the number of its messages doesn't add up):
+        if not summary['full_resync'] and may_have_expunged(folder, status):
+            search = self._search_stored_range(mailbox, folder)
+            if search is not None:
+                summary['expunged_uids'] = self.write(self._store_expunged, folder_id, *search)
+
+        # Flag changes of the messages we already have:
+        if not summary['full_resync']:
+            changes = self._fetch_flag_changes(mailbox, folder, highestmodseq)
+            summary['changed_uids'] = self.write(self._store_flag_changes, folder_id, changes)
+            self._thread_old_emails(mailbox, folder)
+
+        self.write(self._save_sync_state, folder_id, {'uidvalidity': status['UIDVALIDITY'],
+                                                       'uidnext': status['UIDNEXT'],
+                                                       'highestmodseq': highestmodseq,
+                                                       'n_server_messages': status['MESSAGES'],
+                                                       'synced_at': datetime.utcnow()})
+        # (ends the read transaction of this thread - the rows were changed by the writer)
+        self.db.session.commit()
+        return summary
+
+    def write(self, job, *args):
+        """ Run a write job (it's committed after it) - in the write queue, if there is one """
+        if self.write_queue is not None:
+            return self.write_queue.run(job, *args)
+        result = job(*args)
+        self.db.session.commit()
+        return result
+
+    def fetch_body(self, mailbox, folder, email):
+        """
+        Download the whole message `email` (if only its headers are stored),
+        save it to the message store, and save its text and attachments
+        """
+        if email.body_fetched and email.path is not None:
+            return
+        mailbox.folder.set(folder.server_name, readonly=True)
+        # (the raw message is needed as it is - so it's requested directly, not with `mailbox.fetch`)
+        fetch_result = mailbox.client.uid('FETCH', str(email.uid), '(UID FLAGS RFC822.SIZE BODY.PEEK[])')
+        check_command_status(fetch_result, MailboxFetchError)
+        raw = next((item[1] for item in fetch_result[1] if type(item) is tuple), None)
+        if raw is None:
+            raise LookupError(f'Message {email.uid} is not in the folder "{folder.name}" anymore')
+        msg = MailMessage(fetch_result[1])
+        flags = ' '.join(msg.flags)
+        if flags != email.flags:
+            # (in a write job, like the flags of a sync - the unread counters of the folder and the thread change too)
+            self.write(self._set_flags, folder.folder_id, {email.email_id: flags})
+            set_committed_value(email, 'flags', flags)
+        if email.body_fetched:
+            # (downloaded before the message store existed - its text and attachments are stored already)
+            email.path = self.message_store.put(email.owner_id, email.email_id, raw)
+            self.db.session.commit()
+            return
+        self.store_message(email, raw, msg)
+        self.db.session.commit()
+
+    def store_message(self, email, raw, msg):
+        """
+        Save the downloaded message of `email` (a stored `Email`): the raw message (`raw` - bytes)
+        to the message store, its text and its attachments (`msg` - the parsed `MailMessage`).
+        Not committed here
+        """
+        email.path = self.message_store.put(email.owner_id, email.email_id, raw)
+        email.text = msg.text
+        email.body_fetched = True
+        for i, att in enumerate(msg.attachments):
+            sha256, size = self.attachment_store.put_bytes(att.payload)
+            attachment = self.Attachment(filename=att.filename or f'attachment_{i}',
+                                         content_type=att.content_type,
+                                         path=self.attachment_store.path(sha256),
+                                         sha256=sha256,
+                                         size=size,
+                                         email=email)
+            self.db.session.add(attachment)
+
+    def _thread_old_emails(self, mailbox, folder):
+        """ Fetch the threading headers of the emails that were stored before the threading, and find their threads """
+        uids = self._unthreaded_uids(folder)
+        if not uids:
+            return
+        mailbox.folder.set(folder.server_name, readonly=True)
+        for batch in batched(uids, self.bulk):
+            fetch_result = mailbox.client.uid('FETCH', ','.join(map(str, batch)),
+                                              f'(UID BODY.PEEK[HEADER.FIELDS ({THREAD_HEADER_FIELDS})])')
+            headers = parse_fetched_thread_headers(fetch_result[1]) if fetch_result[0] == 'OK' else {}
+            # (the messages that are not on the server anymore get a thread of their own)
+            self.write(self._store_thread_headers, folder.folder_id, batch, headers)
+
+    def _unthreaded_uids(self, folder):
+        """ The uids (sorted) of the stored emails of the folder that have no thread yet """
+        if self.thread_index is None:
+            return []
+        Email = self.Email
+        return sorted(self.db.session.scalars(
+            self.db.select(Email.uid)
+            .where(Email.owner_id == folder.owner_id)
+            .where(Email.folder_id == folder.folder_id)
+            .where(Email.thread_id.is_(None))))
+
+    def _fetch_flag_changes(self, mailbox, folder, highestmodseq):
+        """ Ask the server which flags have changed: [{'email_id', 'uid', 'old_flags', 'flags'}, ...] """
+        local = self._local_flags(folder)
+        if not local:
+            return []
+
+        if highestmodseq is not None and folder.highestmodseq is not None:
+            if highestmodseq == folder.highestmodseq:
+                return []
+            # (CONDSTORE) only the messages whose flags changed:
+            fetch_result = mailbox.client.uid(
+                'FETCH', f'1:{folder.uidnext - 1}', '(UID FLAGS)', f'(CHANGEDSINCE {folder.highestmodseq})')
+        else:
+            fetch_result = mailbox.client.uid(
+                'FETCH', f'{min(local)}:{max(local)}', '(UID FLAGS)')
+        if fetch_result[0] != 'OK':
+            return []
+        return flag_changes(local, parse_fetched_flags(fetch_result[1]))
+
+    def _search_stored_range(self, mailbox, folder):
+        """
+        The uids on the server in the range of the stored messages of the folder (below its UIDNEXT):
+        (first uid, last uid, {uid, ...}) - or None if nothing is stored
+        """
+        first, last = self._stored_range(folder)
+        if first is None:
+            return None
+        search_result = mailbox.client.uid('SEARCH', 'UID', f'{first}:{last}')
+        if search_result[0] != 'OK':
+            return None
+        return first, last, parse_searched_uids(search_result[1])
+
+    def _stored_range(self, folder):
+        """ (the smallest, the largest) uid of the stored messages of the folder below its UIDNEXT """
+        Email = self.Email
+        return self.db.session.execute(
+            self.db.select(self.db.func.min(Email.uid), self.db.func.max(Email.uid))
+            .where(Email.owner_id == folder.owner_id)
+            .where(Email.folder_id == folder.folder_id)
+            .where(Email.uid < (folder.uidnext or 0))
+        ).one()
+
+    def _local_flags(self, folder):
+        """ The flags of the stored messages of the folder (below its UIDNEXT): {uid: (email_id, uid, flags)} """
+        Email = self.Email
+        return {row.uid: row for row in self.db.session.execute(
+            self.db.select(Email.email_id, Email.uid, Email.flags)
+            .where(Email.owner_id == folder.owner_id)
+            .where(Email.folder_id == folder.folder_id)
+            .where(Email.uid < (folder.uidnext or 0))
+        )}
+
+
+    # Write jobs (run in the write queue, or in the calling thread):
+
+    @staticmethod
+    def _header_row(msg):
+        return {'uid': int(msg.uid),
+                'date': msg.date,
+                'from_': msg.from_,
+                'to': msg.to[0] if msg.to else '',
+                'subject': msg.subject,
+                'flags': ' '.join(msg.flags),
+                'size': msg.size_rfc822,
+                'body_fetched': False,
+                **thread_headers(msg.headers)}
+
+    def _store_new_messages(self, folder_id, rows):
+        """ Insert the messages (`rows` - see `_header_row`) that are not stored yet. Returns their uids """
+        folder = self.db.session.get(self.Folder, folder_id)
+        existing = get_existing_uids(self.db, self.Email, folder, [row['uid'] for row in rows])
+        new_rows = []
+        for row in rows:
+            if row['uid'] in existing:
+                continue
+            existing[row['uid']] = None
+            new_rows.append({'owner_id': folder.owner_id, **row})
+        thread_ids = self.thread_index.assign(folder.owner_id, new_rows) if self.thread_index is not None else ()
+        inserted = insert_emails(self.db, self.Email, folder, new_rows)
+        new_rows = [row for row in new_rows if row['uid'] in inserted]
+        if thread_ids:
+            self.thread_index.refresh(thread_ids)
+        folder.n_messages += len(new_rows)
+        folder.n_unread += sum('\\Seen' not in row['flags'].split() for row in new_rows)
+        folder.total_size += sum(row['size'] or 0 for row in new_rows)
+        return [row['uid'] for row in new_rows]
+
+    def _store_flag_changes(self, folder_id, changes):
+        """ Save the changed flags (see `_fetch_flag_changes`). Returns the uids of the changed messages """
+        if not changes:
+            return []
+        changed = self._set_flags(folder_id, {change['email_id']: change['flags'] for change in changes})
+        return [change['uid'] for change in changes if change['email_id'] in changed]
+
+    def _set_flags(self, folder_id, flags_by_email_id):
+        """
+        Save the flags of the stored emails of the folder ({email_id: flags}), and count their unread messages
+        (of the folder and of their threads) again. The stored flags are read here, in the write job - a change
+        that another job has saved since they were fetched is not counted twice.
+        Returns the ids of the emails whose flags have changed
+        """
+        Email = self.Email
+        stored = {}
+        for batch in batched(list(flags_by_email_id), 500):
+            stored.update(self.db.session.execute(
+                self.db.select(Email.email_id, Email.flags).where(Email.email_id.in_(batch))).all())
+        changed = {email_id: flags for email_id, flags in flags_by_email_id.items()
+                   if email_id in stored and stored[email_id] != flags}
+        if not changed:
+            return set()
+        folder = self.db.session.get(self.Folder, folder_id)
+        for email_id, flags in changed.items():
+            was_seen = '\\Seen' in (stored[email_id] or '').split()
+            is_seen = '\\Seen' in flags.split()
+            folder.n_unread += was_seen - is_seen
+        update_emails(self.db, Email, [{'email_id': email_id, 'flags': flags} for email_id, flags in changed.items()])
+        if self.thread_index is not None:
+            self.thread_index.refresh(self.thread_index.threads_of(list(changed)))
+        return set(changed)
+
+    def _store_expunged(self, folder_id, first, last, server_uids):
+        """
+        Delete the stored messages of the folder with uids from `first` to `last`
+        that are not in `server_uids` (see `_search_stored_range`). Returns their uids
+        """
+        Email = self.Email
+        gone = [row for row in self.db.session.execute(
+                    self.db.select(Email.email_id, Email.uid, Email.flags, Email.size)
+                    .where(Email.folder_id == folder_id)
+                    .where(Email.uid.between(first, last)))
+                if row.uid not in server_uids]
+        if not gone:
+            return []
+        self.delete_local_emails([row.email_id for row in gone])
+        folder = self.db.session.get(self.Folder, folder_id)
+        folder.n_messages -= len(gone)
+        folder.n_unread -= sum('\\Seen' not in (row.flags or '').split() for row in gone)
+        folder.total_size -= sum(row.size or 0 for row in gone)
+        return [row.uid for row in gone]
+
+    def _store_thread_headers(self, folder_id, uids, headers):
+        """ Save the threading headers of the stored emails (`headers` - {uid: `thread_headers`}), and their threads """
+        Email = self.Email
+        rows = [{'email_id': row.email_id, 'subject': row.subject, 'date': row.date,
+                 **headers.get(row.uid, {'message_id': None, 'references': None})}
+                for row in self.db.session.execute(
+                    self.db.select(Email.email_id, Email.uid, Email.subject, Email.date)
+                    .where(Email.folder_id == folder_id)
+                    .where(Email.uid.in_(uids))
+                    .where(Email.thread_id.is_(None)))]
+        if not rows:
+            return
+        folder = self.db.session.get(self.Folder, folder_id)
+        thread_ids = self.thread_index.assign(folder.owner_id, rows)
+        update_emails(self.db, Email, [{'email_id': row['email_id'], 'message_id': row['message_id'],
+                                         'references': row['references'], 'thread_id': row['thread_id']}
+                                        for row in rows])
+        self.thread_index.refresh(thread_ids)
+
+    def _save_sync_state(self, folder_id, values):
+        self.db.session.execute(self.db.update(self.Folder)
+                                .where(self.Folder.folder_id == folder_id)
+                                .values(**values))
+
+    def _drop_local_emails(self, folder_id):
+        """ Delete all the locally stored emails of the folder """
+        email_ids = list(self.db.session.scalars(
+            self.db.select(self.Email.email_id).where(self.Email.folder_id == folder_id)))
+        self.delete_local_emails(email_ids)
+        self._save_sync_state(folder_id, {'n_messages': 0, 'n_unread': 0, 'total_size': 0,
+                                          'uidnext': None, 'highestmodseq': None,
+                                          'import_next_uid': None, 'imported_at': None})
+
+    def delete_local_emails(self, email_ids):
+        """
+        Delete the emails (by their ids) with their attachments and files, with a few bulk statements.
+        The counters of their folders are not changed here
+        """
+        db, Email, Attachment, EmailBody = self.db, self.Email, self.Attachment, self.EmailBody
+        thread_ids = set()
+        for batch in batched(email_ids, 500):
+            if self.thread_index is not None:
+                thread_ids.update(self.thread_index.threads_of(batch))
+            paths = list(db.session.scalars(db.select(Email.path).where(Email.email_id.in_(batch))))
+            files = db.session.execute(
+                db.select(Attachment.sha256, Attachment.path).where(Attachment.email_id.in_(batch))).all()
+            db.session.execute(db.delete(Attachment).where(Attachment.email_id.in_(batch)))
+            db.session.execute(db.delete(EmailBody).where(EmailBody.email_id.in_(batch)))
+            db.session.execute(db.delete(Email).where(Email.email_id.in_(batch)))
+            self._remove_unreferenced_files(files)
+            for path in paths:
+                if path is not None:
+                    self.message_store.discard(path)
+        if thread_ids:
+            self.thread_index.refresh(thread_ids)
+
+    def _remove_unreferenced_files(self, files):
+        """ Delete the attachment files (sha256, path) that no attachment refers to anymore """
+        db, Attachment = self.db, self.Attachment
+        hashes = {sha256 for sha256, _ in files if sha256}
+        still_used = set(db.session.scalars(
+            db.select(Attachment.sha256).where(Attachment.sha256.in_(hashes)).distinct())) if hashes else set()
+        for sha256, path in files:
+            if sha256 is None:
+                # (a file saved before the attachment store - one per attachment)
+                if os.path.exists(path):
+                    os.remove(path)
+            elif sha256 not in still_used:
+                self.attachment_store.discard(sha256)
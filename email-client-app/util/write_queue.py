@@ -0,0 +1,95 @@
+"""Single writer for the database: the write jobs of the sync are run one at a time by one thread"""
+
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+from .file_lock import FileLock
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueue:
+    """
+    Runs the write jobs (e.g. "insert these fetched messages") one after another, in one thread.
+
+    With SQLite only one connection can write at a time - concurrent writers wait for each other
+    (or fail with "database is locked" after the busy timeout). So the sync workers do the network
+    part (IMAP) in parallel, and hand the database writes to this queue:
+    - `run(job, *args)` waits for the job to finish and returns its result (or raises its exception)
+    - a job is run with app context, in the writer's own session, which is committed after it
+      (or rolled back if the job raised)
+    - `lock_path` - a file that is locked during every job (with several worker processes,
+      so that only one of them writes at a time; None - no lock, e.g. for PostgreSQL).
+      It's a `FileLock`: `fcntl.flock`, `msvcrt.locking` on Windows, or a lock of this process only
+      where neither exists
+    """
+
+    def __init__(self, app, db, lock_path=None):
+        self.app = app
+        self.db = db
+        self.lock_path = lock_path
+        self._file_lock = FileLock(lock_path) if lock_path is not None else None
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.counters = {'jobs': 0, 'failed': 0}
+
+    def run(self, job, *args):
+        """ Run `job(*args)` in the writer thread, and return its result """
+        return self.submit(job, *args).result()
+
+    def submit(self, job, *args):
+        """ Put `job(*args)` in the queue. Returns a `Future` of its result """
+        self._start()
+        future = Future()
+        self._jobs.put((future, job, args))
+        return future
+
+    def stats(self):
+        return dict(self.counters, queued=self._jobs.qsize())
+
+    def stop(self):
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def _process_lock(self):
+        return self._file_lock if self._file_lock is not None else nullcontext()
+
+
+    # Run by the writer thread:
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                item = self._jobs.get()
+                if item is None:
+                    return
+                future, job, args = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with self._process_lock():
+                        result = job(*args)
+                        self.db.session.commit()
+                except BaseException as e:
+                    self.db.session.rollback()
+                    self.counters['failed'] += 1
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                finally:
+                    self.counters['jobs'] += 1
+                    # (the next job must see the current state of the rows - not this session's copy)
+                    self.db.session.expunge_all()